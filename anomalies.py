@@ -0,0 +1,319 @@
+"""Movimentos repetidos e gastos atípicos, calculados sobre as colunas do ledger.
+
+Duas verificações, vetorizadas (NumPy) sobre os arrays de um UserLedger:
+
+- repetidos: uma saída com o mesmo valor, conta e descrição (sem distinguir
+  maiúsculas/espaços) que outra até DUPLICATE_DAYS dias antes — o típico
+  débito em duplicado. Movimentos sem descrição ficam de fora;
+- atípicos: categorias em que o gasto do mês está mais de Z_LIMIT
+  desvios-padrão acima da média dos 12 meses anteriores (e pelo menos
+  MIN_EXCESS acima). É a série mensal do dashboard: sem transferências e
+  na moeda de relatório. Avaliam-se o mês corrente e o anterior.
+
+Os movimentos não são editados nem apagados, por isso um par repetido já
+encontrado continua válido: cada passagem só procura pares em que um dos
+movimentos é novo (id > last_id da passagem anterior) e acrescenta-os. Os
+atípicos são recalculados (duas colunas de uma matriz categorias × meses).
+O resultado fica em `anomalies`, e o estado de cada utilizador em
+anomaly_scans. As escritas pedem uma passagem depois do commit
+(`ScanQueue`, numa thread do worker, fora do pedido); a tarefa periódica
+apanha a viragem do mês e o que tiver ficado para trás. As páginas só
+leem (`read`).
+
+Valores em cêntimos: o dos repetidos na moeda da conta, o dos atípicos na
+moeda de relatório.
+"""
+import json
+import logging
+import os
+import statistics
+import threading
+from bisect import bisect_left
+from datetime import date
+
+import ledger
+
+DUPLICATE_DAYS = 3
+BASELINE_MONTHS = 12
+Z_LIMIT = 2.5
+MIN_EXCESS = 5000  # cêntimos acima da média
+MIN_MONTHS = 3  # meses com gasto na base, para categorias novas não contarem como picos
+SIGMA_FLOOR = 0.1  # desvio mínimo = 10% da média (gastos fixos têm desvio ~0)
+# o que o dashboard e a API mostram
+SHOW_DAYS = 60
+
+FIELDS = (
+    "tipo", "transaction_id", "ref_id", "account_id", "descricao", "categoria", "mes", "dia", "valor", "media", "z",
+)
+
+
+def _month_key(day):
+    return day.year * 12 + day.month - 1
+
+
+def _month_start(key):
+    return date(key // 12, key % 12 + 1, 1)
+
+
+def history_start(today):
+    """Primeiro dia de que os atípicos precisam (a base do mês anterior)."""
+    return _month_start(_month_key(today) - 1 - BASELINE_MONTHS)
+
+
+def _desc_keys(led):
+    """Para cada id de descrição do ledger, o id da forma normalizada (-1 = sem descrição)."""
+    folded = {}
+    keys = []
+    for text in led.desc_names:
+        norm = " ".join((text or "").lower().split())
+        keys.append(folded.setdefault(norm, len(folded)) if norm else -1)
+    return keys
+
+
+def _first_fresh_day(led, lo, last_id):
+    # dia mais antigo dos movimentos novos (None se não há)
+    np = ledger.numpy()
+    if np is not None:
+        fresh = np.frombuffer(led.ids, dtype=np.int64)[lo:] > last_id
+        return int(np.frombuffer(led.days, dtype=np.int32)[lo:][fresh].min()) if fresh.any() else None
+    return min((led.days[i] for i in range(lo, len(led)) if led.ids[i] > last_id), default=None)
+
+
+def find_duplicates(led, last_id=0, since=None, days=DUPLICATE_DAYS):
+    """[(id, ref_id, posição)]: saídas iguais a outra (ref_id) até `days` dias antes.
+
+    Só pares em que um dos dois é novo (id > last_id); `since` limita a
+    primeira passagem. `posição` é o índice do movimento repetido no ledger.
+    """
+    with led.lock:
+        lo = bisect_left(led.days, since.toordinal()) if since else 0
+        if last_id:
+            first = _first_fresh_day(led, lo, last_id)
+            if first is None:
+                return []
+            # os pares de um movimento novo estão no máximo `days` dias antes dele
+            lo = bisect_left(led.days, first - days, lo)
+        keys = _desc_keys(led)
+        np = ledger.numpy()
+        if np is None:
+            rows = sorted(
+                (led.accounts[i], keys[led.descs[i]], led.amounts[i], led.days[i], led.ids[i], i)
+                for i in range(lo, len(led))
+                if not led.income[i] and not led.transfer[i] and keys[led.descs[i]] >= 0 and led.days[i]
+            )
+            return [
+                (b[4], a[4], b[5])
+                for a, b in zip(rows, rows[1:])
+                if a[:3] == b[:3] and b[3] - a[3] <= days and (a[4] > last_id or b[4] > last_id)
+            ]
+
+        key = np.asarray(keys, dtype=np.int32)[np.frombuffer(led.descs, dtype=np.int32)[lo:]]
+        day = np.frombuffer(led.days, dtype=np.int32)[lo:]
+        sel = (
+            (np.frombuffer(led.income, dtype=np.int8)[lo:] == 0)
+            & (np.frombuffer(led.transfer, dtype=np.int8)[lo:] == 0)
+            & (key >= 0)
+            & (day > 0)
+        )
+        pos = np.nonzero(sel)[0] + lo
+        acc = np.frombuffer(led.accounts, dtype=np.int32)[pos]
+        amt = np.frombuffer(led.amounts, dtype=np.int64)[pos]
+        tid = np.frombuffer(led.ids, dtype=np.int64)[pos]
+        key, day = key[pos - lo], day[pos - lo]
+        # iguais ficam seguidos, por dia: basta comparar cada um com o anterior
+        order = np.lexsort((tid, day, amt, key, acc))
+        acc, key, amt, day, tid, pos = (a[order] for a in (acc, key, amt, day, tid, pos))
+        same = (
+            (acc[1:] == acc[:-1])
+            & (key[1:] == key[:-1])
+            & (amt[1:] == amt[:-1])
+            & (day[1:] - day[:-1] <= days)
+            & ((tid[1:] > last_id) | (tid[:-1] > last_id))
+        )
+        hits = np.nonzero(same)[0]
+        return [(int(tid[k + 1]), int(tid[k]), int(pos[k + 1])) for k in hits]
+
+
+def _grid(led, base, n):
+    """Gasto por (categoria, mês) para os meses base..base+n-1: linhas = ids de categoria."""
+    lo = bisect_left(led.days, _month_start(base).toordinal())
+    ncat = len(led.cat_names)
+    np = ledger.numpy()
+    if np is not None:
+        months = np.frombuffer(led.months, dtype=np.int32)[lo:]
+        keep = (
+            (np.frombuffer(led.income, dtype=np.int8)[lo:] == 0)
+            & (np.frombuffer(led.transfer, dtype=np.int8)[lo:] == 0)
+            & (months < base + n)
+        )
+        cells = np.frombuffer(led.cats, dtype=np.int32)[lo:][keep] * n + (months[keep] - base)
+        values = np.frombuffer(led.values, dtype=led.values.typecode)[lo:][keep]
+        return np.bincount(cells, weights=values, minlength=ncat * n).reshape(ncat, n)
+    grid = [[0] * n for _ in range(ncat)]
+    for i in range(lo, len(led)):
+        m = led.months[i] - base
+        if not led.income[i] and not led.transfer[i] and m < n:
+            grid[led.cats[i]][m] += led.values[i]
+    return grid
+
+
+def _outliers_at(grid, j):
+    """[(id da categoria, gasto, média, z)] da coluna `j` contra as BASELINE_MONTHS anteriores."""
+    np = ledger.numpy()
+    if np is not None:
+        hist = grid[:, j - BASELINE_MONTHS:j]
+        mean = hist.mean(axis=1)
+        sigma = np.maximum(hist.std(axis=1), mean * SIGMA_FLOOR)
+        spent = grid[:, j]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            z = (spent - mean) / sigma
+        hit = ((hist > 0).sum(axis=1) >= MIN_MONTHS) & (spent - mean >= MIN_EXCESS) & (z >= Z_LIMIT)
+        return [(int(c), float(spent[c]), float(mean[c]), float(z[c])) for c in np.nonzero(hit)[0]]
+    out = []
+    for c, row in enumerate(grid):
+        hist, spent = row[j - BASELINE_MONTHS:j], row[j]
+        mean = statistics.fmean(hist)
+        sigma = max(statistics.pstdev(hist), mean * SIGMA_FLOOR)
+        seen = sum(1 for v in hist if v > 0)
+        if seen >= MIN_MONTHS and spent - mean >= MIN_EXCESS and (spent - mean) / sigma >= Z_LIMIT:
+            out.append((c, spent, mean, (spent - mean) / sigma))
+    return out
+
+
+def find_outliers(led, today):
+    """[(categoria, 'YYYY-MM', gasto, média, z)] do mês corrente e do anterior."""
+    current = _month_key(today)
+    base = current - 1 - BASELINE_MONTHS
+    n = current - base + 1
+    with led.lock:
+        grid = _grid(led, base, n)
+        names = list(led.cat_names)
+    return [
+        (names[c], ledger.month_label(base + j), spent, mean, z)
+        for j in (n - 2, n - 1)
+        for c, spent, mean, z in _outliers_at(grid, j)
+    ]
+
+
+def scan(led, state, today):
+    """Uma passagem para um utilizador: (linhas novas, last_id).
+
+    `state` é o de `read` (ou None na primeira vez): só procura repetidos
+    com movimentos depois de state['last_id'], que nunca recua (o ledger
+    pode ter só parte do histórico).
+    """
+    last_id = state["last_id"] if state else 0
+    rows = []
+    for tid, ref_id, i in find_duplicates(led, last_id, since=history_start(today)):
+        day = date.fromordinal(led.days[i])
+        rows.append({
+            "tipo": "duplicado", "transaction_id": tid, "ref_id": ref_id, "account_id": led.accounts[i],
+            "descricao": led.desc_names[led.descs[i]], "categoria": led.cat_names[led.cats[i]],
+            "mes": ledger.month_label(_month_key(day)), "dia": day.isoformat(), "valor": led.amounts[i],
+            "media": None, "z": None,
+        })
+    for categoria, mes, spent, mean, z in find_outliers(led, today):
+        rows.append({
+            "tipo": "atipico", "transaction_id": None, "ref_id": None, "account_id": None, "descricao": None,
+            "categoria": categoria, "mes": mes, "dia": f"{mes}-01", "valor": round(spent),
+            "media": round(mean), "z": round(z, 2),
+        })
+    return rows, max(led.last_id, last_id)
+
+
+def save(cur, results, today):
+    """Grava passagens `results` = [(user_id, data_version, last_id, linhas)].
+
+    3 statements para qualquer nº de utilizadores: os atípicos são
+    substituídos, os repetidos acrescentados (INSERT OR IGNORE). `seq` sobe
+    a cada passagem gravada (os leitores do readpool veem que mudou).
+    """
+    cur.execute(
+        "DELETE FROM anomalies WHERE tipo = 'atipico' AND user_id IN (SELECT value FROM json_each(?))",
+        (json.dumps([r[0] for r in results]),),
+    )
+    cur.execute(
+        f"""
+        INSERT OR IGNORE INTO anomalies (user_id, {', '.join(FIELDS)})
+        SELECT json_extract(value, '$.user_id'), {', '.join(f"json_extract(value, '$.{f}')" for f in FIELDS)}
+        FROM json_each(?)
+        """,
+        (json.dumps([{**row, "user_id": uid} for uid, _, _, rows in results for row in rows]),),
+    )
+    cur.execute(
+        """
+        INSERT INTO anomaly_scans (user_id, data_version, last_id, mes)
+        SELECT json_extract(value, '$[0]'), json_extract(value, '$[1]'), json_extract(value, '$[2]'), ?
+        FROM json_each(?) WHERE true
+        ON CONFLICT(user_id) DO UPDATE SET
+          data_version = excluded.data_version, last_id = MAX(last_id, excluded.last_id), mes = excluded.mes,
+          seq = seq + 1
+        """,
+        (ledger.month_label(_month_key(today)), json.dumps([r[:3] for r in results])),
+    )
+
+
+def read(conn, user_id, since):
+    """Estado da última passagem com as anomalias desde `since` (date), ou None se nunca correu.
+
+    Uma query; só lê (serve em ligações mode=ro).
+    """
+    rows = conn.execute(
+        f"""
+        SELECT s.data_version, s.last_id, s.mes AS scan_mes, {', '.join(f'a.{f}' for f in FIELDS)}
+        FROM anomaly_scans s
+        LEFT JOIN anomalies a ON a.user_id = s.user_id AND a.dia >= ?
+        WHERE s.user_id = ?
+        ORDER BY a.dia DESC, a.transaction_id DESC
+        """,
+        (since.isoformat(), user_id),
+    ).fetchall()
+    if not rows:
+        return None
+    first = rows[0]
+    return {
+        "data_version": first[0],
+        "last_id": first[1],
+        "mes": first[2],
+        "items": [dict(zip(FIELDS, tuple(r)[3:])) for r in rows if r[3] is not None],
+    }
+
+
+def is_stale(state, version, today):
+    return state is None or state["data_version"] != version or state["mes"] != ledger.month_label(_month_key(today))
+
+
+
+class ScanQueue:
+    """Utilizadores com escritas por analisar, tratados por uma thread do worker.
+
+    `run(user_ids)` faz as passagens; pedidos repetidos antes de a thread
+    acordar juntam-se num só. A thread arranca no primeiro pedido de cada
+    processo (os workers do gunicorn fazem fork depois do import).
+    """
+
+    def __init__(self, run):
+        self.run = run
+        self._pending = set()
+        self._cond = threading.Condition()
+        self._pid = None
+
+    def request(self, user_id):
+        with self._cond:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._pending = set()
+                threading.Thread(target=self._loop, name="anomalies", daemon=True).start()
+            self._pending.add(user_id)
+            self._cond.notify()
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                users, self._pending = sorted(self._pending), set()
+            try:
+                self.run(users)
+            except Exception:
+                logging.exception("Anomalias: falha na passagem de %s", users)
@@ -1,29 +1,154 @@
 
+import itertools
+import json
 import os
+import re
+import shutil
+import threading
+import time
+
+# marca o início do arranque (inclui o import do Flask) para medir o boot de cada worker
+_BOOT_T0 = time.perf_counter()
+
 import sqlite3
-from datetime import datetime, date
-from flask import Flask, request, redirect, url_for,make_response, Response, render_template, flash, session, send_file
+from datetime import datetime, date, timedelta
+from pathlib import Path
+from flask import Flask, request, redirect, url_for,make_response, Response, render_template, flash, session, send_file, g, has_request_context, jsonify
 from werkzeug.security import generate_password_hash, check_password_hash
-import pdfkit
 import logging
 
+import click
+from flask.cli import AppGroup
+
+import anomalies
+import backup
+import budgets
+import fx
+import installments
+import ledger
+import live
+import money
+import readpool
+import statements
+import suggest
+import maintenance
+from jobs import PeriodicJob, file_lock
+from template_cache import FragmentCacheExtension
+
+# Módulos pesados/opcionais (pdfkit, csv, plotly) são importados só dentro das
+# rotas que os usam, para não pesarem no arranque de cada worker.
+
 APP_SECRET = os.getenv("APP_SECRET", "super-secret")
-DB_PATH = os.path.join("db", "gerir_contas.db")
+DB_PATH = os.getenv("FINTRACK_DB", os.path.join("db", "gerir_contas.db"))
 
 app = Flask(__name__)
 app.secret_key = APP_SECRET
+app.config["DB_PATH"] = DB_PATH
+app.config["QUERY_BUDGET"] = int(os.getenv("FINTRACK_QUERY_BUDGET", "12"))
+app.config["JINJA_CACHE_DIR"] = os.getenv("FINTRACK_JINJA_CACHE", os.path.join("cache", "jinja"))
+app.config["BACKUP_DIR"] = os.getenv("FINTRACK_BACKUP_DIR", "backups")
+app.config["BACKUP_INTERVAL"] = int(os.getenv("FINTRACK_BACKUP_INTERVAL", "0"))  # segundos; 0 = desligado
+app.config["BACKUP_KEEP"] = int(os.getenv("FINTRACK_BACKUP_KEEP", "7"))
+app.config["BACKUP_COMPRESS"] = os.getenv("FINTRACK_BACKUP_COMPRESS", "1") == "1"
+app.config["MAINTENANCE_INTERVAL"] = int(os.getenv("FINTRACK_MAINTENANCE_INTERVAL", str(6 * 3600)))  # 0 = desligado
+# prestações vencidas -> 'atrasada' e resumo das dívidas, para todos os utilizadores
+app.config["DEBTS_INTERVAL"] = int(os.getenv("FINTRACK_DEBTS_INTERVAL", "3600"))  # 0 = desligado
+# repetidos/atípicos de quem teve escritas e não abriu o dashboard (e a viragem do mês)
+app.config["ANOMALIES_INTERVAL"] = int(os.getenv("FINTRACK_ANOMALIES_INTERVAL", "3600"))  # 0 = desligado
+app.config["MAINTENANCE_IDLE_SECONDS"] = int(os.getenv("FINTRACK_MAINTENANCE_IDLE", "30"))
+app.config["LEDGER_MAX_BYTES"] = int(os.getenv("FINTRACK_LEDGER_MB", "64")) * 1024 * 1024
+# wkhtmltopdf (PDF do relatório); no Windows fica em Program Files
+app.config["WKHTMLTOPDF"] = (
+    os.getenv("FINTRACK_WKHTMLTOPDF")
+    or shutil.which("wkhtmltopdf")
+    or r"C:\Program Files\wkhtmltopdf\bin\wkhtmltopdf.exe"
+)
+app.config["STATEMENTS_DIR"] = os.getenv("FINTRACK_STATEMENTS_DIR", "statements")
+# ligações só de leitura para as leituras em paralelo de dashboard/relatório; 0 = em série
+app.config["READ_POOL_SIZE"] = int(os.getenv("FINTRACK_READ_POOL", "4"))
+app.config["BULK_MAX_ITEMS"] = int(os.getenv("FINTRACK_BULK_MAX_ITEMS", "1000"))  # por pedido em /api/transactions/bulk
+app.config["SUGGEST_MAX_BYTES"] = int(os.getenv("FINTRACK_SUGGEST_MB", "8")) * 1024 * 1024
+# HTML dos {% cache %} por worker (ver template_cache.py)
+app.config["FRAGMENT_CACHE_MAX_BYTES"] = int(os.getenv("FINTRACK_FRAGMENT_MB", "16")) * 1024 * 1024
+app.config["VACUUM_PAGES_PER_STEP"] = int(os.getenv("FINTRACK_VACUUM_PAGES", "256"))
+# moeda em que dashboard, relatório e KPIs são mostrados; contas noutras moedas são convertidas
+app.config["REPORT_CURRENCY"] = os.getenv("FINTRACK_CURRENCY", fx.BASE_CURRENCY)
+app.config["FX_RATES_FILE"] = os.getenv("FINTRACK_FX_FILE", os.path.join("db", "fx_rates.csv"))
+app.config["FX_RELOAD_SECONDS"] = int(os.getenv("FINTRACK_FX_RELOAD", "300"))
+# de quanto em quanto tempo o dashboard aberto pergunta se os dados mudaram (ver live.py)
+app.config["LIVE_POLL_SECONDS"] = float(os.getenv("FINTRACK_LIVE_POLL", "5"))
+app.jinja_options = {**app.jinja_options, "extensions": [FragmentCacheExtension]}
 
 # ---------------------- Helpers DB ----------------------
 
 def get_conn():
-    os.makedirs("db", exist_ok=True)
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(app.config["DB_PATH"])
+    conn.row_factory = sqlite3.Row
+    trace = app.config.get("SQL_TRACE")
+    if trace is not None:
+        # checkplans.py: recolhe as queries executadas para ver os planos
+        conn.set_trace_callback(trace)
+    elif app.debug and has_request_context():
+        conn.set_trace_callback(_count_query)
+    return conn
+
+
+def get_ro_conn():
+    """Ligação só de leitura (mode=ro) para o readpool; pode ser usada noutra thread."""
+    uri = Path(app.config["DB_PATH"]).absolute().as_uri() + "?mode=ro"
+    conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
     conn.row_factory = sqlite3.Row
     return conn
 
 
+def _count_query(sql):
+    # só em debug: conta as queries do pedido actual (ver check_query_budget)
+    if sql.startswith(("BEGIN", "COMMIT", "ROLLBACK")):
+        return
+    g.query_count = g.get("query_count", 0) + 1
+
+
+def _schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
 def init_db():
+    """Aplica as migrações em falta uma única vez (protegido por file lock).
+
+    A versão do schema fica em PRAGMA user_version; workers que arrancam
+    depois de outro já ter migrado saem logo sem escrever nada.
+    """
+    db_path = app.config["DB_PATH"]
+    os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+
     conn = get_conn()
+    try:
+        if _schema_version(conn) >= len(MIGRATIONS):
+            return
+    finally:
+        conn.close()
+
+    with file_lock(db_path + ".lock"):
+        conn = get_conn()
+        try:
+            # outro worker pode ter migrado enquanto esperávamos pelo lock
+            version = _schema_version(conn)
+            if version == 0 and not conn.execute("SELECT 1 FROM sqlite_master").fetchone():
+                # BD nova: o modo só se escolhe sem VACUUM antes da primeira tabela (ver v4)
+                conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            for n, step in enumerate(MIGRATIONS[version:], start=version + 1):
+                step(conn)
+                conn.execute(f"PRAGMA user_version={n}")
+                conn.commit()
+                logging.info("Schema migrado para a versão %s", n)
+        finally:
+            conn.close()
+    # migrações podem reescrever valores (ex.: v8, cêntimos): nada do que estava em memória serve
+    LEDGER.invalidate()
+
+
+def _migrate_v1(conn):
+    """Schema base + seed do admin e das 2 contas fixas."""
     cur = conn.cursor()
 
     # users
@@ -121,7 +246,271 @@ def init_db():
         except sqlite3.IntegrityError:
             pass
 
-    conn.close()
+
+def _migrate_v2(conn):
+    """Versão dos dados por utilizador (chave da cache de fragmentos)."""
+    conn.execute("ALTER TABLE users ADD COLUMN data_version INTEGER NOT NULL DEFAULT 0")
+
+
+def _migrate_v3(conn):
+    """WAL (leitores não bloqueiam writers, nem durante backups) + métricas de backup."""
+    conn.commit()
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS backup_runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            started_at TEXT NOT NULL,
+            kind TEXT NOT NULL,          -- 'full' | 'user'
+            snapshot_user INTEGER,       -- preenchido nos snapshots por utilizador
+            path TEXT,
+            bytes INTEGER,
+            duration_s REAL,
+            mb_per_s REAL,
+            status TEXT
+        );
+        """
+    )
+
+
+def _migrate_v4(conn):
+    """auto_vacuum=INCREMENTAL. BDs novas já o têm (init_db, antes da v1); numa BD
+    existente só tem efeito depois de um VACUUM, que reescreve o ficheiro todo e
+    bloqueia as escritas: não corre aqui (no arranque, com o lock do init), fica
+    para `flask vacuum`."""
+    conn.commit()
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    if maintenance.vacuum_pending(conn):
+        logging.warning("auto_vacuum=INCREMENTAL fica pendente de um VACUUM: corre `flask vacuum`.")
+    conn.execute("ANALYZE")
+
+
+def _migrate_v5(conn):
+    """Moeda por conta (as existentes ficam em MZN) + taxas de câmbio diárias."""
+    conn.execute(f"ALTER TABLE accounts ADD COLUMN moeda TEXT NOT NULL DEFAULT '{fx.BASE_CURRENCY}'")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS fx_rates (
+            dia TEXT NOT NULL,           -- 'YYYY-MM-DD'
+            moeda TEXT NOT NULL,         -- ex.: 'USD'
+            taxa REAL NOT NULL,          -- valor de 1 unidade da moeda em MZN
+            PRIMARY KEY (moeda, dia)
+        ) WITHOUT ROWID;
+        """
+    )
+
+
+def _migrate_v6(conn):
+    """Orçamentos mensais por categoria + gasto do mês mantido pelas escritas."""
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS budgets (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            categoria TEXT NOT NULL,     -- minúsculas (budgets.category_key)
+            limite REAL NOT NULL,        -- por mês, na moeda base
+            alerta_pct REAL NOT NULL DEFAULT 80,
+            UNIQUE(user_id, categoria),
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        );
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS budget_spend (
+            user_id INTEGER NOT NULL,
+            mes TEXT NOT NULL,           -- 'YYYY-MM'
+            categoria TEXT NOT NULL,
+            gasto REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, mes, categoria)
+        ) WITHOUT ROWID;
+        """
+    )
+    rates = fx.FxRates([tuple(r) for r in conn.execute("SELECT dia, moeda, taxa FROM fx_rates")])
+    budgets.rebuild(conn, rates, fx.BASE_CURRENCY)
+
+
+def _migrate_v7(conn):
+    """Índices de transactions para as listas/export/relatório e o recalc de saldos (ver checkplans.py)."""
+    # a mesma expressão que os filtros e o ORDER BY usam: date(t.data)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_transactions_user_dia ON transactions(user_id, date(data))")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_transactions_account ON transactions(account_id)")
+    # (user_id, id): carga/atualização incremental do ledger e das sugestões
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_transactions_user_id ON transactions(user_id, id)")
+    conn.execute("ANALYZE")
+
+
+# colunas de dinheiro: REAL -> INTEGER em cêntimos (money.py)
+MONEY_COLUMNS = {
+    "accounts": ("saldo",),
+    "transactions": ("valor",),
+    "debts": ("valor_total", "valor_pago"),
+    "budgets": ("limite",),
+    "budget_spend": ("gasto",),
+}
+
+
+def _retype_money(conn, table, columns):
+    """Reconstrói `table` com `columns` INTEGER (cêntimos): o SQLite não muda tipos com ALTER."""
+    sql = conn.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name=?", (table,)).fetchone()[0]
+    indexes = [r[0] for r in conn.execute(
+        "SELECT sql FROM sqlite_master WHERE type='index' AND tbl_name=? AND sql IS NOT NULL", (table,)
+    )]
+    seq = conn.execute("SELECT seq FROM sqlite_sequence WHERE name=?", (table,)).fetchone()
+
+    new_sql = re.sub(rf"^CREATE TABLE\s+{table}\b", f"CREATE TABLE {table}_new", sql.strip())
+    for col in columns:
+        new_sql, n = re.subn(rf"\b{col}\s+REAL\b", f"{col} INTEGER", new_sql)
+        assert n == 1, (table, col)
+    cols = [r[1] for r in conn.execute(f"PRAGMA table_info({table})")]
+    select = ", ".join(f"CAST(ROUND({c} * {money.SCALE}) AS INTEGER)" if c in columns else c for c in cols)
+
+    conn.execute(new_sql)
+    conn.execute(f"INSERT INTO {table}_new ({', '.join(cols)}) SELECT {select} FROM {table}")
+    conn.execute(f"DROP TABLE {table}")
+    conn.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+    for index_sql in indexes:
+        conn.execute(index_sql)
+    if seq is not None:
+        # tabela vazia não recria a linha; ids apagados não devem voltar a ser usados
+        conn.execute("DELETE FROM sqlite_sequence WHERE name=?", (table,))
+        conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", (table, seq[0]))
+
+
+def _migrate_v8(conn):
+    """Dinheiro em cêntimos inteiros: somas exatas e linhas mais pequenas."""
+    for table, columns in MONEY_COLUMNS.items():
+        _retype_money(conn, table, columns)
+    conn.execute("ANALYZE")
+
+
+def _migrate_v9(conn):
+    """Prestações das dívidas + estado pré-calculado (em atraso, próximos pagamentos)."""
+    conn.execute("ALTER TABLE debts ADD COLUMN parcelas INTEGER NOT NULL DEFAULT 1")
+    conn.execute("ALTER TABLE debts ADD COLUMN atrasado INTEGER NOT NULL DEFAULT 0")  # cêntimos
+    conn.execute("ALTER TABLE debts ADD COLUMN proximo_vencimento TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_debts_user_status_due ON debts(user_id, status, due_date)")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS debt_installments (
+            debt_id INTEGER NOT NULL,
+            n INTEGER NOT NULL,          -- 1..parcelas
+            user_id INTEGER NOT NULL,
+            due_date TEXT NOT NULL,      -- 'YYYY-MM-DD'
+            valor INTEGER NOT NULL,      -- cêntimos
+            pago INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL DEFAULT 'pendente',  -- pendente | atrasada | paga
+            PRIMARY KEY (debt_id, n),
+            FOREIGN KEY(debt_id) REFERENCES debts(id)
+        ) WITHOUT ROWID;
+        """
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_installments_user_status_due ON debt_installments(user_id, status, due_date)"
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS debt_summary (
+            user_id INTEGER PRIMARY KEY,
+            aberto INTEGER NOT NULL,
+            atrasado INTEGER NOT NULL,
+            proximo_valor INTEGER NOT NULL,  -- a pagar nos próximos installments.UPCOMING_DAYS dias
+            proxima_data TEXT,
+            dividas INTEGER NOT NULL,
+            dia TEXT NOT NULL                -- dia do cálculo
+        );
+        """
+    )
+    # dívidas existentes: uma prestação na data limite, com o que já foi pago
+    cur = conn.cursor()
+    for r in conn.execute("SELECT id, user_id, valor_total, valor_pago, due_date FROM debts").fetchall():
+        installments.create(cur, r[1], r[0], r[2], 1, r[4], pago=r[3] or 0)
+    installments.refresh(cur)
+    conn.execute("ANALYZE")
+
+
+def _migrate_v10(conn):
+    """Chave de idempotência dos movimentos criados pela API em lote."""
+    conn.execute("ALTER TABLE transactions ADD COLUMN chave TEXT")
+    # parcial: os movimentos criados pelos formulários não têm chave
+    conn.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_transactions_chave ON transactions(user_id, chave) WHERE chave IS NOT NULL"
+    )
+
+
+def _migrate_v11(conn):
+    """Movimentos repetidos e gastos atípicos (ver anomalies.py)."""
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS anomalies (
+            user_id INTEGER NOT NULL,
+            tipo TEXT NOT NULL,          -- duplicado | atipico
+            transaction_id INTEGER,      -- duplicado: o movimento repetido
+            ref_id INTEGER,              -- duplicado: o movimento igual anterior
+            account_id INTEGER,
+            descricao TEXT,
+            categoria TEXT,
+            mes TEXT NOT NULL,           -- 'YYYY-MM'
+            dia TEXT NOT NULL,           -- do movimento; atipico: 1º dia do mês
+            valor INTEGER NOT NULL,      -- cêntimos (duplicado: moeda da conta; atipico: moeda de relatório)
+            media INTEGER,               -- atipico: média dos 12 meses anteriores
+            z REAL,
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        );
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_anomalies_user_dia ON anomalies(user_id, dia)")
+    # cada movimento é repetido de outro no máximo uma vez
+    conn.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_anomalies_duplicado ON anomalies(user_id, transaction_id) "
+        "WHERE tipo = 'duplicado'"
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS anomaly_scans (
+            user_id INTEGER PRIMARY KEY,
+            data_version INTEGER NOT NULL,
+            last_id INTEGER NOT NULL,    -- maior id de movimento já analisado
+            mes TEXT NOT NULL            -- mês da passagem ('YYYY-MM')
+        );
+        """
+    )
+
+
+def _migrate_v12(conn):
+    """Assinatura do último CSV de taxas importado: o arranque só reimporta se mudou."""
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS fx_imports (
+            path TEXT PRIMARY KEY,
+            assinatura TEXT NOT NULL,    -- fx.file_signature
+            importado_em TEXT NOT NULL
+        ) WITHOUT ROWID;
+        """
+    )
+
+
+def _migrate_v13(conn):
+    """Contador de passagens das anomalias: entra no token do readpool (ver READS_TOKEN_SQL)."""
+    conn.execute("ALTER TABLE anomaly_scans ADD COLUMN seq INTEGER NOT NULL DEFAULT 0")
+
+
+# cada entrada corresponde a uma versão do schema (índice + 1)
+MIGRATIONS = [
+    _migrate_v1,
+    _migrate_v2,
+    _migrate_v3,
+    _migrate_v4,
+    _migrate_v5,
+    _migrate_v6,
+    _migrate_v7,
+    _migrate_v8,
+    _migrate_v9,
+    _migrate_v10,
+    _migrate_v11,
+    _migrate_v12,
+    _migrate_v13,
+]
 
 
 # ---------------------- Auth ----------------------
@@ -164,7 +553,43 @@ def require_login(func):
     return wrapper
 
 
-def user_accounts(user_id):
+def require_admin(func):
+    from functools import wraps
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if "user_id" not in session:
+            return redirect(url_for("login"))
+        user = user_row(session["user_id"])
+        if not user or user["role"] != "admin":
+            flash("Acesso reservado a administradores.", "danger")
+            return redirect(url_for("dashboard"))
+        return func(*args, **kwargs)
+
+    return wrapper
+
+
+def request_memo(key, loader):
+    """Memoiza `loader()` durante o pedido actual (views e templates partilham o resultado)."""
+    if not has_request_context():
+        return loader()
+    memo = g.setdefault("memo", {})
+    if key not in memo:
+        memo[key] = loader()
+    return memo[key]
+
+
+def forget_memo(user_id):
+    # depois de uma escrita os valores memoizados do utilizador ficam inválidos
+    if has_request_context():
+        memo = g.get("memo", {})
+        for key in [k for k in memo if k[1] == user_id]:
+            del memo[key]
+
+
+def _load_user_accounts(user_id, conn=None):
+    if conn is not None:
+        return conn.execute("SELECT * FROM accounts WHERE user_id=? ORDER BY tipo", (user_id,)).fetchall()
     conn = get_conn()
     cur = conn.cursor()
     cur.execute("SELECT * FROM accounts WHERE user_id=? ORDER BY tipo", (user_id,))
@@ -173,147 +598,332 @@ def user_accounts(user_id):
     return rows
 
 
-def recalc_balances(user_id):
-    """Recalcula saldos a partir das transações."""
+def user_accounts(user_id):
+    return request_memo(("accounts", user_id), lambda: _load_user_accounts(user_id))
+
+
+USER_SQL = "SELECT id, nome, email, role, status, data_version FROM users WHERE id=?"
+
+# token das leituras em paralelo: a linha do utilizador mais o que muda sem
+# mexer na data_version (debt_summary da tarefa periódica, passagens das anomalias)
+READS_TOKEN_SQL = """
+SELECT u.id, u.nome, u.email, u.role, u.status, u.data_version,
+       s.aberto, s.atrasado, s.proximo_valor, s.proxima_data, s.dividas, s.dia, a.seq
+FROM users u
+LEFT JOIN debt_summary s ON s.user_id = u.id
+LEFT JOIN anomaly_scans a ON a.user_id = u.id
+WHERE u.id = ?
+"""
+
+
+def _load_user(user_id, conn=None):
+    if conn is not None:
+        return conn.execute(USER_SQL, (user_id,)).fetchone()
     conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT id FROM accounts WHERE user_id=?", (user_id,))
-    accs = [r["id"] for r in cur.fetchall()]
-    for acc_id in accs:
-        cur.execute(
-            "SELECT COALESCE(SUM(CASE WHEN tipo='income' THEN valor ELSE -valor END),0) FROM transactions WHERE user_id=? AND account_id=?",
-            (user_id, acc_id),
-        )
-        saldo = cur.fetchone()[0] or 0
-        cur.execute("UPDATE accounts SET saldo=? WHERE id=?", (saldo, acc_id))
-    conn.commit()
+    row = conn.execute(USER_SQL, (user_id,)).fetchone()
     conn.close()
+    return row
 
 
-# ---------------------- Dashboard ----------------------
-@app.route("/")
-@app.route("/dashboard")
-@require_login
-def dashboard():
-    user_id = session["user_id"]
-    contas = user_accounts(user_id)
+def user_row(user_id):
+    return request_memo(("user", user_id), lambda: _load_user(user_id))
 
-    conn = get_conn()
-    cur = conn.cursor()
 
-    hoje = date.today()
-    first_month = hoje.replace(day=1)
+def user_data_version(user_id):
+    """Contador que muda sempre que os dados do utilizador mudam."""
+    row = user_row(user_id)
+    return row["data_version"] if row else 0
 
-    # === KPIs mensais (EXCLUINDO transferências internas) ===
-    cur.execute(
-        """
-        SELECT
-          COALESCE(SUM(CASE WHEN tipo='income'  THEN valor END),0) as total_in,
-          COALESCE(SUM(CASE WHEN tipo='expense' THEN valor END),0) as total_out
-        FROM transactions
-        WHERE user_id=?
-          AND date(data) >= date(?)
-          AND (categoria IS NULL OR LOWER(categoria) <> 'transfer')
-        """,
-        (user_id, first_month.isoformat()),
+
+LEDGER = READS = FX = SUGGEST = None
+
+
+def build_caches():
+    """(Re)cria as caches em memória a partir da config atual da app.
+
+    Corre no import (para quem usa o módulo sem factory) e outra vez no
+    create_app, depois de aplicada a config que lhe foi passada.
+    """
+    global LEDGER, READS, FX, SUGGEST
+    if READS is not None:
+        READS.close()
+    LEDGER = ledger.LedgerCache(get_conn, max_bytes=app.config["LEDGER_MAX_BYTES"])
+    READS = readpool.ReadPool(get_ro_conn, size=app.config["READ_POOL_SIZE"])
+    FX = fx.FxCache(get_conn, ttl=app.config["FX_RELOAD_SECONDS"])
+    SUGGEST = suggest.SuggestCache(get_conn, max_bytes=app.config["SUGGEST_MAX_BYTES"])
+
+
+build_caches()
+
+
+def to_report(value, moeda, day=None):
+    """Converte `value` (em `moeda`) para a moeda de relatório, à taxa do dia (hoje por omissão)."""
+    return FX.current().convert(value, moeda, app.config["REPORT_CURRENCY"], day)
+
+
+def ledger_conversion(user_id, contas=None):
+    """(chave, fatores) para o ledger somar na moeda de relatório; None se não há nada a converter."""
+    target = app.config["REPORT_CURRENCY"]
+    currencies = {c["id"]: c["moeda"] for c in (user_accounts(user_id) if contas is None else contas)}
+    if all(m == target for m in currencies.values()):
+        return None
+    rates = FX.current()
+    key = (rates.version, target, tuple(sorted(currencies.items())))
+    return key, lambda accounts, days: rates.factors(accounts, days, currencies, target)
+
+
+def user_ledger(user_id):
+    """Movimentos do utilizador em colunas (ver ledger.py), em dia com a data_version."""
+    return LEDGER.get(user_id, user_data_version(user_id), ledger_conversion(user_id))
+
+
+def gather_user_reads(user_id, **extra):
+    """Leituras de base de uma view em paralelo (readpool): utilizador, contas,
+    ledger e resumo das dívidas, mais as tarefas `extra` = {nome: fn(conn)}.
+
+    Utilizador e contas ficam memoizados no pedido, o ledger fica em dia (o
+    user_ledger seguinte não vai à BD). Os tempos vão no header Server-Timing.
+    """
+    # o token de cada tarefa é a linha do utilizador (com a data_version) + READS_TOKEN_SQL
+    tasks = {
+        "accounts": lambda conn, user: _load_user_accounts(user_id, conn),
+        "ledger": lambda conn, user: LEDGER.prefetch(user_id, user["data_version"] if user else 0, conn),
+        "debts": lambda conn, user: installments.read_summary(conn, user_id),
+    }
+    for name, fn in extra.items():
+        tasks[name] = lambda conn, user, fn=fn: fn(conn)
+
+    sql_trace = app.config.get("SQL_TRACE")
+    counted = []
+
+    def trace(sql):
+        # corre nas threads do pool: sem `g`; conta-se aqui e soma-se no fim
+        if sql_trace is not None:
+            sql_trace(sql)
+        elif not sql.startswith(("BEGIN", "COMMIT", "ROLLBACK")):
+            counted.append(sql)
+
+    results, token, timings = READS.gather(
+        tasks, READS_TOKEN_SQL, (user_id,), trace=trace if sql_trace is not None or app.debug else None
     )
-    agg = cur.fetchone()
-    total_in = float(agg["total_in"] or 0)
-    total_out = float(agg["total_out"] or 0)
+    if app.debug:
+        g.query_count = g.get("query_count", 0) + len(counted)
+    g.setdefault("server_timing", []).extend(timings.items())
+    memo = g.setdefault("memo", {})
+    memo[("user", user_id)] = token
+    memo[("accounts", user_id)] = results["accounts"]
+    return results
+
+
+def current_debts(state):
+    """Resumo das dívidas lido pelo readpool. Só se usa `aberto`, que não depende
+    do dia: um resumo de ontem (a tarefa periódica ainda não passou) serve."""
+    return state or installments.EMPTY
+
+
+def current_anomalies(user_id, state):
+    """Repetidos e atípicos gravados pela última passagem (`state` de anomalies.read), com a moeda de cada valor."""
+    items = state["items"] if state else []
+    moedas = {c["id"]: c["moeda"] for c in user_accounts(user_id)}
+    for a in items:
+        a["moeda"] = moedas.get(a["account_id"], app.config["REPORT_CURRENCY"])
+    return items
+
+
+def month_kpis(led, hoje):
+    """KPIs do mês corrente (sem transferências internas)."""
+    total_in, total_out = led.totals(since=hoje.replace(day=1))
     net_month = total_in - total_out
-    savings_rate = (net_month / total_in * 100.0) if total_in > 0 else 0.0
+    return {
+        "total_in": total_in,
+        "total_out": total_out,
+        "net_month": net_month,
+        "savings_rate": (net_month / total_in * 100.0) if total_in > 0 else 0.0,
+        # média diária de gastos no mês
+        "avg_daily_spend": total_out / max(hoje.day, 1),
+    }
 
-    # Média diária de gastos no mês
-    dias_passados = hoje.day
-    avg_daily_spend = (total_out / max(dias_passados, 1))
 
-    # Dívidas em aberto
-    cur.execute(
-        "SELECT COALESCE(SUM(valor_total - valor_pago),0) AS aberto FROM debts WHERE user_id=? AND status='pendente'",
-        (user_id,),
+def chart_units(cents):
+    """Cêntimos -> unidades arredondadas, para gráficos e JSON (lista ou valor)."""
+    if isinstance(cents, (list, tuple)):
+        return [chart_units(c) for c in cents]
+    return round(money.units(cents), 2)
+
+
+def last_months(hoje, n=12):
+    """['YYYY-MM', ...] dos últimos `n` meses, a terminar no mês atual (sem buracos)."""
+    total_curr = hoje.year * 12 + (hoje.month - 1)  # mês 0-indexado
+    return [ledger.month_label(k) for k in range(total_curr - n + 1, total_curr + 1)]
+
+
+def live_snapshot(user_id, version):
+    """O que o dashboard mostra, arredondado, para o broker SSE calcular deltas."""
+    led = LEDGER.get(user_id, version, ledger_conversion(user_id))
+    hoje = date.today()
+    conn = get_conn()
+    contas = conn.execute("SELECT id, saldo, moeda FROM accounts WHERE user_id=?", (user_id,)).fetchall()
+    divida = current_debts(installments.read_summary(conn, user_id))["aberto"]
+    conn.close()
+
+    months = last_months(hoje)
+    kpis = month_kpis(led, hoje)
+    return {
+        "kpis": {k: round(v, 2) if k == "savings_rate" else chart_units(v) for k, v in kpis.items()},
+        "divida_aberta": chart_units(to_report(divida or 0, fx.BASE_CURRENCY)),
+        "balances": {str(c["id"]): chart_units(to_report(c["saldo"] or 0, c["moeda"])) for c in contas},
+        "categories": {
+            (cat if cat is not None else "(sem categoria)"): chart_units(total)
+            for cat, total in led.by_category(since=hoje.replace(day=1))
+        },
+        "days": {
+            d.isoformat(): [chart_units(i), chart_units(o)]
+            for d, i, o in led.by_day(since=hoje - timedelta(days=29))
+        },
+        "months": {
+            ym: [chart_units(i), chart_units(o)]
+            for ym, (i, o) in led.by_month(since=date.fromisoformat(months[0] + "-01")).items()
+        },
+    }
+
+
+LIVE = live.SnapshotCache(live_snapshot)
+
+
+def record_spend(cur, user_id, account_id, data_str, tipo, valor, categoria):
+    """Atualiza o gasto do orçamento na mesma transação do INSERT do movimento.
+
+    Devolve o alerta de budgets.add_spend (ou None). Chamar em todas as
+    escritas que inserem saídas.
+    """
+    moeda = next((c["moeda"] for c in user_accounts(user_id) if c["id"] == account_id), fx.BASE_CURRENCY)
+    if moeda != fx.BASE_CURRENCY:
+        valor = FX.current().convert_cents(valor, moeda, fx.BASE_CURRENCY, ledger.day_month(data_str)[0] or None)
+    return budgets.add_spend(cur, user_id, data_str, tipo, valor, categoria)
+
+
+def record_spends(cur, user_id, rows):
+    """record_spend para um lote [(account_id, data_str, tipo, valor, categoria)]; devolve os alertas."""
+    moedas = {c["id"]: c["moeda"] for c in user_accounts(user_id)}
+    base_rows = []
+    for account_id, data_str, tipo, valor, categoria in rows:
+        moeda = moedas.get(account_id, fx.BASE_CURRENCY)
+        if moeda != fx.BASE_CURRENCY:
+            valor = FX.current().convert_cents(valor, moeda, fx.BASE_CURRENCY, ledger.day_month(data_str)[0] or None)
+        base_rows.append((data_str, tipo, valor, categoria))
+    return budgets.add_spend_many(cur, user_id, base_rows)
+
+
+def flash_budget_alert(alert):
+    if not alert:
+        return
+    verb = "ultrapassou o" if alert["status"] == "excedido" else "está perto do"
+    flash(
+        f"Orçamento de '{alert['categoria']}' {verb} limite: "
+        f"{fmt_money(alert['gasto'], fx.BASE_CURRENCY)} de {fmt_money(alert['limite'], fx.BASE_CURRENCY)} em {alert['mes']}.",
+        "warning",
     )
-    divida_aberta = float(cur.fetchone()["aberto"] or 0)
 
-    # Série 30 dias (EXCLUINDO transfer)
+
+def bump_data_version(cur, user_id):
+    # invalida os fragmentos em cache do utilizador (em todos os workers)
+    cur.execute("UPDATE users SET data_version = data_version + 1 WHERE id=?", (user_id,))
+    forget_memo(user_id)
+
+
+def recalc_balances(cur, user_id):
+    """Recalcula saldos a partir das transações, na transação de quem escreveu.
+
+    Quem chama faz o commit (movimentos e saldos ficam visíveis juntos) e
+    depois pede a passagem das anomalias (ANOMALY_SCANS.request).
+    """
+    # um só UPDATE para todas as contas do utilizador
     cur.execute(
         """
-        SELECT strftime('%Y-%m-%d', data) d,
-               SUM(CASE WHEN tipo='income'  THEN valor ELSE 0 END) as inc,
-               SUM(CASE WHEN tipo='expense' THEN valor ELSE 0 END) as exp
-        FROM transactions
+        UPDATE accounts
+        SET saldo = (
+            SELECT COALESCE(SUM(CASE WHEN t.tipo='income' THEN t.valor ELSE -t.valor END),0)
+            FROM transactions t
+            WHERE t.user_id = accounts.user_id AND t.account_id = accounts.id
+        )
         WHERE user_id=?
-          AND date(data) >= date('now','-29 day')
-          AND (categoria IS NULL OR LOWER(categoria) <> 'transfer')
-        GROUP BY d
-        ORDER BY d
         """,
         (user_id,),
     )
-    series = cur.fetchall()
-    labels = [r["d"] for r in series]
-    incs = [float(r["inc"] or 0) for r in series]
-    exps = [float(r["exp"] or 0) for r in series]
+    bump_data_version(cur, user_id)
+
+
+def scan_user_anomalies(user_ids):
+    """Passagem incremental depois de escritas, sobre o ledger em cache (só lê os movimentos novos)."""
+    hoje = date.today()
+    conn = get_conn()
+    results = []
+    for user_id in user_ids:
+        row = conn.execute("SELECT data_version FROM users WHERE id=?", (user_id,)).fetchone()
+        state = anomalies.read(conn, user_id, hoje)
+        if row is None or not anomalies.is_stale(state, row[0], hoje):
+            continue
+        contas = _load_user_accounts(user_id, conn)
+        led = LEDGER.get(user_id, row[0], ledger_conversion(user_id, contas))
+        new, last_id = anomalies.scan(led, state, hoje)
+        results.append((user_id, row[0], last_id, new))
+    if results:
+        anomalies.save(conn.cursor(), results, hoje)
+        conn.commit()
+    conn.close()
+
+
+ANOMALY_SCANS = anomalies.ScanQueue(scan_user_anomalies)
+
+
+# ---------------------- Dashboard ----------------------
+@app.route("/")
+@app.route("/dashboard")
+@require_login
+def dashboard():
+    user_id = session["user_id"]
+    hoje = date.today()
+    first_month = hoje.replace(day=1)
+
+    # utilizador, contas, ledger, dívidas e anomalias em paralelo (ligações só de leitura)
+    since = hoje - timedelta(days=anomalies.SHOW_DAYS)
+    reads = gather_user_reads(user_id, anomalies=lambda conn: anomalies.read(conn, user_id, since))
+    contas = user_accounts(user_id)
+    led = user_ledger(user_id)
+
+    # === KPIs mensais (EXCLUINDO transferências internas) ===
+    kpis = month_kpis(led, hoje)
+
+    # Dívidas em aberto (pré-calculado em debt_summary; dívidas são registadas na moeda base)
+    divida_aberta = to_report(current_debts(reads["debts"])["aberto"], fx.BASE_CURRENCY)
+
+    # possíveis débitos repetidos e categorias fora do normal
+    alertas = current_anomalies(user_id, reads["anomalies"])
+
+    # Série 30 dias (EXCLUINDO transfer)
+    series = led.by_day(since=hoje - timedelta(days=29))
+    labels = [d.isoformat() for d, _, _ in series]
+    incs = [inc for _, inc, _ in series]
+    exps = [exp for _, _, exp in series]
 
     # Despesas por categoria (mês) – EXCLUINDO transfer
-    cur.execute(
-        """
-        SELECT COALESCE(categoria,'(sem categoria)') as cat, SUM(valor) as total
-        FROM transactions
-        WHERE user_id=?
-          AND tipo='expense'
-          AND date(data) >= date(?)
-          AND (categoria IS NULL OR LOWER(categoria) <> 'transfer')
-        GROUP BY categoria
-        ORDER BY total DESC
-        """,
-        (user_id, first_month.isoformat()),
-    )
-    exp_rows = cur.fetchall()
-    exp_cats = [r["cat"] for r in exp_rows]
-    exp_vals = [float(r["total"] or 0) for r in exp_rows]
-    top_exp_cat = f"{exp_cats[0]} — {exp_vals[0]:.2f} MT" if exp_rows else "—"
+    exp_rows = led.by_category(since=first_month)
+    exp_cats = [cat if cat is not None else "(sem categoria)" for cat, _ in exp_rows]
+    exp_vals = [total for _, total in exp_rows]
+    top_exp_cat = f"{exp_cats[0]} — {fmt_money(exp_vals[0])}" if exp_rows else "—"
 
-    # Saldos por conta (caso ainda queiras usar noutro gráfico)
+    # Saldos por conta (caso ainda queiras usar noutro gráfico), no mesmo eixo: moeda de relatório
     saldo_labels = [f"{c['nome']} ({c['banco']})" for c in contas]
-    saldo_vals = [float(c["saldo"] or 0) for c in contas]
+    saldo_vals = [to_report(c["saldo"] or 0, c["moeda"]) for c in contas]
 
-    # --- Série mensal (últimos 12 meses), EXCLUINDO transfer ---
-    cur.execute(
-        """
-        SELECT strftime('%Y-%m', data) AS ym,
-               SUM(CASE WHEN tipo='income'  THEN valor ELSE 0 END) AS inc,
-               SUM(CASE WHEN tipo='expense' THEN valor ELSE 0 END) AS exp
-        FROM transactions
-        WHERE user_id=?
-          AND date(data) >= date('now','start of month','-11 months')
-          AND (categoria IS NULL OR LOWER(categoria) <> 'transfer')
-        GROUP BY ym
-        ORDER BY ym
-        """,
-        (user_id,),
-    )
-    rows_m = cur.fetchall()
+    # Sequência contínua de 12 meses (terminando no mês atual)
+    months_labels = last_months(hoje)
 
-    # Construir sequência contínua de 12 meses (terminando no mês atual)
-    # Evita buracos quando não houve movimentos num mês
-    total_curr = hoje.year * 12 + (hoje.month - 1)  # mês 0-indexado
-    start_total = total_curr - 11
-    start_year = start_total // 12
-    start_month = start_total % 12 + 1
-
-    months_labels = []
-    y, m = start_year, start_month
-    for _ in range(12):
-        months_labels.append(f"{y:04d}-{m:02d}")
-        m += 1
-        if m == 13:
-            m = 1
-            y += 1
-
-    m_map = {r["ym"]: {"inc": float(r["inc"] or 0), "exp": float(r["exp"] or 0)} for r in rows_m}
-    months_in = [m_map.get(ym, {}).get("inc", 0.0) for ym in months_labels]
-    months_out = [m_map.get(ym, {}).get("exp", 0.0) for ym in months_labels]
-    months_net = [round(i - o, 2) for i, o in zip(months_in, months_out)]
+    # --- Série mensal (últimos 12 meses), EXCLUINDO transfer ---
+    m_map = led.by_month(since=date.fromisoformat(months_labels[0] + "-01"))
+    months_in = [m_map.get(ym, (0, 0))[0] for ym in months_labels]
+    months_out = [m_map.get(ym, (0, 0))[1] for ym in months_labels]
+    months_net = [i - o for i, o in zip(months_in, months_out)]
 
     # Destaques (tops)
     def idx_max(arr):
@@ -327,37 +937,34 @@ def dashboard():
     idx_net = idx_max(months_net)
 
     top_income_month = months_labels[idx_income] if idx_income >= 0 else "-"
-    top_income_value = months_in[idx_income] if idx_income >= 0 else 0.0
+    top_income_value = months_in[idx_income] if idx_income >= 0 else 0
 
     top_expense_month = months_labels[idx_expense] if idx_expense >= 0 else "-"
-    top_expense_value = months_out[idx_expense] if idx_expense >= 0 else 0.0
+    top_expense_value = months_out[idx_expense] if idx_expense >= 0 else 0
 
     top_saving_month = months_labels[idx_net] if idx_net >= 0 else "-"
-    top_saving_value = months_net[idx_net] if idx_net >= 0 else 0.0
-
-    conn.close()
+    top_saving_value = months_net[idx_net] if idx_net >= 0 else 0
 
     return render_template(
         "dashboard.html",
+        data_version=user_data_version(user_id),
         contas=contas,
-        total_in=total_in,
-        total_out=total_out,
         divida_aberta=divida_aberta,
+        alertas=alertas,
         labels=labels,
-        incs=incs,
-        exps=exps,
-        net_month=net_month,
-        savings_rate=savings_rate,
-        avg_daily_spend=avg_daily_spend,
+        # gráficos em unidades; o resto em cêntimos (filtro money)
+        incs=chart_units(incs),
+        exps=chart_units(exps),
+        **kpis,
         top_exp_cat=top_exp_cat,
         saldo_labels=saldo_labels,
-        saldo_vals=saldo_vals,
+        saldo_vals=chart_units(saldo_vals),
         exp_cats=exp_cats,
-        exp_vals=exp_vals,
+        exp_vals=chart_units(exp_vals),
         months_labels=months_labels,
-        months_in=months_in,
-        months_out=months_out,
-        months_net=months_net,
+        months_in=chart_units(months_in),
+        months_out=chart_units(months_out),
+        months_net=chart_units(months_net),
         top_income_month=top_income_month,
         top_income_value=top_income_value,
         top_expense_month=top_expense_month,
@@ -369,6 +976,22 @@ def dashboard():
 
 
 
+@app.route("/dashboard/live")
+@require_login
+def dashboard_live():
+    """?v=<data_version da página>: 204 se nada mudou; senão o delta (ou o snapshot completo) em JSON.
+
+    Polling curto em vez de uma ligação aberta: um cliente parado não ocupa
+    nenhuma thread do worker entre pedidos.
+    """
+    user_id = session["user_id"]
+    since = request.args.get("v", type=int)
+    version = user_data_version(user_id)
+    if since == version:
+        return Response(status=204)
+    return jsonify(LIVE.changes(user_id, since, version))
+
+
 # ---------------------- Transações (LISTA + FILTROS + CARDS) ----------------------
 @app.route("/transactions", methods=["GET"])
 @require_login
@@ -413,7 +1036,7 @@ def transactions():
     cur.execute(
         f"""
         SELECT t.id, t.data, t.tipo, t.valor, t.descricao, t.categoria,
-               a.nome as conta, a.tipo as tipo_conta
+               a.nome as conta, a.tipo as tipo_conta, a.moeda
         FROM transactions t
         JOIN accounts a ON a.id = t.account_id
         WHERE {where_sql}
@@ -425,63 +1048,64 @@ def transactions():
     rows = cur.fetchall()
 
     # --------- KPIs do período (exclui transfer) ----------
+    # com várias moedas: somas por (moeda, dia) e conversão em memória, sem JOIN às taxas
+    multi = ledger_conversion(user_id) is not None
+    group_cols, group_sql = ("a.moeda, date(t.data) AS dia,", "GROUP BY a.moeda, dia") if multi else ("", "")
     cur.execute(
         f"""
-        SELECT
+        SELECT {group_cols}
           COALESCE(SUM(CASE WHEN t.tipo='income'  THEN t.valor END),0) as total_in,
           COALESCE(SUM(CASE WHEN t.tipo='expense' THEN t.valor END),0) as total_out
         FROM transactions t
+        JOIN accounts a ON a.id = t.account_id
         WHERE {where_sql}
           AND (t.categoria IS NULL OR LOWER(t.categoria) <> 'transfer')
+        {group_sql}
         """,
         params,
     )
-    kpi = cur.fetchone()
-    kpi_in = float(kpi["total_in"] or 0)
-    kpi_out = float(kpi["total_out"] or 0)
+    kpi_in = kpi_out = 0
+    for kpi in cur.fetchall():
+        if not multi:
+            kpi_in, kpi_out = kpi["total_in"], kpi["total_out"]
+            break
+        day = ledger.day_month(kpi["dia"])[0] or None
+        kpi_in += to_report(kpi["total_in"], kpi["moeda"], day)
+        kpi_out += to_report(kpi["total_out"], kpi["moeda"], day)
 
     # --------- Saldos por conta ----------
     contas = user_accounts(user_id)  # pode retornar sqlite3.Row
     # normaliza para dict para permitir .get()
     contas = [dict(c) if not isinstance(c, dict) else c for c in contas]
 
-    saldo_poupanca = 0.0
-    saldo_despesas = 0.0
+    saldo_poupanca = 0
+    saldo_despesas = 0
+    moeda_poupanca = moeda_despesas = fx.BASE_CURRENCY
     for c in contas:
         nome = (c.get("nome") or "").lower()
         tipo = (c.get("tipo") or "").lower()
-        saldo = float(c.get("saldo") or 0)
+        saldo = c.get("saldo") or 0
         if tipo == "poupanca" or "poup" in nome:
-            saldo_poupanca = saldo
+            saldo_poupanca, moeda_poupanca = saldo, c["moeda"]
         if tipo == "despesas" or "desp" in nome:
-            saldo_despesas = saldo
+            saldo_despesas, moeda_despesas = saldo, c["moeda"]
 
     # --------- Totais gerais do histórico (exclui transfer) ----------
-    cur.execute(
-        """
-        SELECT
-          COALESCE(SUM(CASE WHEN tipo='income'  THEN valor END),0) as total_in_all,
-          COALESCE(SUM(CASE WHEN tipo='expense' THEN valor END),0) as total_out_all
-        FROM transactions
-        WHERE user_id=?
-          AND (categoria IS NULL OR LOWER(categoria) <> 'transfer')
-        """,
-        (user_id,),
-    )
-    tot = cur.fetchone()
-    total_in_all = float(tot["total_in_all"] or 0)
-    total_out_all = float(tot["total_out_all"] or 0)
+    total_in_all, total_out_all = user_ledger(user_id).totals()
 
     conn.close()
 
     return render_template(
         "transactions.html",
+        data_version=user_data_version(user_id),
         rows=rows,
         contas=contas,
         kpi_in=kpi_in,
         kpi_out=kpi_out,
         saldo_poupanca=saldo_poupanca,
         saldo_despesas=saldo_despesas,
+        moeda_poupanca=moeda_poupanca,
+        moeda_despesas=moeda_despesas,
         total_in_all=total_in_all,
         total_out_all=total_out_all,
     )
@@ -500,7 +1124,7 @@ def transactions_new():
             tipo = request.form.get("tipo")  # income / expense
             account_id = int(request.form.get("account_id"))
             data_str = request.form.get("data") or date.today().isoformat()
-            valor = float(request.form.get("valor", 0))
+            valor = money.parse(request.form.get("valor", 0))
             descricao = request.form.get("descricao")
             categoria = request.form.get("categoria")
 
@@ -518,13 +1142,18 @@ def transactions_new():
                 """,
                 (user_id, account_id, data_str, tipo, valor, descricao, categoria),
             )
+            tx_id = cur.lastrowid
+            alert = record_spend(cur, user_id, account_id, data_str, tipo, valor, categoria)
+            # atualizar saldos das contas (mesma transação)
+            recalc_balances(cur, user_id)
             conn.commit()
-
-            # atualizar saldos das contas
-            recalc_balances(user_id)
+            SUGGEST.record(user_id, tx_id, categoria, descricao)
+            # repetidos/atípicos com os movimentos novos, numa thread (o pedido não espera)
+            ANOMALY_SCANS.request(user_id)
 
             # manda mensagem para o próximo GET
             flash("Movimento registado com sucesso ✅", "success")
+            flash_budget_alert(alert)
 
         except Exception as e:
             conn.rollback()
@@ -587,7 +1216,7 @@ def transactions_export():
 
     cur.execute(
         f"""
-        SELECT t.data, a.nome as conta, t.tipo, t.valor, t.descricao, t.categoria
+        SELECT t.data, a.nome as conta, t.tipo, t.valor, a.moeda, t.descricao, t.categoria
         FROM transactions t
         JOIN accounts a ON a.id = t.account_id
         WHERE {where_sql}
@@ -601,14 +1230,15 @@ def transactions_export():
     # CSV
     si = StringIO()
     writer = csv.writer(si)
-    writer.writerow(["Data", "Conta", "Tipo", "Valor", "Descrição", "Categoria"])
+    writer.writerow(["Data", "Conta", "Tipo", "Valor", "Moeda", "Descrição", "Categoria"])
     for r in rows:
         writer.writerow(
             [
                 r["data"],
                 r["conta"],
                 r["tipo"],
-                f"{r['valor']:.2f}",
+                money.fmt(r["valor"]),
+                r["moeda"],
                 r["descricao"] or "",
                 r["categoria"] or "",
             ]
@@ -629,11 +1259,27 @@ def transactions_export():
 @require_login
 def transfer():
     user_id = session["user_id"]
-    from_acc = int(request.form.get("from_account"))
-    to_acc = int(request.form.get("to_account"))
     data_str = request.form.get("data") or date.today().isoformat()
-    valor = float(request.form.get("valor"))
     descricao = request.form.get("descricao") or "Transferência"
+    # as duas contas têm de ser do utilizador (como no /api/transactions/bulk)
+    moedas = {c["id"]: c["moeda"] for c in user_accounts(user_id)}
+    from_acc, to_acc = _bulk_id(request.form.get("from_account")), _bulk_id(request.form.get("to_account"))
+    if from_acc not in moedas or to_acc not in moedas or from_acc == to_acc:
+        flash("Escolhe duas contas diferentes.", "danger")
+        return redirect(url_for("transactions_new"))
+    try:
+        valor = money.parse(request.form.get("valor"))
+        if valor <= 0:
+            raise ValueError("Valor tem que ser maior que zero.")
+    except ValueError as e:
+        flash(f"Erro na transferência: {e}", "danger")
+        return redirect(url_for("transactions_new"))
+
+    # contas em moedas diferentes: a entrada é convertida à taxa do dia
+    valor_dest = valor
+    if moedas[from_acc] != moedas[to_acc]:
+        day = ledger.day_month(data_str)[0] or None
+        valor_dest = FX.current().convert_cents(valor, moedas[from_acc], moedas[to_acc], day)
 
     conn = get_conn()
     cur = conn.cursor()
@@ -645,12 +1291,16 @@ def transfer():
     pair_id = cur.lastrowid
     cur.execute(
         "INSERT INTO transactions (user_id, account_id, data, tipo, valor, descricao, categoria, pair_id) VALUES (?,?,?,?,?,?,?,?)",
-        (user_id, to_acc, data_str, "income", valor, descricao, "transfer", pair_id),
+        (user_id, to_acc, data_str, "income", valor_dest, descricao, "transfer", pair_id),
     )
+    income_id = cur.lastrowid
     cur.execute("UPDATE transactions SET pair_id=? WHERE id=?", (pair_id, pair_id))
+    recalc_balances(cur, user_id)
     conn.commit()
     conn.close()
-    recalc_balances(user_id)
+    for tx_id in (pair_id, income_id):
+        SUGGEST.record(user_id, tx_id, "transfer", descricao)
+    ANOMALY_SCANS.request(user_id)
     flash("Transferência concluída.", "success")
     # no fim
 # flash("Transferência concluída.", "success")
@@ -663,27 +1313,30 @@ def transfer():
 @require_login
 def salary_split():
     user_id = session["user_id"]
-    total = float(request.form.get("valor_total"))
+    total = money.parse(request.form.get("valor_total"))
     pct_poup = float(request.form.get("pct_poupanca"))  # ex: 40 => 40%
     data_str = request.form.get("data") or date.today().isoformat()
 
     # obter ids das contas
     conn = get_conn()
     cur = conn.cursor()
-    cur.execute("SELECT id FROM accounts WHERE user_id=? AND tipo='despesas'", (user_id,))
-    acc_desp = cur.fetchone()["id"]
-    cur.execute("SELECT id FROM accounts WHERE user_id=? AND tipo='poupanca'", (user_id,))
-    acc_poup = cur.fetchone()["id"]
+    cur.execute("SELECT id, moeda FROM accounts WHERE user_id=? AND tipo='despesas'", (user_id,))
+    acc_desp, moeda_desp = cur.fetchone()
+    cur.execute("SELECT id, moeda FROM accounts WHERE user_id=? AND tipo='poupanca'", (user_id,))
+    acc_poup, moeda_poup = cur.fetchone()
 
     # entrada do salário na conta de despesas (BIM)
     cur.execute(
         "INSERT INTO transactions (user_id, account_id, data, tipo, valor, descricao, categoria) VALUES (?,?,?,?,?,?,?)",
         (user_id, acc_desp, data_str, "income", total, "Salário mensal", "salario"),
     )
-    conn.commit()
 
     # transferência da percentagem para poupança
-    valor_poup = round(total * (pct_poup / 100.0), 2)
+    valor_poup = money.scale(total, pct_poup / 100.0)
+    valor_poup_dest = valor_poup
+    if moeda_poup != moeda_desp:
+        day = ledger.day_month(data_str)[0] or None
+        valor_poup_dest = FX.current().convert_cents(valor_poup, moeda_desp, moeda_poup, day)
     if valor_poup > 0:
         # expense em despesas
         cur.execute(
@@ -694,13 +1347,15 @@ def salary_split():
         # income em poupança
         cur.execute(
             "INSERT INTO transactions (user_id, account_id, data, tipo, valor, descricao, categoria, pair_id) VALUES (?,?,?,?,?,?,?,?)",
-            (user_id, acc_poup, data_str, "income", valor_poup, "Transferência poupança", "transfer", pair_id),
+            (user_id, acc_poup, data_str, "income", valor_poup_dest, "Transferência poupança", "transfer", pair_id),
         )
         cur.execute("UPDATE transactions SET pair_id=? WHERE id=?", (pair_id, pair_id))
-        conn.commit()
 
+    # salário, transferência e saldos numa só transação
+    recalc_balances(cur, user_id)
+    conn.commit()
     conn.close()
-    recalc_balances(user_id)
+    ANOMALY_SCANS.request(user_id)
     flash("Salário registado e dividido.", "success")
     # no fim
 # flash("Salário registado e dividido.", "success")
@@ -725,17 +1380,25 @@ def debts():
     if request.method == "POST":
         try:
             nome = request.form.get("nome")
-            valor_total = float(request.form.get("valor_total", 0))
+            valor_total = money.parse(request.form.get("valor_total", 0))
             due_date = request.form.get("due_date") or None
             notas = request.form.get("notas")
+            parcelas = int(request.form.get("parcelas") or 1)
 
             if not nome or valor_total <= 0:
                 raise ValueError("Preenche o nome e um valor > 0")
+            if not 1 <= parcelas <= 360:
+                raise ValueError("Número de prestações entre 1 e 360")
+            if parcelas > 1 and not due_date:
+                raise ValueError("Indica a data da primeira prestação")
 
             cur.execute("""
-                INSERT INTO debts (user_id, nome, valor_total, valor_pago, due_date, status, notas)
-                VALUES (?, ?, ?, 0, ?, 'pendente', ?)
-            """, (user_id, nome, valor_total, due_date, notas))
+                INSERT INTO debts (user_id, nome, valor_total, valor_pago, due_date, status, notas, parcelas)
+                VALUES (?, ?, ?, 0, ?, 'pendente', ?, ?)
+            """, (user_id, nome, valor_total, due_date, notas, parcelas))
+            installments.create(cur, user_id, cur.lastrowid, valor_total, parcelas, due_date)
+            installments.refresh(cur, user_id=user_id)
+            bump_data_version(cur, user_id)
             conn.commit()
 
             flash("Dívida registada com sucesso ✅", "success")
@@ -746,17 +1409,26 @@ def debts():
         return redirect(url_for("debts", ok="debt_new"))
 
 
-    # Listar dívidas
+    # Listar dívidas pela ordem do índice (user_id, status, due_date), sem
+    # B-tree temporária; a ordenação estável põe as pendentes primeiro e as
+    # sem data no fim de cada grupo
     cur.execute("""
-        SELECT id, nome, valor_total, valor_pago, due_date, status, notas
+        SELECT id, nome, valor_total, valor_pago, due_date, status, notas,
+               parcelas, atrasado, proximo_vencimento
         FROM debts
         WHERE user_id=?
-        ORDER BY
-          CASE status WHEN 'pendente' THEN 0 ELSE 1 END,
-          date(due_date) IS NULL,
-          date(due_date) ASC
+        ORDER BY status, due_date
     """, (user_id,))
-    rows = cur.fetchall()
+    rows = sorted(cur.fetchall(), key=lambda d: (d["status"] != "pendente", d["due_date"] is None))
+    resumo = installments.read_summary(conn, user_id)
+    if installments.is_stale(resumo, date.today()):
+        # a tarefa periódica ainda não passou hoje: atrasos à data de hoje, sem escrever
+        resumo, due = installments.as_of(conn, user_id, date.today())
+        rows = [
+            dict(d, atrasado=due[d["id"]][0], proximo_vencimento=due[d["id"]][1]) if d["id"] in due else d
+            for d in rows
+        ]
+    resumo = resumo or installments.EMPTY
 
     # Também vamos precisar das contas para saber se há contas antes de pagar
     contas_rows = user_accounts(user_id)
@@ -767,6 +1439,8 @@ def debts():
     return render_template(
         "debts.html",
         rows=rows,
+        resumo=resumo,
+        upcoming_days=installments.UPCOMING_DAYS,
         contas=contas,
     )
 
@@ -781,7 +1455,7 @@ def pay_debt(debt_id):
 
     # Buscar dívida
     cur.execute("""
-        SELECT id, nome, valor_total, valor_pago, due_date, status
+        SELECT id, nome, valor_total, valor_pago, due_date, status, parcelas, atrasado, proximo_vencimento
         FROM debts
         WHERE user_id=? AND id=?
     """, (user_id, debt_id))
@@ -792,7 +1466,7 @@ def pay_debt(debt_id):
         flash("Dívida não encontrada.", "danger")
         return redirect(url_for("debts"))
 
-    aberto = float(debt["valor_total"] - debt["valor_pago"])
+    aberto = debt["valor_total"] - debt["valor_pago"]
 
     # Buscar contas para escolher de onde sai o dinheiro
     contas_rows = user_accounts(user_id)
@@ -802,13 +1476,20 @@ def pay_debt(debt_id):
         try:
             account_id = int(request.form.get("account_id"))
             data_str = request.form.get("data") or date.today().isoformat()
-            valor = float(request.form.get("valor", 0))
+            valor = money.parse(request.form.get("valor", 0))
 
             if valor <= 0:
                 raise ValueError("Valor tem que ser maior que zero.")
             if valor > aberto:
                 raise ValueError("Não podes pagar mais do que o valor em aberto.")
 
+            # a dívida está na moeda base; a saída fica na moeda da conta
+            moeda_conta = next((c["moeda"] for c in contas if c["id"] == account_id), fx.BASE_CURRENCY)
+            valor_conta = valor
+            if moeda_conta != fx.BASE_CURRENCY:
+                day = ledger.day_month(data_str)[0] or None
+                valor_conta = FX.current().convert_cents(valor, fx.BASE_CURRENCY, moeda_conta, day)
+
             # 1. Registar saída na tabela transactions
             cur.execute("""
                 INSERT INTO transactions (user_id, account_id, data, tipo, valor, descricao, categoria)
@@ -818,43 +1499,40 @@ def pay_debt(debt_id):
                 account_id,
                 data_str,
                 "expense",
-                valor,
+                valor_conta,
                 f"Pagamento dívida: {debt['nome']}",
                 "divida"
             ))
+            tx_id = cur.lastrowid
+
+            alert = record_spend(cur, user_id, account_id, data_str, "expense", valor_conta, "divida")
 
-            # 2. Atualizar valor_pago na dívida
+            # 2. Atualizar valor_pago na dívida; se ficou 100% paga -> status = 'paga'
             cur.execute("""
                 UPDATE debts
-                SET valor_pago = valor_pago + ?
+                SET valor_pago = valor_pago + ?,
+                    status = CASE WHEN valor_pago + ? >= valor_total THEN 'paga' ELSE status END
                 WHERE id=? AND user_id=?
-            """, (valor, debt_id, user_id))
+            """, (valor, valor, debt_id, user_id))
 
-            # 3. Ver se ficou 100% paga -> status = 'paga'
-            cur.execute("""
-                SELECT valor_total, valor_pago
-                FROM debts
-                WHERE id=? AND user_id=?
-            """, (debt_id, user_id))
-            check = cur.fetchone()
-            if check and (check["valor_total"] - check["valor_pago"]) <= 0.005:
-                cur.execute("""
-                    UPDATE debts
-                    SET status='paga'
-                    WHERE id=? AND user_id=?
-                """, (debt_id, user_id))
-
-            # 4. Recalcular saldos das contas
+            # 3. Abater às prestações e atualizar o resumo (em aberto / em atraso)
+            installments.apply_payment(cur, user_id, debt_id, valor)
+            installments.refresh(cur, user_id=user_id)
+
+            # 4. Recalcular saldos das contas (mesma transação)
+            recalc_balances(cur, user_id)
             conn.commit()
-            recalc_balances(user_id)
+            SUGGEST.record(user_id, tx_id, "divida", f"Pagamento dívida: {debt['nome']}")
+            ANOMALY_SCANS.request(user_id)
 
             flash("Pagamento registado com sucesso ✅", "success")
+            flash_budget_alert(alert)
         except Exception as e:
             conn.rollback()
             flash(f"Erro ao pagar dívida: {e}", "danger")
         
         conn.close()
-    return redirect(url_for("debts", ok="debt_pay"))
+        return redirect(url_for("debts", ok="debt_pay"))
 
     # GET → mostrar formulário
     conn.close()
@@ -866,118 +1544,407 @@ def pay_debt(debt_id):
     )
 
 
-# ---------------------- Relatório (helpers) ----------------------
-
-
+# ---------------------- Orçamentos ----------------------
+def save_budget(user_id, categoria, limite, alerta_pct=None):
+    """Cria ou atualiza o orçamento mensal de uma categoria (valores na moeda base)."""
+    cat = budgets.category_key(categoria)
+    if cat is None or cat == "transfer":
+        raise ValueError("Escolhe uma categoria.")
+    limite = money.parse(limite)
+    alerta_pct = float(alerta_pct if alerta_pct not in (None, "") else budgets.DEFAULT_ALERT_PCT)
+    if limite <= 0:
+        raise ValueError("O limite tem que ser maior que zero.")
+    if not 0 < alerta_pct <= 100:
+        raise ValueError("O alerta é uma percentagem entre 1 e 100.")
 
-def _render_report_html(print_mode=False):
-    """Calcula dados e devolve HTML (string) já renderizado."""
-    user_id = session["user_id"]
     conn = get_conn()
     cur = conn.cursor()
+    cur.execute(
+        """
+        INSERT INTO budgets (user_id, categoria, limite, alerta_pct) VALUES (?,?,?,?)
+        ON CONFLICT (user_id, categoria) DO UPDATE SET limite=excluded.limite, alerta_pct=excluded.alerta_pct
+        RETURNING id
+        """,
+        (user_id, cat, limite, alerta_pct),
+    )
+    budget_id = cur.fetchone()[0]
+    conn.commit()
+    conn.close()
+    return budget_id
+
+
+def delete_budget(user_id, budget_id):
+    conn = get_conn()
+    deleted = conn.execute("DELETE FROM budgets WHERE id=? AND user_id=?", (budget_id, user_id)).rowcount
+    conn.commit()
+    conn.close()
+    return deleted
+
+
+def _budget_month():
+    mes = request.args.get("mes") or date.today().strftime("%Y-%m")
+    if budgets.month_key(mes + "-01") != mes:
+        mes = date.today().strftime("%Y-%m")
+    return mes
+
+
+@app.route("/budgets", methods=["GET", "POST"])
+@require_login
+def budgets_page():
+    user_id = session["user_id"]
+
+    if request.method == "POST":
+        try:
+            save_budget(
+                user_id,
+                request.form.get("categoria"),
+                request.form.get("limite", 0),
+                request.form.get("alerta_pct"),
+            )
+            flash("Orçamento guardado ✅", "success")
+        except ValueError as e:
+            flash(f"Erro ao guardar orçamento: {e}", "danger")
+        return redirect(url_for("budgets_page"))
+
+    mes = _budget_month()
+    conn = get_conn()
+    rows = budgets.month_status(conn, user_id, mes)
+    conn.close()
+    return render_template("budgets.html", rows=rows, mes=mes)
+
+
+@app.route("/budgets/<int:budget_id>/delete", methods=["POST"])
+@require_login
+def budgets_delete(budget_id):
+    if delete_budget(session["user_id"], budget_id):
+        flash("Orçamento removido.", "success")
+    return redirect(url_for("budgets_page"))
+
+
+@app.route("/api/budgets", methods=["GET", "POST"])
+@require_login
+def api_budgets():
+    """GET: orçamentos com o gasto do mês (?mes=YYYY-MM). POST: {categoria, limite, alerta_pct}."""
+    user_id = session["user_id"]
+    if request.method == "POST":
+        data = request.get_json(silent=True) or {}
+        try:
+            budget_id = save_budget(user_id, data.get("categoria"), data.get("limite", 0), data.get("alerta_pct"))
+        except (TypeError, ValueError) as e:
+            return jsonify(error=str(e)), 400
+        return jsonify(id=budget_id), 201
+
+    mes = _budget_month()
+    conn = get_conn()
+    rows = budgets.month_status(conn, user_id, mes)
+    conn.close()
+    for r in rows:
+        r["limite"], r["gasto"] = chart_units(r["limite"]), chart_units(r["gasto"])
+    return jsonify(mes=mes, moeda=fx.BASE_CURRENCY, budgets=rows)
+
+
+@app.route("/api/budgets/<int:budget_id>", methods=["DELETE"])
+@require_login
+def api_budgets_delete(budget_id):
+    if not delete_budget(session["user_id"], budget_id):
+        return jsonify(error="Orçamento não encontrado."), 404
+    return "", 204
+
+
+# ---------------------- API de escrita em lote ----------------------
+BULK_KEY_MAX = 100
+
+
+def _bulk_id(value):
+    if isinstance(value, bool):
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_bulk_item(item, moedas):
+    """Valida um item do lote; devolve-o normalizado (valores em cêntimos) ou ValueError."""
+    if not isinstance(item, dict):
+        raise ValueError("Item tem de ser um objeto.")
+    chave = item.get("chave")
+    if not isinstance(chave, str) or not chave.strip() or len(chave) > BULK_KEY_MAX:
+        raise ValueError(f"chave obrigatória (texto até {BULK_KEY_MAX} caracteres).")
+    tipo = item.get("tipo")
+    data_str = item.get("data") or date.today().isoformat()
+    try:
+        date.fromisoformat(str(data_str)[:10])
+    except ValueError:
+        raise ValueError("data inválida (AAAA-MM-DD).") from None
+    valor = item.get("valor")
+    if isinstance(valor, bool) or not isinstance(valor, (int, float, str)):
+        raise ValueError("valor tem de ser um número (ou texto com um número).")
+    valor = money.parse(valor)
+    if valor <= 0:
+        raise ValueError("Valor tem que ser maior que zero.")
+    descricao = item.get("descricao")
+
+    if tipo in ("income", "expense"):
+        account_id = _bulk_id(item.get("account_id"))
+        if account_id not in moedas:
+            raise ValueError("account_id inválido.")
+        return {
+            "chave": chave, "tipo": tipo, "account_id": account_id, "data": data_str, "valor": valor,
+            "descricao": descricao, "categoria": item.get("categoria"),
+        }
+    if tipo == "transfer":
+        from_acc, to_acc = _bulk_id(item.get("from_account")), _bulk_id(item.get("to_account"))
+        if from_acc not in moedas or to_acc not in moedas or from_acc == to_acc:
+            raise ValueError("from_account/to_account inválidos.")
+        valor_dest = valor
+        if moedas[from_acc] != moedas[to_acc]:
+            day = ledger.day_month(data_str)[0] or None
+            valor_dest = FX.current().convert_cents(valor, moedas[from_acc], moedas[to_acc], day)
+        return {
+            "chave": chave, "tipo": "expense", "account_id": from_acc, "data": data_str, "valor": valor,
+            "descricao": descricao or "Transferência", "categoria": "transfer",
+            "to_account": to_acc, "valor_dest": valor_dest,
+        }
+    raise ValueError("tipo tem de ser income, expense ou transfer.")
+
+
+@app.route("/api/transactions/bulk", methods=["POST"])
+@require_login
+def api_transactions_bulk():
+    """Lote de movimentos/transferências: {items: [{chave, tipo, ...}]}.
+
+    Tudo ou nada: o lote é validado de uma vez e inserido numa só transação,
+    com um número fixo de queries (o lote vai como JSON para json_each).
+    Itens cuja `chave` já existe não são inseridos de novo (reenvios de
+    clientes móveis) e voltam como 'duplicado' com o id original.
+    """
+    user_id = session["user_id"]
+    data = request.get_json(silent=True) or {}
+    raw = data.get("items")
+    if not isinstance(raw, list) or not raw:
+        return jsonify(error="items tem de ser uma lista não vazia."), 400
+    if len(raw) > app.config["BULK_MAX_ITEMS"]:
+        return jsonify(error=f"No máximo {app.config['BULK_MAX_ITEMS']} itens por pedido."), 413
+
+    moedas = {c["id"]: c["moeda"] for c in user_accounts(user_id)}
+    items, errors, seen = [], [], set()
+    for i, item in enumerate(raw):
+        try:
+            parsed = parse_bulk_item(item, moedas)
+            if parsed["chave"] in seen:
+                raise ValueError("chave repetida no lote.")
+        except (TypeError, ValueError) as e:
+            errors.append({"index": i, "chave": item.get("chave") if isinstance(item, dict) else None, "error": str(e)})
+            continue
+        seen.add(parsed["chave"])
+        items.append(parsed)
+    if errors:
+        return jsonify(error="Lote inválido; nada foi registado.", errors=errors), 400
+
+    conn = get_conn()
+    cur = conn.cursor()
+    try:
+        # 1. um INSERT para todos os movimentos (e a saída das transferências);
+        #    chaves já registadas ficam de fora (DO NOTHING) e não vêm no RETURNING
+        created = dict(cur.execute(
+            """
+            INSERT INTO transactions (user_id, account_id, data, tipo, valor, descricao, categoria, chave)
+            SELECT ?, json_extract(j.value, '$[0]'), json_extract(j.value, '$[1]'), json_extract(j.value, '$[2]'),
+                   json_extract(j.value, '$[3]'), json_extract(j.value, '$[4]'), json_extract(j.value, '$[5]'),
+                   json_extract(j.value, '$[6]')
+            FROM json_each(?) AS j WHERE true
+            ORDER BY j.key
+            ON CONFLICT (user_id, chave) WHERE chave IS NOT NULL DO NOTHING
+            RETURNING chave, id
+            """,
+            (user_id, json.dumps([
+                [it["account_id"], it["data"], it["tipo"], it["valor"], it["descricao"], it["categoria"], it["chave"]]
+                for it in items
+            ])),
+        ).fetchall())
+        duplicates = {}
+        if len(created) < len(items):
+            duplicates = dict(cur.execute(
+                "SELECT chave, id FROM transactions WHERE user_id=? AND chave IN (SELECT value FROM json_each(?))",
+                (user_id, json.dumps([it["chave"] for it in items if it["chave"] not in created])),
+            ).fetchall())
+        new = [it for it in items if it["chave"] in created]
+
+        # 2. entradas das transferências, ligadas à saída por pair_id
+        transfers = [it for it in new if "to_account" in it]
+        if transfers:
+            cur.execute(
+                """
+                INSERT INTO transactions (user_id, account_id, data, tipo, valor, descricao, categoria, pair_id)
+                SELECT ?, json_extract(j.value, '$[0]'), json_extract(j.value, '$[1]'), 'income',
+                       json_extract(j.value, '$[2]'), json_extract(j.value, '$[3]'), 'transfer', json_extract(j.value, '$[4]')
+                FROM json_each(?) AS j
+                ORDER BY j.key
+                """,
+                (user_id, json.dumps([
+                    [it["to_account"], it["data"], it["valor_dest"], it["descricao"], created[it["chave"]]]
+                    for it in transfers
+                ])),
+            )
+            cur.execute(
+                "UPDATE transactions SET pair_id=id WHERE id IN (SELECT value FROM json_each(?))",
+                (json.dumps([created[it["chave"]] for it in transfers]),),
+            )
+
+        # 3. orçamentos: um upsert para o lote
+        alerts = record_spends(
+            cur, user_id, [(it["account_id"], it["data"], it["tipo"], it["valor"], it["categoria"]) for it in new]
+        )
+        if new:
+            # saldos uma só vez para o lote inteiro, na mesma transação
+            recalc_balances(cur, user_id)
+        conn.commit()
+    except sqlite3.Error as e:
+        conn.rollback()
+        return jsonify(error=f"Erro ao registar o lote: {e}"), 500
+    finally:
+        conn.close()
+
+    if new:
+        for it in new:
+            SUGGEST.record(user_id, created[it["chave"]], it["categoria"], it["descricao"])
+        ANOMALY_SCANS.request(user_id)
+        maintenance.after_bulk_write(app.config["DB_PATH"], len(new) + len(transfers))
+
+    results = [
+        {"chave": it["chave"], "id": created[it["chave"]], "status": "criado"}
+        if it["chave"] in created
+        else {"chave": it["chave"], "id": duplicates.get(it["chave"]), "status": "duplicado"}
+        for it in items
+    ]
+    for alert in alerts:
+        alert["gasto"], alert["limite"] = chart_units(alert["gasto"]), chart_units(alert["limite"])
+    return jsonify(criados=len(new), duplicados=len(items) - len(new), items=results, alertas=alerts), (
+        201 if new else 200
+    )
+
+
+# ---------------------- Sugestões (autocomplete) ----------------------
+@app.route("/api/suggest")
+@require_login
+def api_suggest():
+    """?campo=categoria|descricao&q=prefixo → [{value, count}] por nº de usos, sem ler transactions."""
+    campo = request.args.get("campo", "categoria")
+    if campo not in suggest.FIELDS:
+        return jsonify(error="Campo inválido."), 400
+    limit = min(max(request.args.get("limit", 8, type=int), 1), 20)
+    user_id = session["user_id"]
+    items = SUGGEST.search(user_id, user_data_version(user_id), campo, request.args.get("q", ""), limit)
+    return jsonify(campo=campo, items=items)
+
+
+@app.route("/api/anomalies")
+@require_login
+def api_anomalies():
+    """Possíveis débitos repetidos e gastos atípicos dos últimos anomalies.SHOW_DAYS dias (valores em unidades)."""
+    user_id = session["user_id"]
+    hoje = date.today()
+    conn = get_conn()
+    state = anomalies.read(conn, user_id, hoje - timedelta(days=anomalies.SHOW_DAYS))
+    conn.close()
+    items = current_anomalies(user_id, state)
+    fields = {
+        "duplicado": ("transaction_id", "ref_id", "account_id", "descricao", "categoria", "dia", "valor", "moeda"),
+        "atipico": ("categoria", "mes", "valor", "media", "z", "moeda"),
+    }
+    out = {"duplicados": [], "atipicos": []}
+    for a in items:
+        a["valor"], a["media"] = chart_units(a["valor"]), chart_units(a["media"] or 0)
+        out[a["tipo"] + "s"].append({k: a[k] for k in fields[a["tipo"]]})
+    return jsonify(dias=anomalies.SHOW_DAYS, **out)
+
+
+# ---------------------- Relatório (helpers) ----------------------
 
-    # --- contas
-    cur.execute("""
-        SELECT id, nome, banco, tipo, saldo
-        FROM accounts
-        WHERE user_id=?
-        ORDER BY tipo, nome
-    """, (user_id,))
-    contas_rows = cur.fetchall()
-    contas = [dict(r) if not isinstance(r, dict) else r for r in contas_rows]
-
-    # --- saldos agregados
-    saldo_total = 0.0
-    saldo_poupanca = 0.0
-    saldo_despesas = 0.0
 
+def report_balances(contas):
+    """Saldo de cada tipo de conta (na moeda da conta) + total na moeda de relatório."""
+    saldos = {
+        "saldo_total": 0,
+        "saldo_poupanca": 0,
+        "saldo_despesas": 0,
+        "moeda_poupanca": fx.BASE_CURRENCY,
+        "moeda_despesas": fx.BASE_CURRENCY,
+    }
     for c in contas:
-        saldo_c = float(c.get("saldo") or 0)
-        saldo_total += saldo_c
+        saldo_c = c.get("saldo") or 0
+        # o total soma contas em moedas diferentes: converte à taxa de hoje
+        saldos["saldo_total"] += to_report(saldo_c, c["moeda"])
         nome_c = (c.get("nome") or "").lower()
         tipo_c = (c.get("tipo") or "").lower()
         if tipo_c == "poupanca" or "poup" in nome_c:
-            saldo_poupanca = saldo_c
+            saldos["saldo_poupanca"], saldos["moeda_poupanca"] = saldo_c, c["moeda"]
         if tipo_c == "despesas" or "desp" in nome_c:
-            saldo_despesas = saldo_c
+            saldos["saldo_despesas"], saldos["moeda_despesas"] = saldo_c, c["moeda"]
+    return saldos
 
-    # --- totais históricos (sem transfer)
-    cur.execute("""
-        SELECT
-          COALESCE(SUM(CASE WHEN tipo='income'  THEN valor END),0) AS total_in,
-          COALESCE(SUM(CASE WHEN tipo='expense' THEN valor END),0) AS total_out
-        FROM transactions
-        WHERE user_id=?
-          AND (categoria IS NULL OR LOWER(categoria) <> 'transfer')
-    """, (user_id,))
-    t_all = cur.fetchone()
-    total_in_all = float(t_all["total_in"] or 0)
-    total_out_all = float(t_all["total_out"] or 0)
 
-    # --- dívidas abertas
-    cur.execute("""
-        SELECT COALESCE(SUM(valor_total - valor_pago),0) AS aberto
-        FROM debts
-        WHERE user_id=? AND status='pendente'
-    """, (user_id,))
-    dividas_abertas = float(cur.fetchone()["aberto"] or 0)
-
-    # --- período actual
-    hoje = date.today()
+def report_period(hoje):
+    """(1º dia do mês, etiqueta 'dd/mm/aaaa a dd/mm/aaaa') do período actual."""
     first_month_date = hoje.replace(day=1)
-    first_month_iso = first_month_date.isoformat()  # '2025-10-01'
-    periodo_label = f"{first_month_iso[8:10]}/{first_month_iso[5:7]}/{first_month_iso[0:4]} a {hoje.strftime('%d/%m/%Y')}"
+    return first_month_date, f"{first_month_date.strftime('%d/%m/%Y')} a {hoje.strftime('%d/%m/%Y')}"
 
-    # --- totais do mês (sem transfer)
-    cur.execute("""
-        SELECT
-          COALESCE(SUM(CASE WHEN tipo='income'  THEN valor END),0) AS month_in,
-          COALESCE(SUM(CASE WHEN tipo='expense' THEN valor END),0) AS month_out
-        FROM transactions
-        WHERE user_id=? AND date(data) >= date(?)
-          AND (categoria IS NULL OR LOWER(categoria) <> 'transfer')
-    """, (user_id, first_month_iso))
-    m = cur.fetchone()
-    month_in = float(m["month_in"] or 0)
-    month_out = float(m["month_out"] or 0)
 
-    # --- despesas por categoria (no mês)
-    cur.execute("""
-        SELECT LOWER(COALESCE(categoria,'(sem)')) AS cat, SUM(valor) AS total
-        FROM transactions
-        WHERE user_id=? AND date(data) >= date(?)
-          AND tipo='expense'
-          AND (categoria IS NULL OR LOWER(categoria) <> 'transfer')
-        GROUP BY cat
-        ORDER BY total DESC
-    """, (user_id, first_month_iso))
-    cat_rows = cur.fetchall()
-    cat_expenses = [(r["cat"], float(r["total"] or 0)) for r in cat_rows]
+def _render_report_html(print_mode=False):
+    """Calcula dados e devolve HTML (string) já renderizado."""
+    user_id = session["user_id"]
+    hoje = date.today()
 
-    # --- últimos 60 movimentos
-    cur.execute("""
-        SELECT t.data, a.nome AS conta, t.tipo, t.valor, t.descricao, t.categoria
+    # utilizador, contas, ledger, dívidas e últimos 60 movimentos em paralelo
+    reads = gather_user_reads(user_id, rows=lambda conn: conn.execute("""
+        SELECT t.data, a.nome AS conta, t.tipo, t.valor, a.moeda, t.descricao, t.categoria
         FROM transactions t
         JOIN accounts a ON a.id=t.account_id
         WHERE t.user_id=?
         ORDER BY date(t.data) DESC, t.id DESC
         LIMIT 60
-    """, (user_id,))
-    rows = cur.fetchall()
+    """, (user_id,)).fetchall())
 
-    conn.close()
+    # --- contas (memoizadas no pedido; 1 conta por tipo, logo a ordem é a mesma)
+    contas_rows = user_accounts(user_id)
+    contas = [dict(r) if not isinstance(r, dict) else r for r in contas_rows]
+
+    # --- saldos agregados
+    saldos = report_balances(contas)
+
+    # --- totais históricos (sem transfer)
+    led = user_ledger(user_id)
+    total_in_all, total_out_all = led.totals()
+
+    # --- dívidas abertas
+    dividas_abertas = to_report(current_debts(reads["debts"])["aberto"], fx.BASE_CURRENCY)
 
-    patrimonio_liquido = saldo_total - dividas_abertas
+    # --- período actual
+    first_month_date, periodo_label = report_period(hoje)
+
+    # --- totais do mês (sem transfer)
+    month_in, month_out = led.totals(since=first_month_date)
+
+    # --- despesas por categoria (no mês)
+    cat_expenses = [
+        (cat if cat is not None else "(sem)", total)
+        for cat, total in led.by_category(since=first_month_date, fold=str.lower)
+    ]
+
+    # --- últimos 60 movimentos
+    rows = reads["rows"]
+
+    patrimonio_liquido = saldos["saldo_total"] - dividas_abertas
 
     # qual template usar
     template_name = "report.html" if not print_mode else "report_pdf.html"
 
     html = render_template(
         template_name,
+        data_version=user_data_version(user_id),
         contas=contas,
-        saldo_poupanca=saldo_poupanca,
-        saldo_despesas=saldo_despesas,
-        saldo_total=saldo_total,
+        **saldos,
         patrimonio_liquido=patrimonio_liquido,
         total_in_all=total_in_all,
         total_out_all=total_out_all,
@@ -1000,33 +1967,37 @@ def report():
     return make_response(html, 200)
 
 
+# opções wkhtmltopdf
+PDF_OPTIONS = {
+    "page-size": "A4",
+    "margin-top": "8mm",
+    "margin-right": "8mm",
+    "margin-bottom": "10mm",
+    "margin-left": "8mm",
+    "encoding": "UTF-8",
+    "enable-local-file-access": None,
+    "quiet": None,
+}
+
+
+def html_to_pdf(html, path=False):
+    """PDF via wkhtmltopdf: devolve os bytes, ou escreve em `path`."""
+    import pdfkit
+
+    # *********** MUITO IMPORTANTE NO WINDOWS ***********
+    # Se o wkhtmltopdf estiver noutro sítio, define FINTRACK_WKHTMLTOPDF.
+    config = pdfkit.configuration(wkhtmltopdf=app.config["WKHTMLTOPDF"])
+    return pdfkit.from_string(html, path, options=PDF_OPTIONS, configuration=config)
+
+
 @app.route("/report/pdf")
 @require_login
 def report_pdf():
     # para o PDF usamos a versão print_mode=True (sem botão, etc)
     html = _render_report_html(print_mode=True)
 
-    # opções wkhtmltopdf
-    options = {
-        "page-size": "A4",
-        "margin-top": "8mm",
-        "margin-right": "8mm",
-        "margin-bottom": "10mm",
-        "margin-left": "8mm",
-        "encoding": "UTF-8",
-        "enable-local-file-access": None,
-    }
-
     try:
-        import pdfkit
-
-        # *********** MUITO IMPORTANTE NO WINDOWS ***********
-        # Muda este caminho se no teu PC estiver diferente.
-        WKHTML_PATH = r"C:\Program Files\wkhtmltopdf\bin\wkhtmltopdf.exe"
-
-        config = pdfkit.configuration(wkhtmltopdf=WKHTML_PATH)
-
-        pdf_bytes = pdfkit.from_string(html, False, options=options, configuration=config)
+        pdf_bytes = html_to_pdf(html)
 
         filename = f"relatorio_{date.today().isoformat()}.pdf"
         return Response(
@@ -1043,6 +2014,87 @@ def report_pdf():
         flash(f"Falha ao gerar PDF ({e}). Verifica se wkhtmltopdf está instalado e caminho correto.", "danger")
         return redirect(url_for("report"))
 
+# ---------------------- Extratos mensais (lote) ----------------------
+
+def statement_context(d, hoje, periodo_label):
+    """Variáveis do report_pdf.html a partir de um utilizador de statements.collect."""
+    saldos = report_balances(d["contas"])
+    dividas_abertas = to_report(d["aberto"], fx.BASE_CURRENCY)
+    return dict(
+        data_version=d["data_version"],
+        contas=d["contas"],
+        **saldos,
+        patrimonio_liquido=saldos["saldo_total"] - dividas_abertas,
+        total_in_all=d["total_in_all"],
+        total_out_all=d["total_out_all"],
+        dividas_abertas=dividas_abertas,
+        month_in=d["month_in"],
+        month_out=d["month_out"],
+        cat_expenses=sorted(d["cats"].items(), key=lambda kv: kv[1], reverse=True),
+        rows=d["rows"],
+        periodo_label=periodo_label,
+        hoje=hoje.strftime("%d/%m/%Y"),
+    )
+
+
+def render_statement(user_id, ctx):
+    """Corre nos processos do pool de `flask statements`."""
+    with app.test_request_context():
+        session["user_id"] = user_id  # as chaves do {% cache %} são por utilizador
+        return render_template("report_pdf.html", **ctx)
+
+
+@app.cli.command("statements")
+@click.option("--out", default=None, help="Pasta de saída (default: FINTRACK_STATEMENTS_DIR).")
+@click.option("--user", "user_ids", type=int, multiple=True, help="Só estes utilizadores (repetível).")
+@click.option("--jobs", type=int, default=None, help="wkhtmltopdf em simultâneo (default: nº de cores).")
+@click.option("--procs", type=int, default=None, help="Processos a renderizar HTML (default: nº de cores).")
+@click.option("--html", "as_html", is_flag=True, help="Escreve o HTML em vez do PDF.")
+@click.option("--force", is_flag=True, help="Refaz também os extratos que já existem.")
+def statements_command(out, user_ids, jobs, procs, as_html, force):
+    """Extrato do mês actual para cada utilizador activo; retoma onde parou."""
+    t0 = time.perf_counter()
+    hoje = date.today()
+    since, periodo_label = report_period(hoje)
+    out_dir = out or app.config["STATEMENTS_DIR"]
+
+    conn = get_conn()
+    try:
+        installments.refresh(conn.cursor(), hoje)  # dívidas em aberto à data do extrato
+        conn.commit()
+        data = statements.collect(conn, FX.current(), app.config["REPORT_CURRENCY"], since, user_ids)
+    finally:
+        conn.close()
+
+    items, skipped = [], 0
+    for uid, d in data.items():
+        path = statements.output_path(out_dir, uid, hoje.strftime("%Y-%m"), "html" if as_html else "pdf")
+        if os.path.exists(path) and not force:
+            skipped += 1
+            continue
+        items.append((uid, path, statement_context(d, hoje, periodo_label)))
+
+    cores = statements.available_cores()
+    click.echo(
+        f"{len(data)} utilizadores activos: {skipped} já feitos, {len(items)} a gerar "
+        f"({procs or cores} processos, {jobs or cores} PDFs em paralelo)."
+    )
+    done, failed = statements.run_batch(
+        items,
+        render_statement,
+        statements.write_html if as_html else html_to_pdf,
+        render_procs=procs or cores,
+        pdf_jobs=jobs or cores,
+        echo=click.echo,
+    )
+    click.echo(
+        f"Concluído em {time.perf_counter() - t0:.1f}s: {done} gerados, {skipped} saltados, "
+        f"{failed} com erro. Ficheiros em {out_dir}"
+    )
+    if failed:
+        raise SystemExit(1)
+
+
 # ---------------------- Gestão de Utilizadores ----------------------
 @app.route("/admin/users", methods=["GET", "POST"])
 @require_login
@@ -1072,6 +2124,86 @@ def admin_users():
     return render_template("admin_users.html", users=users)
 
 
+# ---------------------- Manutenção da BD ----------------------
+_activity = {"inflight": 0, "last": 0.0}
+_activity_lock = threading.Lock()
+
+
+@app.before_request
+def _track_request_start():
+    with _activity_lock:
+        _activity["inflight"] += 1
+
+
+@app.teardown_request
+def _track_request_end(exc):
+    with _activity_lock:
+        _activity["inflight"] -= 1
+        _activity["last"] = time.time()
+
+
+def app_is_idle():
+    """Sem pedidos em curso neste worker e sem tráfego nos últimos segundos."""
+    with _activity_lock:
+        return (
+            _activity["inflight"] == 0
+            and time.time() - _activity["last"] >= app.config["MAINTENANCE_IDLE_SECONDS"]
+        )
+
+
+def run_maintenance(analyze=False):
+    result = maintenance.run_maintenance(
+        app.config["DB_PATH"],
+        analyze=analyze,
+        vacuum_pages=app.config["VACUUM_PAGES_PER_STEP"],
+        idle=app_is_idle(),
+    )
+    result["finished_at"] = datetime.now().isoformat(timespec="seconds")
+    app.extensions["fintrack_last_maintenance"] = result
+    return result
+
+
+@app.route("/admin/storage", methods=["GET", "POST"])
+@require_admin
+def admin_storage():
+    """Estado do armazenamento (JSON). POST corre uma ronda de manutenção já."""
+    ran = None
+    if request.method == "POST":
+        ran = run_maintenance(analyze=request.args.get("analyze") == "1")
+
+    conn = get_conn()
+    stats = maintenance.storage_stats(conn, app.config["DB_PATH"])
+    conn.close()
+
+    job = app.extensions.get("fintrack_jobs", {}).get("maintenance")
+    return jsonify(
+        stats=stats,
+        ran=ran,
+        last_maintenance=app.extensions.get("fintrack_last_maintenance"),
+        last_scheduled_run=datetime.fromtimestamp(job.last_run()).isoformat(timespec="seconds") if job and job.last_run() else None,
+    )
+
+
+@app.cli.command("maintenance")
+@click.option("--analyze", is_flag=True, help="ANALYZE completo (ex.: depois de importações grandes).")
+def maintenance_command(analyze):
+    """Corre optimize/ANALYZE, vacuum incremental e checkpoint do WAL."""
+    r = run_maintenance(analyze)
+    click.echo(f"{r['analyze']}: {r['vacuumed_pages']} páginas libertadas, checkpoint {r['checkpoint']}, {r['duration_s']:.2f}s")
+
+
+@app.cli.command("vacuum")
+def vacuum_command():
+    """VACUUM único para passar a BD a auto_vacuum=INCREMENTAL (bloqueia as escritas enquanto corre)."""
+    conn = get_conn()
+    pending = maintenance.vacuum_pending(conn)
+    conn.close()
+    if not pending:
+        click.echo("auto_vacuum já está em INCREMENTAL; nada a fazer.")
+        return
+    click.echo(f"VACUUM concluído em {maintenance.full_vacuum(app.config['DB_PATH']):.2f}s.")
+
+
 # ---------------------- Bootstrap ----------------------
 @app.context_processor
 def inject_utils():
@@ -1079,12 +2211,350 @@ def inject_utils():
     return {
         "now": datetime.now,
         "user_accounts": user_accounts,
+        "currency_symbol": currency_symbol,
+        "base_currency": fx.BASE_CURRENCY,
+        "report_currency": app.config["REPORT_CURRENCY"],
+        # entra nas chaves dos fragmentos com valores convertidos
+        "fx_version": FX.current().version,
     }
 
+
+def currency_symbol(moeda=None):
+    return fx.symbol(moeda or app.config["REPORT_CURRENCY"])
+
+
+@app.template_filter("money")
+def fmt_money(value, moeda=None):
+    """Cêntimos -> '1234.50 MT' (na moeda de relatório, ou em `moeda`)."""
+    return f"{money.fmt(value)} {currency_symbol(moeda)}"
+
+
+@app.template_filter("cents")
+def fmt_cents(value):
+    """Cêntimos -> '1234.50' (sem símbolo)."""
+    return money.fmt(value)
+
+
+@app.after_request
+def add_server_timing(response):
+    """Tempos das leituras em paralelo (gather_user_reads), visíveis no DevTools do browser."""
+    timings = g.get("server_timing")
+    if timings:
+        response.headers["Server-Timing"] = ", ".join(f"db-{name};dur={ms:.2f}" for name, ms in timings)
+    return response
+
+
+@app.after_request
+def check_query_budget(response):
+    """Em debug, falha alto quando uma rota excede o orçamento de queries por pedido."""
+    if app.debug:
+        used = g.get("query_count", 0)
+        budget = app.config["QUERY_BUDGET"]
+        response.headers["X-Query-Count"] = str(used)
+        assert used <= budget, (
+            f"Rota '{request.endpoint}' executou {used} queries (orçamento: {budget})"
+        )
+    return response
+
+
+@app.cli.command("init-db")
+def init_db_command():
+    """Aplica as migrações pendentes do schema."""
+    init_db()
+    print(f"Schema na versão {len(MIGRATIONS)}.")
+
+
+# ---------------------- Backups ----------------------
+
+def run_backup(compress=None):
+    """Backup online completo + rotação; regista as métricas em backup_runs."""
+    metrics = backup.backup_database(
+        app.config["DB_PATH"],
+        app.config["BACKUP_DIR"],
+        compress=app.config["BACKUP_COMPRESS"] if compress is None else compress,
+        keep=app.config["BACKUP_KEEP"],
+    )
+    conn = get_conn()
+    backup.record_run(conn, metrics)
+    conn.close()
+    logging.info(
+        "Backup %s: %.1f KB em %.2fs (%.1f MB/s, %s passos)",
+        metrics["path"], metrics["bytes"] / 1024, metrics["duration_s"], metrics["mb_per_s"], metrics["steps"],
+    )
+    return metrics
+
+
+def export_user(user_id, compress=None):
+    metrics = backup.export_user_snapshot(
+        app.config["DB_PATH"],
+        user_id,
+        os.path.join(app.config["BACKUP_DIR"], "users"),
+        compress=app.config["BACKUP_COMPRESS"] if compress is None else compress,
+        keep=app.config["BACKUP_KEEP"],
+    )
+    conn = get_conn()
+    backup.record_run(conn, metrics)
+    conn.close()
+    return metrics
+
+
+backup_cli = AppGroup("backup", help="Backups online da BD.")
+
+
+@backup_cli.command("run")
+@click.option("--compress/--no-compress", default=None, help="gzip do ficheiro final.")
+def backup_run_command(compress):
+    """Backup completo (não bloqueia a app)."""
+    m = run_backup(compress)
+    click.echo(f"{m['path']}  {m['bytes'] / 1024:.1f} KB  {m['duration_s']:.2f}s  {m['mb_per_s']:.1f} MB/s")
+
+
+@backup_cli.command("user")
+@click.argument("user_id", type=int)
+@click.option("--compress/--no-compress", default=None)
+def backup_user_command(user_id, compress):
+    """Snapshot só com os dados de um utilizador."""
+    m = export_user(user_id, compress)
+    click.echo(f"{m['path']}  {m['rows']} linhas  {m['duration_s']:.2f}s")
+
+
+app.cli.add_command(backup_cli)
+
+
+def import_fx_rates(path=None, force=False):
+    """Importa o ficheiro de taxas (se existir) se mudou desde a última importação.
+
+    Como o init_db: a assinatura do ficheiro fica em fx_imports e os workers
+    que arrancam com o mesmo ficheiro saem logo, sem lock nem escritas.
+    Devolve o nº de linhas importadas (0 = já estava), ou None se não existe.
+    """
+    path = path or app.config["FX_RATES_FILE"]
+    if not path or not os.path.exists(path):
+        return None
+    signature = fx.file_signature(path)
+    conn = get_conn()
+    try:
+        if not force and fx.imported_signature(conn, path) == signature:
+            return 0
+    finally:
+        conn.close()
+    # os workers arrancam ao mesmo tempo: importa um de cada vez
+    with file_lock(app.config["DB_PATH"] + ".lock"):
+        conn = get_conn()
+        try:
+            # outro worker pode ter importado enquanto esperávamos pelo lock
+            if not force and fx.imported_signature(conn, path) == signature:
+                return 0
+            n = fx.load_file(conn, path)
+        finally:
+            conn.close()
+    FX.reset()
+    return n
+
+
+fx_cli = AppGroup("fx", help="Moedas e taxas de câmbio.")
+
+
+@fx_cli.command("import")
+@click.argument("path", required=False)
+def fx_import_command(path):
+    """Importa taxas diárias de um CSV (data,moeda,taxa; taxa = valor em MZN)."""
+    n = import_fx_rates(path, force=True)
+    if n is None:
+        raise click.ClickException(f"Ficheiro não encontrado: {path or app.config['FX_RATES_FILE']}")
+    click.echo(f"{n} taxas importadas. Moedas: {', '.join(FX.current().currencies())}")
+
+
+@fx_cli.command("account")
+@click.argument("account_id", type=int)
+@click.argument("moeda")
+def fx_account_command(account_id, moeda):
+    """Define a moeda de uma conta (os valores já registados ficam nessa moeda)."""
+    moeda = moeda.upper()
+    if moeda not in FX.current().currencies():
+        raise click.ClickException(f"Sem taxas de câmbio para {moeda}; importa-as primeiro.")
+    conn = get_conn()
+    cur = conn.cursor()
+    row = cur.execute("SELECT user_id FROM accounts WHERE id=?", (account_id,)).fetchone()
+    if not row:
+        conn.close()
+        raise click.ClickException(f"Conta {account_id} não existe.")
+    cur.execute("UPDATE accounts SET moeda=? WHERE id=?", (moeda, account_id))
+    bump_data_version(cur, row["user_id"])
+    # os gastos dos orçamentos estão na moeda base: refaz os deste utilizador
+    budgets.rebuild(conn, FX.current(), fx.BASE_CURRENCY, row["user_id"])
+    conn.commit()
+    conn.close()
+    click.echo(f"Conta {account_id} em {moeda}.")
+
+
+app.cli.add_command(fx_cli)
+
+
+@app.cli.command("budgets-rebuild")
+@click.option("--user", "user_id", type=int, default=None, help="Só este utilizador.")
+def budgets_rebuild_command(user_id):
+    """Recalcula o gasto dos orçamentos a partir dos movimentos."""
+    conn = get_conn()
+    n = budgets.rebuild(conn, FX.current(), fx.BASE_CURRENCY, user_id)
+    conn.commit()
+    conn.close()
+    click.echo(f"{n} linhas (utilizador, mês, categoria) recalculadas.")
+
+
+def run_debts_refresh():
+    """Prestações vencidas -> 'atrasada' e resumo das dívidas de todos os utilizadores."""
+    t0 = time.perf_counter()
+    conn = get_conn()
+    cur = conn.cursor()
+    overdue = installments.refresh(cur)
+    conn.commit()
+    conn.close()
+    return {"overdue": overdue, "duration_s": time.perf_counter() - t0}
+
+
+@app.cli.command("debts-refresh")
+def debts_refresh_command():
+    """Marca prestações em atraso e recalcula o resumo das dívidas (todos os utilizadores)."""
+    r = run_debts_refresh()
+    click.echo(f"{r['overdue']} prestações passaram a atrasadas ({r['duration_s']:.2f}s).")
+
+
+def run_anomalies_scan(user_ids=None, full=False):
+    """Passagem de repetidos/atípicos para os utilizadores com escritas (ou mês novo) desde a última.
+
+    Carrega de uma vez só o histórico de que a análise precisa
+    (anomalies.history_start) para ledgers próprios, sem passar pela cache
+    LEDGER (não empurra para fora os utilizadores activos). `full` ignora o
+    estado e volta a analisar tudo.
+    """
+    t0 = time.perf_counter()
+    hoje = date.today()
+    conn = get_conn()
+    cur = conn.cursor()
+    where = "u.status = 'ativo'"
+    params = []
+    if user_ids:
+        where += f" AND u.id IN ({','.join('?' * len(user_ids))})"
+        params = list(user_ids)
+    if not full:
+        where += " AND (s.user_id IS NULL OR s.data_version <> u.data_version OR s.mes <> ?)"
+        params.append(ledger.month_label(hoje.year * 12 + hoje.month - 1))
+    # a data_version é lida antes dos movimentos: uma escrita pelo meio só faz
+    # com que a próxima passagem volte a olhar para este utilizador
+    pending = {
+        r[0]: (r[1], None if full or r[2] is None else {"last_id": r[2]})
+        for r in cur.execute(
+            f"""
+            SELECT u.id, u.data_version, s.last_id FROM users u
+            LEFT JOIN anomaly_scans s ON s.user_id = u.id
+            WHERE {where}
+            """,
+            params,
+        ).fetchall()
+    }
+    ids = json.dumps(list(pending))
+    contas = {}
+    for c in cur.execute("SELECT * FROM accounts WHERE user_id IN (SELECT value FROM json_each(?))", (ids,)):
+        contas.setdefault(c["user_id"], []).append(c)
+    results = []
+
+    def analyse(uid, rows):
+        led = ledger.UserLedger()
+        led.load(rows)
+        led.convert(*(ledger_conversion(uid, contas.get(uid, [])) or (None, None)))
+        version, state = pending.pop(uid)
+        new, last_id = anomalies.scan(led, state, hoje)
+        results.append((uid, version, last_id, new))
+
+    # um utilizador de cada vez em memória (ordenado pelo índice user_id, date(data));
+    # tuplos simples: sqlite3.Row -> tuple custa mais do que a análise
+    tx = conn.cursor()
+    tx.row_factory = None
+    tx.execute(
+        """
+        SELECT user_id, id, data, tipo, valor, account_id, categoria, descricao FROM transactions
+        WHERE user_id IN (SELECT value FROM json_each(?)) AND date(data) >= ?
+        ORDER BY user_id
+        """,
+        (ids, anomalies.history_start(hoje).isoformat()),
+    )
+    for uid, rows in itertools.groupby(tx, key=lambda r: r[0]):
+        analyse(uid, [r[1:] for r in rows])
+    for uid in list(pending):  # sem movimentos recentes
+        analyse(uid, [])
+    found = sum(len(r[3]) for r in results)
+    if results:
+        anomalies.save(cur, results, hoje)
+        conn.commit()
+    conn.close()
+    return {"users": len(results), "found": found, "duration_s": time.perf_counter() - t0}
+
+
+@app.cli.command("anomalies-scan")
+@click.option("--user", "user_ids", type=int, multiple=True, help="Só estes utilizadores.")
+@click.option("--full", is_flag=True, help="Volta a analisar tudo, não só o que mudou.")
+def anomalies_scan_command(user_ids, full):
+    """Procura débitos repetidos e gastos atípicos (utilizadores com escritas desde a última passagem)."""
+    r = run_anomalies_scan(list(user_ids) or None, full)
+    click.echo(f"{r['users']} utilizadores analisados, {r['found']} anomalias novas ({r['duration_s']:.2f}s).")
+
+
+def start_background_jobs():
+    """Arranca as tarefas periódicas configuradas (uma thread por tarefa, por worker)."""
+    jobs = app.extensions.setdefault("fintrack_jobs", {})
+    state_dir = os.path.dirname(app.config["DB_PATH"]) or "."
+    if app.config["BACKUP_INTERVAL"] > 0 and "backup" not in jobs:
+        jobs["backup"] = PeriodicJob("backup", app.config["BACKUP_INTERVAL"], run_backup, state_dir)
+        jobs["backup"].start()
+    if app.config["MAINTENANCE_INTERVAL"] > 0 and "maintenance" not in jobs:
+        jobs["maintenance"] = PeriodicJob(
+            "maintenance", app.config["MAINTENANCE_INTERVAL"], run_maintenance, state_dir, is_idle=app_is_idle
+        )
+        jobs["maintenance"].start()
+    if app.config["DEBTS_INTERVAL"] > 0 and "debts" not in jobs:
+        jobs["debts"] = PeriodicJob("debts", app.config["DEBTS_INTERVAL"], run_debts_refresh, state_dir)
+        jobs["debts"].start()
+    if app.config["ANOMALIES_INTERVAL"] > 0 and "anomalies" not in jobs:
+        jobs["anomalies"] = PeriodicJob("anomalies", app.config["ANOMALIES_INTERVAL"], run_anomalies_scan, state_dir)
+        jobs["anomalies"].start()
+    return jobs
+
+
+def create_app(config=None):
+    """Application factory usada pelo gunicorn (run:app) e pelo modo dev.
+
+    Aplica a config, recria as caches (LEDGER, READS, FX, SUGGEST) com ela,
+    garante o schema (uma vez, com lock entre workers), importa as taxas se
+    o CSV mudou e regista quanto tempo o worker demorou a ficar pronto.
+
+    Não cria uma app nova: configura e devolve o `app` global deste módulo
+    (as rotas estão ligadas a ele). Chamá-la outra vez no mesmo processo
+    altera essa mesma app e descarta as caches; as tarefas periódicas só
+    arrancam na primeira vez.
+    """
+    if config:
+        app.config.update(config)
+    build_caches()
+
+    # bytecode dos templates partilhado entre workers/reinícios
+    from jinja2 import FileSystemBytecodeCache
+
+    os.makedirs(app.config["JINJA_CACHE_DIR"], exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(app.config["JINJA_CACHE_DIR"])
+
+    init_db()
+    import_fx_rates()
+    start_background_jobs()
+
+    startup = time.perf_counter() - _BOOT_T0
+    app.config["STARTUP_SECONDS"] = startup
+    logging.info("Worker %s pronto em %.1f ms", os.getpid(), startup * 1000)
+    return app
+
+
 if __name__ == "__main__":
-    # Inicializa a BD sem usar before_first_request (removido no Flask 3.x)
-    with app.app_context():
-        init_db()
+    create_app()
     app.run(debug=True)
 
 
@@ -0,0 +1,179 @@
+"""Backups online da BD com a API de backup do SQLite.
+
+A cópia é feita em blocos de `pages` páginas; entre blocos a thread cede o
+processador (e o lock de leitura), por isso o tráfego normal continua a
+escrever durante o backup. Se outra ligação escrever a meio, o SQLite
+recomeça a cópia; ao fim de `max_restarts` recomeços fazemos a cópia num só
+passo, que em WAL também não bloqueia os writers.
+"""
+import gzip
+import logging
+import os
+import shutil
+import sqlite3
+import time
+from datetime import datetime
+
+
+class _TooManyRestarts(Exception):
+    pass
+
+
+def _timestamp():
+    return datetime.now().strftime("%Y%m%d-%H%M%S")
+
+
+def _gzip(path):
+    gz_path = path + ".gz"
+    with open(path, "rb") as src, gzip.open(gz_path, "wb", compresslevel=6) as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+    os.remove(path)
+    return gz_path
+
+
+def rotate(dest_dir, prefix, keep):
+    """Mantém só os `keep` backups mais recentes com este prefixo."""
+    if keep <= 0:
+        return []
+    files = sorted(
+        f for f in os.listdir(dest_dir)
+        if f.startswith(prefix + "-") and (f.endswith(".db") or f.endswith(".db.gz"))
+    )
+    removed = files[:-keep]
+    for f in removed:
+        os.remove(os.path.join(dest_dir, f))
+    return removed
+
+
+def backup_database(db_path, dest_dir, pages=256, pause=0.001, compress=False, keep=7, max_restarts=5):
+    """Backup completo de `db_path` para `dest_dir`. Devolve as métricas da corrida."""
+    os.makedirs(dest_dir, exist_ok=True)
+    prefix = os.path.splitext(os.path.basename(db_path))[0]
+    dest = os.path.join(dest_dir, f"{prefix}-{_timestamp()}.db")
+
+    state = {"steps": 0, "restarts": 0, "remaining": None}
+
+    def progress(status, remaining, total):
+        state["steps"] += 1
+        if state["remaining"] is not None and remaining > state["remaining"]:
+            state["restarts"] += 1
+            if state["restarts"] > max_restarts:
+                raise _TooManyRestarts()
+        state["remaining"] = remaining
+        # cede entre passos para não competir com os pedidos em curso
+        time.sleep(pause)
+
+    t0 = time.perf_counter()
+    src = sqlite3.connect(db_path)
+    dst = sqlite3.connect(dest)
+    try:
+        try:
+            src.backup(dst, pages=pages, progress=progress)
+        except _TooManyRestarts:
+            logging.warning("Backup recomeçou %s vezes; a copiar num só passo", state["restarts"])
+            src.backup(dst, pages=-1)
+        page_size = dst.execute("PRAGMA page_size").fetchone()[0]
+        page_count = dst.execute("PRAGMA page_count").fetchone()[0]
+    finally:
+        dst.close()
+        src.close()
+
+    if compress:
+        dest = _gzip(dest)
+    duration = time.perf_counter() - t0
+    rotated = rotate(dest_dir, prefix, keep)
+
+    size = page_size * page_count
+    return {
+        "kind": "full",
+        "path": dest,
+        "pages": page_count,
+        "bytes": size,
+        "file_bytes": os.path.getsize(dest),
+        "steps": state["steps"],
+        "restarts": state["restarts"],
+        "duration_s": duration,
+        "mb_per_s": (size / 1024 / 1024) / duration if duration > 0 else 0.0,
+        "rotated": len(rotated),
+    }
+
+
+def _user_tables(conn, schema="main"):
+    """Tabelas com coluna user_id (as novas entram sozinhas no snapshot)."""
+    tables = []
+    for name, sql in conn.execute(
+        f"SELECT name, sql FROM {schema}.sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%' ORDER BY name"
+    ).fetchall():
+        cols = [c[1] for c in conn.execute(f'PRAGMA {schema}.table_info("{name}")')]
+        if "user_id" in cols:
+            tables.append((name, sql))
+    return tables
+
+
+def export_user_snapshot(db_path, user_id, dest_dir, compress=False, keep=7):
+    """Exporta só os dados de um utilizador para uma BD SQLite própria.
+
+    Serve para restaurar um único tenant sem mexer nos restantes. A leitura
+    é feita numa só transação, logo o snapshot é consistente.
+    """
+    os.makedirs(dest_dir, exist_ok=True)
+    prefix = f"user-{user_id}"
+    dest = os.path.join(dest_dir, f"{prefix}-{_timestamp()}.db")
+
+    t0 = time.perf_counter()
+    snap = sqlite3.connect(dest, isolation_level=None)
+    rows = 0
+    try:
+        snap.execute("ATTACH DATABASE ? AS live", (db_path,))
+        snap.execute("BEGIN")
+        users_sql = snap.execute(
+            "SELECT sql FROM live.sqlite_master WHERE type='table' AND name='users'"
+        ).fetchone()[0]
+        snap.execute(users_sql)
+        rows += snap.execute("INSERT INTO main.users SELECT * FROM live.users WHERE id=?", (user_id,)).rowcount
+        for name, sql in _user_tables(snap, "live"):
+            snap.execute(sql)
+            rows += snap.execute(
+                f'INSERT INTO main."{name}" SELECT * FROM live."{name}" WHERE user_id=?', (user_id,)
+            ).rowcount
+        snap.execute("COMMIT")
+        snap.execute("DETACH DATABASE live")
+    finally:
+        snap.close()
+
+    if compress:
+        dest = _gzip(dest)
+    duration = time.perf_counter() - t0
+    rotated = rotate(dest_dir, prefix, keep)
+    size = os.path.getsize(dest)
+    return {
+        "kind": "user",
+        "user_id": user_id,
+        "path": dest,
+        "rows": rows,
+        "file_bytes": size,
+        "duration_s": duration,
+        "mb_per_s": (size / 1024 / 1024) / duration if duration > 0 else 0.0,
+        "rotated": len(rotated),
+    }
+
+
+def record_run(conn, metrics, status="ok"):
+    """Guarda as métricas de uma corrida na tabela backup_runs."""
+    conn.execute(
+        """
+        INSERT INTO backup_runs (started_at, kind, snapshot_user, path, bytes, duration_s, mb_per_s, status)
+        VALUES (?,?,?,?,?,?,?,?)
+        """,
+        (
+            datetime.now().isoformat(timespec="seconds"),
+            metrics.get("kind"),
+            metrics.get("user_id"),
+            metrics.get("path"),
+            metrics.get("bytes", metrics.get("file_bytes")),
+            metrics.get("duration_s"),
+            metrics.get("mb_per_s"),
+            status,
+        ),
+    )
+    conn.commit()
@@ -0,0 +1,180 @@
+"""Orçamentos mensais por categoria.
+
+O gasto do mês por (utilizador, mês, categoria) fica em budget_spend e é
+atualizado pelas escritas que inserem movimentos (`add_spend`), na mesma
+transação do INSERT. Assim o alerta de um movimento é uma leitura por chave
+primária e a página de orçamentos não varre a tabela transactions.
+
+Valores em cêntimos na moeda base (como as dívidas). `rebuild` recalcula tudo a partir
+dos movimentos, para o caso de o contador divergir (ex.: taxas de câmbio
+importadas depois de os movimentos terem sido registados).
+"""
+import json
+from datetime import date
+
+# % do limite a partir do qual avisamos que o orçamento está perto do fim
+DEFAULT_ALERT_PCT = 80.0
+
+
+def category_key(categoria):
+    """Categorias comparam-se sem maiúsculas/espaços (como no relatório)."""
+    cat = (categoria or "").strip().lower()
+    return cat or None
+
+
+def month_key(data_str):
+    try:
+        return date.fromisoformat(str(data_str)[:10]).strftime("%Y-%m")
+    except ValueError:
+        return None
+
+
+def status(gasto, limite, alerta_pct):
+    if gasto > limite:
+        return "excedido"
+    if gasto >= limite * alerta_pct / 100.0:
+        return "perto"
+    return "ok"
+
+
+def _spend_key(data_str, tipo, categoria):
+    """(mes, categoria) em que a saída conta, ou None se não entra nos orçamentos."""
+    cat = category_key(categoria)
+    mes = month_key(data_str)
+    if tipo != "expense" or cat is None or cat == "transfer" or mes is None:
+        return None
+    return mes, cat
+
+
+def _alert(cat, mes, gasto, valor, limite, alerta_pct):
+    before, after = status(gasto - valor, limite, alerta_pct), status(gasto, limite, alerta_pct)
+    if after == before or after == "ok":
+        return None
+    return {"categoria": cat, "mes": mes, "gasto": gasto, "limite": limite, "status": after}
+
+
+def add_spend(cur, user_id, data_str, tipo, valor, categoria):
+    """Soma uma saída (cêntimos, já na moeda base) ao gasto do mês da categoria.
+
+    Devolve um alerta {categoria, mes, gasto, limite, status} se este movimento
+    fez o orçamento passar de nível (ok -> perto -> excedido), senão None.
+    """
+    key = _spend_key(data_str, tipo, categoria)
+    if key is None:
+        return None
+    mes, cat = key
+    # o orçamento vem no RETURNING: uma query em vez de duas
+    gasto, limite, alerta_pct = cur.execute(
+        """
+        INSERT INTO budget_spend (user_id, mes, categoria, gasto) VALUES (?,?,?,?)
+        ON CONFLICT (user_id, mes, categoria) DO UPDATE SET gasto = gasto + excluded.gasto
+        RETURNING gasto,
+          (SELECT limite FROM budgets b WHERE b.user_id = budget_spend.user_id AND b.categoria = budget_spend.categoria),
+          (SELECT alerta_pct FROM budgets b WHERE b.user_id = budget_spend.user_id AND b.categoria = budget_spend.categoria)
+        """,
+        (user_id, mes, cat, valor),
+    ).fetchone()
+    if limite is None:
+        return None
+    return _alert(cat, mes, gasto, valor, limite, alerta_pct)
+
+
+def add_spend_many(cur, user_id, rows):
+    """Como add_spend, para um lote [(data_str, tipo, valor, categoria)].
+
+    Duas queries seja qual for o tamanho do lote (o lote vai como JSON).
+    Devolve a lista de alertas (um por mês/categoria que mudou de nível).
+    """
+    totals = {}
+    for data_str, tipo, valor, categoria in rows:
+        key = _spend_key(data_str, tipo, categoria)
+        if key is not None:
+            totals[key] = totals.get(key, 0) + valor
+    if not totals:
+        return []
+    after = cur.execute(
+        """
+        INSERT INTO budget_spend (user_id, mes, categoria, gasto)
+        SELECT ?, json_extract(j.value, '$[0]'), json_extract(j.value, '$[1]'), json_extract(j.value, '$[2]')
+        FROM json_each(?) AS j WHERE true
+        ON CONFLICT (user_id, mes, categoria) DO UPDATE SET gasto = gasto + excluded.gasto
+        RETURNING mes, categoria, gasto
+        """,
+        (user_id, json.dumps([[mes, cat, valor] for (mes, cat), valor in totals.items()])),
+    ).fetchall()
+    limits = {
+        r[0]: (r[1], r[2])
+        for r in cur.execute("SELECT categoria, limite, alerta_pct FROM budgets WHERE user_id=?", (user_id,))
+    }
+    alerts = []
+    for mes, cat, gasto in after:
+        if cat in limits:
+            alert = _alert(cat, mes, gasto, totals[(mes, cat)], *limits[cat])
+            if alert:
+                alerts.append(alert)
+    return alerts
+
+
+def month_status(conn, user_id, mes):
+    """Orçamentos do utilizador com o gasto do mês (só budgets + budget_spend)."""
+    rows = conn.execute(
+        """
+        SELECT b.id, b.categoria, b.limite, b.alerta_pct, COALESCE(s.gasto, 0) AS gasto
+        FROM budgets b
+        LEFT JOIN budget_spend s
+          ON s.user_id = b.user_id AND s.mes = ? AND s.categoria = b.categoria
+        WHERE b.user_id = ?
+        ORDER BY b.categoria
+        """,
+        (mes, user_id),
+    ).fetchall()
+    return [
+        {
+            "id": r[0],
+            "categoria": r[1],
+            "limite": r[2],
+            "alerta_pct": r[3],
+            "gasto": r[4],
+            "pct": round(r[4] * 100.0 / r[2], 1) if r[2] else 0.0,
+            "status": status(r[4], r[2], r[3]),
+        }
+        for r in rows
+    ]
+
+
+def rebuild(conn, rates, base, user_id=None):
+    """Recalcula budget_spend a partir de transactions (migração, correções).
+
+    `rates` é um fx.FxRates; os valores são convertidos para `base` à taxa do dia.
+    """
+    where, params = "", []
+    if user_id is not None:
+        where, params = "AND t.user_id = ?", [user_id]
+    rows = conn.execute(
+        f"""
+        SELECT t.user_id, strftime('%Y-%m', t.data) AS mes, t.categoria,
+               a.moeda, date(t.data) AS dia, SUM(t.valor)
+        FROM transactions t
+        JOIN accounts a ON a.id = t.account_id
+        WHERE t.tipo = 'expense' AND t.categoria IS NOT NULL
+          AND strftime('%Y-%m', t.data) IS NOT NULL {where}
+        GROUP BY t.user_id, mes, t.categoria, a.moeda, dia
+        """,
+        params,
+    ).fetchall()
+    totals = {}
+    for uid, mes, categoria, moeda, dia, valor in rows:
+        # normalização em Python: LOWER() do SQLite só trata ASCII
+        cat = category_key(categoria)
+        if cat is None or cat == "transfer":
+            continue
+        day = date.fromisoformat(dia).toordinal()
+        key = (uid, mes, cat)
+        totals[key] = totals.get(key, 0) + rates.convert_cents(valor, moeda, base, day)
+
+    conn.execute(f"DELETE FROM budget_spend {'WHERE user_id = ?' if user_id is not None else ''}", params)
+    conn.executemany(
+        "INSERT INTO budget_spend (user_id, mes, categoria, gasto) VALUES (?,?,?,?)",
+        [(*key, gasto) for key, gasto in totals.items()],
+    )
+    return len(totals)
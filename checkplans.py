@@ -0,0 +1,175 @@
+"""Verifica os planos (EXPLAIN QUERY PLAN) das queries dos caminhos quentes.
+
+Cria uma BD temporária com o seed do loadtest.py, corre ANALYZE (como a
+manutenção faz em produção), percorre as rotas principais com o cliente de
+teste do Flask e recolhe todas as queries que a app executou, já com os
+parâmetros. Falha (exit 1) se alguma query sobre `transactions` fizer SCAN
+completo da tabela ou ordenar com uma B-tree temporária em vez de um índice.
+
+Serve para apanhar a edição que transforma um SEARCH num SCAN sem ninguém
+dar por isso; corre-se antes de mexer no SQL de dashboard, transactions,
+export, relatório ou recalc_balances.
+
+    python checkplans.py
+    python checkplans.py --rows 5000 -v   # mostra o plano de todas as queries
+"""
+import argparse
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+from datetime import date, timedelta
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+TABLE = "transactions"
+WRITE_PREFIXES = ("INSERT", "REPLACE", "BEGIN", "COMMIT", "ROLLBACK", "PRAGMA", "SAVEPOINT", "RELEASE")
+LITERALS_RE = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+
+def routes(accounts):
+    """(método, path, form[, status]) com parâmetros representativos de cada rota.
+
+    Em /api/ o form vai como JSON. Com `status`, a resposta tem de ter esse código.
+    """
+    today = date.today()
+    desde = (today - timedelta(days=30)).isoformat()
+    acc = accounts[0]
+    return [
+        ("GET", "/dashboard", None),
+        ("GET", "/transactions", None),
+        ("GET", f"/transactions?from={desde}", None),
+        ("GET", f"/transactions?from={desde}&to={today.isoformat()}&tipo=expense", None),
+        ("GET", f"/transactions?account_id={acc}&categoria=comp", None),
+        ("GET", "/transactions?q=mov+1", None),
+        ("GET", "/transactions?page=3", None),
+        ("GET", "/transactions/export", None),
+        ("GET", f"/transactions/export?from={desde}&tipo=expense", None),
+        ("GET", "/report", None),
+        ("GET", "/budgets", None),
+        ("GET", "/debts", None),
+        # o seed não tem dívidas: esta é a 1ª (id 1), com prestações
+        ("POST", "/debts", {"nome": "checkplans", "valor_total": "300", "parcelas": 3, "due_date": desde}),
+        ("GET", "/debts/pay/1", None, 200),
+        ("POST", "/debts/pay/1", {"account_id": acc, "valor": "50"}),
+        ("GET", "/api/suggest?campo=descricao&q=mo", None),
+        ("POST", "/transactions/new", {
+            "tipo": "expense", "account_id": acc, "valor": "12.50",
+            "descricao": "checkplans", "categoria": "compras",
+        }),
+        ("POST", "/api/transactions/bulk", {"items": [
+            {"chave": "checkplans-1", "tipo": "expense", "account_id": acc, "valor": "3.20", "categoria": "comp"},
+            {"chave": "checkplans-2", "tipo": "transfer", "from_account": acc, "to_account": accounts[1], "valor": 10},
+        ]}),
+        # reenvio: as chaves já existem
+        ("POST", "/api/transactions/bulk", {"items": [
+            {"chave": "checkplans-1", "tipo": "expense", "account_id": acc, "valor": "3.20", "categoria": "comp"},
+        ]}),
+        ("GET", "/dashboard", None),
+        ("GET", "/api/suggest?campo=categoria&q=c", None),
+    ]
+
+
+def capture(db_path, users, rows):
+    """Semeia a BD, corre as rotas e devolve [(rota, sql)] pela ordem de execução."""
+    import loadtest
+
+    emails = loadtest.seed_database(db_path, users, rows)
+    import app as fintrack
+
+    conn = sqlite3.connect(db_path)
+    conn.execute("ANALYZE")
+    conn.commit()
+    accounts = [r[0] for r in conn.execute(
+        "SELECT a.id FROM accounts a JOIN users u ON u.id = a.user_id WHERE u.email=? ORDER BY a.id", (emails[0],)
+    )]
+    conn.close()
+
+    captured = []
+    route = [None]
+    fintrack.app.config["SQL_TRACE"] = lambda sql: captured.append((route[0], sql))
+    client = fintrack.app.test_client()
+    client.post("/login", data={"email": emails[0], "senha": loadtest.PASSWORD})
+    for method, path, form, *status in routes(accounts):
+        route[0] = f"{method} {path}"
+        if path.startswith("/api/") and form is not None:
+            resp = client.open(path, method=method, json=form)
+        else:
+            resp = client.open(path, method=method, data=form)
+        if resp.status_code >= 400 or status and resp.status_code != status[0]:
+            raise SystemExit(f"{route[0]} devolveu {resp.status_code}")
+    fintrack.app.config["SQL_TRACE"] = None
+    return captured
+
+
+def table_aliases(sql):
+    """Nomes com que `transactions` aparece no plano (a própria tabela e aliases)."""
+    names = {TABLE}
+    for m in re.finditer(rf"\b{TABLE}\s+(?:AS\s+)?(\w+)", sql, re.IGNORECASE):
+        if m.group(1).upper() not in ("WHERE", "SET", "JOIN", "LEFT", "INNER", "ON", "GROUP", "ORDER", "LIMIT"):
+            names.add(m.group(1))
+    return names
+
+
+def problems(plan, sql):
+    names = table_aliases(sql)
+    found = []
+    for detail in plan:
+        m = re.match(r"SCAN (\w+)", detail)
+        if m and m.group(1) in names:
+            found.append(detail)
+        # ORDER BY sobre agregados (GROUP BY ... ORDER BY COUNT(*)) não tem índice possível
+        elif "TEMP B-TREE" in detail and "ORDER BY" in detail and "GROUP BY" not in sql.upper():
+            found.append(detail)
+    return found
+
+
+def check(db_path, captured, verbose=False):
+    conn = sqlite3.connect(db_path)
+    seen = set()
+    failures = 0
+    try:
+        for route, sql in captured:
+            stmt = " ".join(sql.split())
+            if stmt.upper().startswith(WRITE_PREFIXES) or not re.search(rf"\b{TABLE}\b", stmt, re.IGNORECASE):
+                continue
+            key = LITERALS_RE.sub("?", stmt)
+            if key in seen:
+                continue
+            seen.add(key)
+            plan = [r[3] for r in conn.execute("EXPLAIN QUERY PLAN " + stmt)]
+            bad = problems(plan, stmt)
+            if bad or verbose:
+                print(f"{'FALHA' if bad else 'ok   '} [{route}] {stmt[:160]}")
+                for detail in plan:
+                    print(f"        {'!' if detail in bad else ' '} {detail}")
+            failures += bool(bad)
+    finally:
+        conn.close()
+    print(f"{len(seen)} queries sobre {TABLE} verificadas, {failures} com SCAN/ORDER BY sem índice.")
+    return failures
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    p.add_argument("--users", type=int, default=3, help="utilizadores sintéticos na BD")
+    p.add_argument("--rows", type=int, default=2000, help="movimentos por utilizador no seed")
+    p.add_argument("-v", "--verbose", action="store_true", help="mostra também os planos sem problemas")
+    args = p.parse_args(argv)
+
+    sys.path.insert(0, HERE)
+    workdir = tempfile.mkdtemp(prefix="fintrack-plans-")
+    db_path = os.path.join(workdir, "plans.db")
+    os.environ["FINTRACK_JINJA_CACHE"] = os.path.join(workdir, "jinja")
+    try:
+        captured = capture(db_path, args.users, args.rows)
+        failures = check(db_path, captured, args.verbose)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
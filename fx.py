@@ -0,0 +1,190 @@
+"""Câmbios: taxas diárias em memória e conversão em bloco.
+
+As taxas vêm de um ficheiro CSV (``data,moeda,taxa``) importado para a
+tabela fx_rates; ``taxa`` é quanto vale 1 unidade da moeda na moeda base
+(MZN). Para um dia sem taxa usa-se a última taxa anterior conhecida.
+
+As conversões não fazem JOIN por linha: a tabela inteira fica em memória
+(por moeda, dias e taxas ordenados) e cada consulta é um bisect, memoizado
+por (moeda, dia); com NumPy, uma coluna inteira de dias é convertida de uma
+vez com searchsorted.
+"""
+import csv
+import os
+import threading
+import time
+import zlib
+from array import array
+from bisect import bisect_right
+from datetime import date
+from functools import lru_cache
+
+import money
+
+BASE_CURRENCY = "MZN"
+
+SYMBOLS = {"MZN": "MT", "USD": "US$", "ZAR": "R", "EUR": "€", "GBP": "£"}
+
+
+def symbol(code):
+    return SYMBOLS.get(code, code)
+
+
+@lru_cache(maxsize=None)
+def _numpy():
+    # só na primeira conversão em bloco (não pesa no arranque); sem NumPy usamos o bisect memoizado
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def file_signature(path):
+    """'tamanho:crc32' do ficheiro: só muda quando muda o conteúdo (tocar no mtime não conta)."""
+    with open(path, "rb") as fh:
+        data = fh.read()
+    return f"{len(data)}:{zlib.crc32(data):08x}"
+
+
+def imported_signature(conn, path):
+    """Assinatura do ficheiro na última importação (None se nunca foi importado)."""
+    row = conn.execute("SELECT assinatura FROM fx_imports WHERE path=?", (os.path.abspath(path),)).fetchone()
+    return row[0] if row else None
+
+
+def load_file(conn, path):
+    """Importa (upsert) as taxas do CSV e regista a assinatura. Devolve o nº de linhas importadas."""
+    rows = []
+    with open(path, newline="", encoding="utf-8") as fh:
+        for r in csv.DictReader(fh):
+            dia = date.fromisoformat(r["data"].strip()).isoformat()
+            moeda = r["moeda"].strip().upper()
+            taxa = float(r["taxa"])
+            if taxa <= 0:
+                raise ValueError(f"Taxa inválida para {moeda} em {dia}: {taxa}")
+            rows.append((dia, moeda, taxa))
+    conn.executemany("INSERT OR REPLACE INTO fx_rates (dia, moeda, taxa) VALUES (?,?,?)", rows)
+    conn.execute(
+        "INSERT OR REPLACE INTO fx_imports (path, assinatura, importado_em) VALUES (?,?,datetime('now'))",
+        (os.path.abspath(path), file_signature(path)),
+    )
+    conn.commit()
+    return len(rows)
+
+
+class FxRates:
+    """Snapshot imutável da tabela fx_rates."""
+
+    def __init__(self, rows, base=BASE_CURRENCY):
+        self.base = base
+        series = {}
+        for dia, moeda, taxa in rows:
+            series.setdefault(moeda, []).append((date.fromisoformat(dia).toordinal(), float(taxa)))
+        self._days = {}
+        self._rates = {}
+        for moeda, points in series.items():
+            points.sort()
+            self._days[moeda] = [d for d, _ in points]
+            self._rates[moeda] = [t for _, t in points]
+        self._memo = {}
+        # muda quando o conteúdo muda; entra nas chaves das caches (ledger e fragmentos)
+        self.version = f"{len(rows)}:{zlib.crc32(repr(sorted(rows)).encode()):08x}"
+
+    def currencies(self):
+        return sorted({self.base, *self._days})
+
+    def rate(self, moeda, day):
+        """Valor de 1 `moeda` na moeda base no dia `day` (ordinal)."""
+        if moeda == self.base:
+            return 1.0
+        key = (moeda, day)
+        taxa = self._memo.get(key)
+        if taxa is None:
+            days = self._days.get(moeda)
+            if not days:
+                raise LookupError(f"Sem taxas de câmbio para {moeda}")
+            # antes da primeira taxa conhecida usamos a primeira
+            taxa = self._rates[moeda][max(bisect_right(days, day) - 1, 0)]
+            self._memo[key] = taxa
+        return taxa
+
+    def convert(self, value, src, dst, day=None):
+        if src == dst:
+            return value
+        day = day or date.today().toordinal()
+        return value * self.rate(src, day) / self.rate(dst, day)
+
+    def convert_cents(self, cents, src, dst, day=None):
+        """Como convert, para valores a guardar: cêntimos inteiros, arredondados."""
+        if src == dst:
+            return cents
+        return money.scale(cents, self.convert(1.0, src, dst, day))
+
+    def _rates_for(self, moeda, days):
+        # versão vectorizada de rate() para uma coluna de dias (NumPy)
+        np = _numpy()
+        if moeda == self.base:
+            return np.ones(len(days))
+        if not self._days.get(moeda):
+            raise LookupError(f"Sem taxas de câmbio para {moeda}")
+        idx = np.searchsorted(np.asarray(self._days[moeda]), days, side="right") - 1
+        return np.asarray(self._rates[moeda])[np.clip(idx, 0, None)]
+
+    def factors(self, accounts, days, currencies, target):
+        """Fator de conversão para `target` de cada movimento.
+
+        `accounts`/`days` são colunas paralelas (array 'i'); `currencies`
+        mapeia conta -> moeda. Devolve um array('d') paralelo.
+        """
+        np = _numpy()
+        if np is not None:
+            acc = np.frombuffer(accounts, dtype=np.int32)
+            d = np.frombuffer(days, dtype=np.int32)
+            out = np.ones(len(acc))
+            for account_id, moeda in currencies.items():
+                if moeda == target:
+                    continue
+                sel = acc == account_id
+                if sel.any():
+                    out[sel] = self._rates_for(moeda, d[sel]) / self._rates_for(target, d[sel])
+            return array("d", out.tobytes())
+        out = []
+        for account_id, day in zip(accounts, days):
+            moeda = currencies.get(account_id, target)
+            out.append(1.0 if moeda == target else self.rate(moeda, day) / self.rate(target, day))
+        return array("d", out)
+
+
+class FxCache:
+    """Mantém o FxRates actual; relê a tabela ao mudar de dia ou ao fim de `ttl` segundos.
+
+    Importações feitas noutro processo (CLI, outro worker) ficam visíveis
+    aqui no máximo `ttl` segundos depois.
+    """
+
+    def __init__(self, connect, ttl=300, base=BASE_CURRENCY):
+        self.connect = connect
+        self.ttl = ttl
+        self.base = base
+        self._current = None
+        self._loaded = (None, 0.0)  # (dia, time.monotonic())
+        self._lock = threading.Lock()
+
+    def current(self):
+        today = date.today()
+        with self._lock:
+            day, at = self._loaded
+            if self._current is None or day != today or time.monotonic() - at > self.ttl:
+                conn = self.connect()
+                try:
+                    rows = [tuple(r) for r in conn.execute("SELECT dia, moeda, taxa FROM fx_rates")]
+                finally:
+                    conn.close()
+                self._current = FxRates(rows, self.base)
+                self._loaded = (today, time.monotonic())
+            return self._current
+
+    def reset(self):
+        with self._lock:
+            self._current = None
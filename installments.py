@@ -0,0 +1,196 @@
+"""Prestações das dívidas e estado pré-calculado (em atraso, próximos pagamentos).
+
+Cada dívida tem um plano de `parcelas` prestações mensais sem juros
+(debt_installments), a partir da data limite. Os pagamentos abatem às
+prestações mais antigas (`apply_payment`).
+
+O que a página de dívidas e o dashboard mostram — em aberto, em atraso,
+a pagar nos próximos 30 dias — fica em debts (atrasado, proximo_vencimento)
+e em debt_summary, uma linha por utilizador. `refresh` recalcula isso para
+todos os utilizadores de uma vez (tarefa periódica: as prestações passam a
+'atrasada' só porque o dia muda) ou só para um, nas escritas. As leituras
+nunca escrevem: num dia em que a tarefa ainda não passou, `as_of` calcula o
+mesmo à data de hoje sem gravar nada.
+
+Valores em cêntimos na moeda base (como valor_total/valor_pago).
+"""
+from datetime import date, timedelta
+
+# janela dos "próximos pagamentos"
+UPCOMING_DAYS = 30
+
+
+def add_months(day, n):
+    """Mesmo dia `n` meses depois (ou o último dia do mês, se não existir)."""
+    k = day.year * 12 + day.month - 1 + n
+    year, month = divmod(k, 12)
+    month += 1
+    for d in (day.day, 30, 29, 28):
+        try:
+            return date(year, month, min(day.day, d))
+        except ValueError:
+            continue
+
+
+def schedule(valor_total, parcelas, first_due):
+    """[(n, 'YYYY-MM-DD', cêntimos)]: prestações iguais, o resto da divisão nas primeiras."""
+    parcelas = max(int(parcelas), 1)
+    base, resto = divmod(valor_total, parcelas)
+    return [
+        (n, add_months(first_due, n - 1).isoformat(), base + (1 if n <= resto else 0))
+        for n in range(1, parcelas + 1)
+    ]
+
+
+def create(cur, user_id, debt_id, valor_total, parcelas, due_date, pago=0):
+    """Gera as prestações de uma dívida (sem data limite não há plano)."""
+    if not due_date:
+        return 0
+    rows = []
+    for n, dia, valor in schedule(valor_total, parcelas, date.fromisoformat(due_date[:10])):
+        abatido = min(pago, valor)
+        pago -= abatido
+        rows.append((debt_id, n, user_id, dia, valor, abatido, "paga" if abatido >= valor else "pendente"))
+    cur.executemany(
+        """
+        INSERT INTO debt_installments (debt_id, n, user_id, due_date, valor, pago, status)
+        VALUES (?,?,?,?,?,?,?)
+        """,
+        rows,
+    )
+    return len(rows)
+
+
+def apply_payment(cur, user_id, debt_id, valor):
+    """Abate `valor` às prestações em aberto, da mais antiga para a mais recente.
+
+    Um só UPDATE: `antes` é o que falta pagar nas prestações anteriores
+    (soma acumulada), e cada prestação recebe o que sobra do pagamento.
+    Uma 'atrasada' paga em parte continua atrasada.
+    """
+    cur.execute(
+        """
+        UPDATE debt_installments SET
+          pago = pago + MIN(valor - pago, MAX(? - w.antes, 0)),
+          status = CASE WHEN ? - w.antes >= valor - pago THEN 'paga' ELSE status END
+        FROM (
+            SELECT n AS wn, SUM(valor - pago) OVER (ORDER BY n) - (valor - pago) AS antes
+            FROM debt_installments
+            WHERE debt_id = ? AND status <> 'paga'
+        ) AS w
+        WHERE debt_id = ? AND user_id = ? AND n = w.wn AND w.antes < ?
+        """,
+        (valor, valor, debt_id, debt_id, user_id, valor),
+    )
+
+
+def refresh(cur, today=None, user_id=None):
+    """Marca prestações vencidas e recalcula debts/debt_summary numa passagem.
+
+    Sem `user_id` trata todos os utilizadores (4 statements, independentemente
+    de quantos sejam); com `user_id`, 3. Devolve o nº de prestações que passaram a 'atrasada'.
+    """
+    today = (today or date.today()).isoformat()
+    upcoming = (date.fromisoformat(today) + timedelta(days=UPCOMING_DAYS)).isoformat()
+    where = d_where = ""
+    params = []
+    if user_id is not None:
+        where, d_where, params = "AND user_id = ?", "AND d.user_id = ?", [user_id]
+
+    overdue = cur.execute(
+        f"UPDATE debt_installments SET status='atrasada' WHERE status='pendente' AND due_date < ? {where}",
+        [today, *params],
+    ).rowcount
+
+    # por dívida: quanto está em atraso e a próxima prestação por pagar
+    # (e limpa as que acabaram de ficar pagas)
+    cur.execute(
+        f"""
+        UPDATE debts SET
+          atrasado = COALESCE((
+            SELECT SUM(i.valor - i.pago) FROM debt_installments i
+            WHERE i.debt_id = debts.id AND i.status = 'atrasada'), 0),
+          proximo_vencimento = (
+            SELECT MIN(i.due_date) FROM debt_installments i
+            WHERE i.debt_id = debts.id AND i.status <> 'paga')
+        WHERE (status = 'pendente' OR proximo_vencimento IS NOT NULL) {where}
+        """,
+        params,
+    )
+
+    # todos: apaga e volta a inserir só quem tem dívidas pendentes;
+    # um utilizador: o agregado sem GROUP BY dá sempre uma linha (zeros se já não deve nada)
+    if user_id is None:
+        cur.execute("DELETE FROM debt_summary")
+    cur.execute(
+        f"""
+        INSERT OR REPLACE INTO debt_summary (user_id, aberto, atrasado, proximo_valor, proxima_data, dividas, dia)
+        SELECT {'d.user_id' if user_id is None else '?'},
+               COALESCE(SUM(d.valor_total - d.valor_pago), 0), COALESCE(SUM(d.atrasado), 0),
+               COALESCE(MAX(p.valor), 0), MIN(d.proximo_vencimento), COUNT(d.id), ?
+        FROM debts d
+        LEFT JOIN (
+            SELECT user_id, SUM(valor - pago) AS valor FROM debt_installments
+            WHERE status = 'pendente' AND due_date <= ? {where}
+            GROUP BY user_id
+        ) p ON p.user_id = d.user_id
+        WHERE d.status = 'pendente' {d_where}
+        {'GROUP BY d.user_id' if user_id is None else ''}
+        """,
+        [*params, today, upcoming, *params, *params],
+    )
+    return overdue
+
+
+EMPTY = {"aberto": 0, "atrasado": 0, "proximo_valor": 0, "proxima_data": None, "dividas": 0, "dia": None}
+
+
+def read_summary(conn, user_id):
+    """Linha de debt_summary ou None (nunca teve dívidas). Só lê: serve em ligações mode=ro."""
+    row = conn.execute(
+        "SELECT aberto, atrasado, proximo_valor, proxima_data, dividas, dia FROM debt_summary WHERE user_id=?",
+        (user_id,),
+    ).fetchone()
+    if row is None:
+        return None
+    return dict(zip(("aberto", "atrasado", "proximo_valor", "proxima_data", "dividas", "dia"), tuple(row)))
+
+
+def is_stale(state, today):
+    return state is not None and state["dia"] != today.isoformat()
+
+
+def as_of(conn, user_id, today):
+    """O que `refresh` gravaria hoje para o utilizador, só a ler: (resumo,
+    {debt_id: (atrasado, proximo_vencimento)} das dívidas pendentes). Duas queries."""
+    day = today.isoformat()
+    upcoming = (today + timedelta(days=UPCOMING_DAYS)).isoformat()
+    due, proximo_valor = {}, 0
+    for debt_id, atrasado, proximo, a_pagar in conn.execute(
+        """
+        SELECT debt_id,
+               COALESCE(SUM(CASE WHEN due_date < ? THEN valor - pago END), 0),
+               MIN(due_date),
+               COALESCE(SUM(CASE WHEN due_date BETWEEN ? AND ? THEN valor - pago END), 0)
+        FROM debt_installments
+        WHERE user_id = ? AND status <> 'paga'
+        GROUP BY debt_id
+        """,
+        (day, day, upcoming, user_id),
+    ):
+        due[debt_id] = (atrasado, proximo)
+        proximo_valor += a_pagar
+    pending = conn.execute(
+        "SELECT id, valor_total - valor_pago FROM debts WHERE user_id = ? AND status = 'pendente'", (user_id,)
+    ).fetchall()
+    debts = {r[0]: due.get(r[0], (0, None)) for r in pending}
+    datas = [p for _, p in debts.values() if p]
+    state = {
+        "aberto": sum(r[1] for r in pending),
+        "atrasado": sum(a for a, _ in debts.values()),
+        "proximo_valor": proximo_valor if pending else 0,
+        "proxima_data": min(datas) if datas else None,
+        "dividas": len(pending),
+        "dia": day,
+    }
+    return state, debts
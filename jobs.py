@@ -0,0 +1,102 @@
+"""Locks entre processos e tarefas periódicas partilhadas pelos workers.
+
+Com o gunicorn há vários processos a correr a mesma app; as tarefas de
+manutenção (backups, optimize, ...) arrancam em todos, mas só um worker
+executa cada ronda: quem apanhar o lock e encontrar a tarefa "em atraso".
+"""
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+@contextmanager
+def file_lock(path, blocking=True):
+    """Lock exclusivo num ficheiro. Devolve True/False (False só se blocking=False)."""
+    with open(path, "a+") as fh:
+        if os.name == "nt":
+            import msvcrt
+
+            fh.seek(0)
+            mode = msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK
+            while True:
+                try:
+                    msvcrt.locking(fh.fileno(), mode, 1)
+                    break
+                except OSError:
+                    if not blocking:
+                        yield False
+                        return
+                    # LK_LOCK desiste ao fim de ~10s; continuamos à espera
+            try:
+                yield True
+            finally:
+                fh.seek(0)
+                msvcrt.locking(fh.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+
+            flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+            try:
+                fcntl.flock(fh.fileno(), flags)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+
+
+class PeriodicJob(threading.Thread):
+    """Corre `fn()` de `interval` em `interval` segundos, num só worker de cada vez.
+
+    O instante da última execução fica no mtime de um ficheiro "stamp" ao lado
+    do lock, por isso é partilhado entre processos e sobrevive a reinícios.
+    `is_idle` (opcional) permite adiar a execução enquanto houver tráfego.
+    """
+
+    def __init__(self, name, interval, fn, state_dir, is_idle=None):
+        super().__init__(name=f"job-{name}", daemon=True)
+        self.job_name = name
+        self.interval = interval
+        self.fn = fn
+        self.is_idle = is_idle
+        self.lock_path = os.path.join(state_dir, f".job-{name}.lock")
+        self.stamp_path = os.path.join(state_dir, f".job-{name}.stamp")
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def last_run(self):
+        try:
+            return os.path.getmtime(self.stamp_path)
+        except OSError:
+            return 0.0
+
+    def run(self):
+        # acorda mais vezes do que o intervalo para não acumular atraso
+        tick = max(min(self.interval / 4, 60), 1)
+        while not self._stop_event.wait(tick):
+            self.run_if_due()
+
+    def run_if_due(self):
+        if time.time() - self.last_run() < self.interval:
+            return False
+        if self.is_idle is not None and not self.is_idle():
+            return False
+        with file_lock(self.lock_path, blocking=False) as acquired:
+            # outro worker pode ter corrido entretanto
+            if not acquired or time.time() - self.last_run() < self.interval:
+                return False
+            try:
+                self.fn()
+            except Exception:
+                logging.exception("Tarefa periódica '%s' falhou", self.job_name)
+            finally:
+                with open(self.stamp_path, "a"):
+                    pass
+                os.utime(self.stamp_path)
+        return True
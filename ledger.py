@@ -0,0 +1,430 @@
+"""Ledger em memória, por utilizador, em colunas compactas (módulo `array`).
+
+Cada utilizador tem os seus movimentos em buffers paralelos ordenados por
+data: dia (ordinal), mês (ano*12+mês-1), valor, conta, categoria e
+descrição (ids internos), flag de entrada e flag de transferência. Somas por período,
+por categoria, por dia e por mês passam a ser fatias destes buffers
+(com NumPy quando está instalado; senão um ciclo simples em Python), em
+vez de um SUM novo em SQL seguido de cópias de sqlite3.Row.
+
+A cache carrega cada utilizador na primeira leitura e depois só lê os
+movimentos novos (id > último id visto) quando a data_version do
+utilizador muda, seja a escrita deste worker ou de outro. Os utilizadores
+menos usados saem primeiro quando se passa o limite de memória.
+
+Com contas em várias moedas as somas usam `values`: os valores já
+convertidos para a moeda de relatório, calculados de uma vez (fatores de
+câmbio por movimento, ver fx.py) e refeitos só quando mudam os movimentos,
+as taxas ou as moedas. Sem conversão `values` é a própria coluna `amounts`.
+
+Valores em cêntimos (ver money.py): `amounts` é int64 e, sem conversão, as
+somas são inteiras e exatas; com conversão `values` é float (cêntimos).
+
+    python ledger.py     # mede memória e tempos para 100k movimentos
+"""
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from datetime import date
+from functools import lru_cache
+
+
+
+@lru_cache(maxsize=None)
+def numpy():
+    """O módulo numpy, ou None se não estiver instalado (usamos ciclos simples).
+
+    Importado só na primeira soma vectorizada: no import do módulo custava
+    ~25-35 ms ao arranque de cada worker, mesmo em pedidos que nunca o usam.
+    """
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+_COLUMNS = ("ids", "days", "months", "amounts", "accounts", "cats", "descs", "income", "transfer")
+
+
+@lru_cache(maxsize=16384)
+def day_month(value):
+    """'YYYY-MM-DD[...]' -> (ordinal, ano*12+mês-1); (0, 0) se a data for inválida
+    (como date() NULL em SQL). Memoizado: as datas repetem-se muito."""
+    try:
+        d = date.fromisoformat(str(value)[:10])
+    except ValueError:
+        return 0, 0
+    return d.toordinal(), d.year * 12 + d.month - 1
+
+
+def month_label(key):
+    return f"{key // 12:04d}-{key % 12 + 1:02d}"
+
+
+class UserLedger:
+    """Movimentos de um utilizador em colunas, ordenados por dia."""
+
+    def __init__(self):
+        self.ids = array("q")
+        self.days = array("i")
+        self.months = array("i")
+        self.amounts = array("q")  # cêntimos
+        self.accounts = array("i")
+        self.cats = array("i")
+        self.descs = array("i")
+        self.income = array("b")
+        self.transfer = array("b")
+        self.values = self.amounts  # valores na moeda de relatório
+        self.conversion = None  # chave da conversão aplicada a `values`
+        self.cat_names = [None]  # id 0 = sem categoria
+        self._cat_index = {None: 0}
+        self.desc_names = [None]  # id 0 = sem descrição
+        self._desc_index = {None: 0}
+        self.names_bytes = 2 * 64  # estimativa dos nomes, atualizada à medida que entram
+        self.last_id = 0
+        self.version = None
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def nbytes(self):
+        cols = sum(getattr(self, c).itemsize * len(getattr(self, c)) for c in _COLUMNS)
+        if self.values is not self.amounts:
+            cols += self.values.itemsize * len(self.values)
+        return cols + self.names_bytes
+
+    def _cat_id(self, name):
+        cid = self._cat_index.get(name)
+        if cid is None:
+            cid = len(self.cat_names)
+            self._cat_index[name] = cid
+            self.cat_names.append(name)
+            self.names_bytes += len(name or "") + 64
+        return cid
+
+    def _desc_id(self, text):
+        did = self._desc_index.get(text)
+        if did is None:
+            did = len(self.desc_names)
+            self._desc_index[text] = did
+            self.desc_names.append(text)
+            self.names_bytes += len(text or "") + 64
+        return did
+
+    def _row(self, r):
+        # r = (id, data, tipo, valor, account_id, categoria, descricao)
+        day, month = day_month(r[1])
+        cat = r[5]
+        return (
+            r[0], day, month, int(r[3] or 0), r[4] or 0, self._cat_id(cat), self._desc_id(r[6]),
+            1 if r[2] == "income" else 0,
+            1 if cat is not None and cat.lower() == "transfer" else 0,
+        )
+
+    def load(self, rows):
+        """Carga inicial (ou recarga completa)."""
+        parsed = sorted((self._row(r) for r in rows), key=lambda x: (x[1], x[0]))
+        for i, col in enumerate(_COLUMNS):
+            getattr(self, col)[:] = array(getattr(self, col).typecode, (p[i] for p in parsed))
+        self.last_id = max(self.ids) if self.ids else 0
+        self._reset_conversion()
+
+    def extend(self, rows):
+        """Movimentos novos: cada um entra na posição certa (datas retroativas incluídas)."""
+        for r in rows:
+            p = self._row(r)
+            pos = bisect_right(self.days, p[1])
+            for i, col in enumerate(_COLUMNS):
+                getattr(self, col).insert(pos, p[i])
+            self.last_id = max(self.last_id, p[0])
+        self._reset_conversion()
+
+    def _reset_conversion(self):
+        self.values = self.amounts
+        self.conversion = None
+
+    def convert(self, key, factors):
+        """Prepara `values` na moeda de relatório.
+
+        `key` identifica a conversão (None = sem conversão); `factors(accounts,
+        days)` devolve um array('d') com o fator de cada movimento.
+        """
+        with self.lock:
+            if key == self.conversion:
+                return
+            if key is None:
+                self.values = self.amounts
+            else:
+                fac = factors(self.accounts, self.days)
+                np = numpy()
+                if np is not None:
+                    conv = np.frombuffer(self.amounts, dtype=np.int64) * np.frombuffer(fac, dtype=np.float64)
+                    self.values = array("d", conv.tobytes())
+                else:
+                    self.values = array("d", (a * k for a, k in zip(self.amounts, fac)))
+            self.conversion = key
+
+    # ---------------- consultas ----------------
+
+    def _np_values(self):
+        return numpy().frombuffer(self.values, dtype=self.values.typecode)
+
+    def _num(self, x):
+        # bincount soma em float64: exato para cêntimos, volta a int sem conversão
+        return int(round(x)) if self.values.typecode == "q" else float(x)
+
+    def _span(self, since=None, until=None):
+        lo = bisect_left(self.days, since.toordinal()) if since else 0
+        hi = bisect_right(self.days, until.toordinal()) if until else len(self.days)
+        return lo, hi
+
+    def totals(self, since=None, until=None, exclude_transfer=True):
+        """(entradas, saídas) no período."""
+        with self.lock:
+            lo, hi = self._span(since, until)
+            np = numpy()
+            if np is not None:
+                amt = self._np_values()[lo:hi]
+                inc = np.frombuffer(self.income, dtype=np.int8)[lo:hi].astype(bool)
+                keep = np.frombuffer(self.transfer, dtype=np.int8)[lo:hi] == 0 if exclude_transfer else np.ones(hi - lo, bool)
+                return amt[inc & keep].sum().item(), amt[~inc & keep].sum().item()
+            t_in = t_out = 0
+            amounts, income, transfer = self.values, self.income, self.transfer
+            for i in range(lo, hi):
+                if exclude_transfer and transfer[i]:
+                    continue
+                if income[i]:
+                    t_in += amounts[i]
+                else:
+                    t_out += amounts[i]
+            return t_in, t_out
+
+    def by_category(self, since=None, until=None, income=False, fold=None):
+        """[(categoria, total)] do maior para o menor (sem transferências).
+
+        `fold` (ex.: str.lower) junta categorias que só diferem na escrita.
+        """
+        with self.lock:
+            lo, hi = self._span(since, until)
+            want = 1 if income else 0
+            np = numpy()
+            if np is not None:
+                sel = (np.frombuffer(self.income, dtype=np.int8)[lo:hi] == want) & (
+                    np.frombuffer(self.transfer, dtype=np.int8)[lo:hi] == 0
+                )
+                cats = np.frombuffer(self.cats, dtype=np.int32)[lo:hi][sel]
+                amt = self._np_values()[lo:hi][sel]
+                sums = np.bincount(cats, weights=amt, minlength=len(self.cat_names))
+                per_cat = {int(c): self._num(sums[c]) for c in np.unique(cats)}
+            else:
+                per_cat = {}
+                for i in range(lo, hi):
+                    if self.income[i] == want and not self.transfer[i]:
+                        per_cat[self.cats[i]] = per_cat.get(self.cats[i], 0) + self.values[i]
+            names = self.cat_names
+        out = {}
+        for cid, total in per_cat.items():
+            name = names[cid]
+            if fold is not None and name is not None:
+                name = fold(name)
+            out[name] = out.get(name, 0) + total
+        return sorted(out.items(), key=lambda kv: kv[1], reverse=True)
+
+    def by_day(self, since=None, until=None):
+        """[(date, entradas, saídas)] só para os dias com movimentos (sem transferências)."""
+        with self.lock:
+            lo, hi = self._span(since, until)
+            rows = {}
+            for i in range(lo, hi):
+                if self.transfer[i]:
+                    continue
+                acc = rows.setdefault(self.days[i], [0, 0])
+                acc[0 if self.income[i] else 1] += self.values[i]
+        return [(date.fromordinal(d), v[0], v[1]) for d, v in sorted(rows.items()) if d]
+
+    def by_month(self, since=None, until=None):
+        """{'YYYY-MM': (entradas, saídas)} (sem transferências)."""
+        with self.lock:
+            lo, hi = self._span(since, until)
+            np = numpy()
+            if np is not None and hi > lo:
+                months = np.frombuffer(self.months, dtype=np.int32)[lo:hi]
+                amt = self._np_values()[lo:hi]
+                inc = np.frombuffer(self.income, dtype=np.int8)[lo:hi].astype(bool)
+                keep = (np.frombuffer(self.transfer, dtype=np.int8)[lo:hi] == 0) & (months != 0)
+                if not keep.any():
+                    return {}
+                base = int(months[keep].min())
+                idx = months - base
+                n = int(idx.max()) + 1
+                s_in = np.bincount(idx[inc & keep], weights=amt[inc & keep], minlength=n)
+                s_out = np.bincount(idx[~inc & keep], weights=amt[~inc & keep], minlength=n)
+                present = np.bincount(idx[keep], minlength=n)
+                return {
+                    month_label(base + k): (self._num(s_in[k]), self._num(s_out[k]))
+                    for k in range(n) if present[k]
+                }
+            rows = {}
+            for i in range(lo, hi):
+                if self.transfer[i] or not self.months[i]:
+                    continue
+                acc = rows.setdefault(self.months[i], [0, 0])
+                acc[0 if self.income[i] else 1] += self.values[i]
+        return {month_label(k): (v[0], v[1]) for k, v in sorted(rows.items())}
+
+
+class LedgerCache:
+    """LRU de UserLedger com limite de memória, partilhada pelas threads do worker."""
+
+    LOAD_SQL = """
+        SELECT id, data, tipo, valor, account_id, categoria, descricao
+        FROM transactions
+        WHERE user_id=? AND id>?
+        ORDER BY id
+    """
+
+    def __init__(self, connect, max_bytes=64 * 1024 * 1024):
+        self.connect = connect
+        self.max_bytes = max_bytes
+        self._users = OrderedDict()
+        self._sizes = {}  # user_id -> bytes contados em `_bytes`
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.loads = 0
+        self.refreshes = 0
+
+    def _fetch(self, user_id, since_id, conn=None):
+        if conn is not None:
+            return conn.execute(self.LOAD_SQL, (user_id, since_id)).fetchall()
+        conn = self.connect()
+        try:
+            return conn.execute(self.LOAD_SQL, (user_id, since_id)).fetchall()
+        finally:
+            conn.close()
+
+    def _entry(self, user_id):
+        with self._lock:
+            led = self._users.get(user_id)
+            if led is None:
+                led = self._users[user_id] = UserLedger()
+            self._users.move_to_end(user_id)
+        return led
+
+    def _sync(self, led, user_id, version, conn=None):
+        # chamar com led.lock
+        if led.version is None:
+            led.load(self._fetch(user_id, 0, conn))
+            self.loads += 1
+        elif led.version != version:
+            led.extend(self._fetch(user_id, led.last_id, conn))
+            self.refreshes += 1
+        led.version = version
+
+    def get(self, user_id, version, conversion=None):
+        """Ledger do utilizador, atualizado se `version` mudou desde a última leitura.
+
+        `conversion` = (chave, fatores) para as somas saírem noutra moeda (ver
+        UserLedger.convert); None = valores tal como estão nas contas.
+        """
+        led = self._entry(user_id)
+        with led.lock:
+            self._sync(led, user_id, version)
+            led.convert(*(conversion or (None, None)))
+            self._account(user_id, led)
+        return led
+
+    def prefetch(self, user_id, version, conn):
+        """Só a parte de I/O de `get`, numa ligação dada (ex.: readpool, em paralelo
+        com outras leituras). O `get` seguinte com a mesma versão não vai à BD."""
+        led = self._entry(user_id)
+        with led.lock:
+            self._sync(led, user_id, version, conn)
+            self._account(user_id, led)
+
+    def invalidate(self, user_id=None):
+        """Esquece um utilizador (ou todos) — ex.: depois de migrações que reescrevem valores."""
+        with self._lock:
+            if user_id is None:
+                self._users.clear()
+                self._sizes.clear()
+                self._bytes = 0
+            else:
+                self._users.pop(user_id, None)
+                self._bytes -= self._sizes.pop(user_id, 0)
+
+    def nbytes(self):
+        return self._bytes
+
+    def _account(self, user_id, led):
+        # chamar com led.lock: o tamanho só muda em load/extend/convert
+        size = led.nbytes()
+        with self._lock:
+            if self._users.get(user_id) is not led:
+                return  # invalidado entretanto
+            self._bytes += size - self._sizes.get(user_id, 0)
+            self._sizes[user_id] = size
+            if self._bytes > self.max_bytes:
+                self._evict(keep=user_id)
+
+    def _evict(self, keep):
+        # chamar com self._lock
+        while self._bytes > self.max_bytes and len(self._users) > 1:
+            uid = next(iter(self._users))
+            if uid == keep:
+                self._users.move_to_end(uid)
+                continue
+            del self._users[uid]
+            self._bytes -= self._sizes.pop(uid, 0)
+
+
+def _benchmark(n=100_000):
+    """Memória e tempos de consulta para `n` movimentos sintéticos."""
+    import random
+    import tracemalloc
+
+    rnd = random.Random(1)
+    today = date.today().toordinal()
+    cats = ["refeição", "compras", "transporte", "agua", "luz", "extra", "divida", "transfer", None]
+    rows = [
+        (i, date.fromordinal(today - rnd.randint(0, 3 * 365)).isoformat(),
+         "income" if rnd.random() < 0.2 else "expense", rnd.randint(1_000, 500_000),
+         rnd.randint(1, 2), rnd.choice(cats), f"compra {rnd.randint(1, 500)}")
+        for i in range(1, n + 1)
+    ]
+    tracemalloc.start()
+    led = UserLedger()
+    t0 = time.perf_counter()
+    led.load(rows)
+    load_s = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    first_month = date.today().replace(day=1)
+    year_ago = date.fromordinal(today - 365)
+    timings = {}
+    for name, fn in [
+        ("totals (mês)", lambda: led.totals(since=first_month)),
+        ("totals (tudo)", lambda: led.totals()),
+        ("by_category (mês)", lambda: led.by_category(since=first_month)),
+        ("by_day (30 dias)", lambda: led.by_day(since=date.fromordinal(today - 29))),
+        ("by_month (12 meses)", lambda: led.by_month(since=year_ago)),
+    ]:
+        t0 = time.perf_counter()
+        for _ in range(20):
+            fn()
+        timings[name] = (time.perf_counter() - t0) / 20
+
+    scale = 100_000 / n
+    print(f"NumPy: {'sim' if numpy() is not None else 'não'}")
+    print(f"Movimentos: {n}; carga {load_s * 1000:.0f} ms")
+    print(f"Memória das colunas: {led.nbytes() * scale / 1024 / 1024:.2f} MB por 100k movimentos")
+    print(f"Pico durante a carga (tracemalloc): {peak * scale / 1024 / 1024:.2f} MB por 100k")
+    for name, secs in timings.items():
+        print(f"  {name:<22} {secs * 1000:8.3f} ms")
+
+
+if __name__ == "__main__":
+    _benchmark()
@@ -0,0 +1,67 @@
+"""Atualizações do dashboard por polling curto, pela data_version.
+
+A página guarda a data_version com que foi desenhada e pergunta de tempos
+a tempos se mudou (`/dashboard/live?v=<versão>`):
+
+- igual: 204 sem corpo. É uma query (a linha do utilizador) e o pedido
+  acaba logo, por isso os clientes parados não seguram threads do worker;
+- diferente: um delta contra o snapshot da versão do cliente, se este
+  worker ainda o tiver (saldos, KPIs do mês, categorias, dias e meses dos
+  gráficos, só as entradas que mudaram); senão o snapshot completo, com
+  `full` — o cliente apaga o que não vier nele.
+
+A versão vem sempre do cliente: uma escrita entre o render da página e o
+primeiro pedido também é enviada.
+"""
+import threading
+from collections import OrderedDict
+
+
+class SnapshotCache:
+    """Último snapshot enviado por utilizador (LRU), partilhado pelas threads do worker."""
+
+    def __init__(self, snapshot, max_users=1024):
+        self.snapshot = snapshot  # (user_id, version) -> dict
+        self.max_users = max_users
+        self._last = OrderedDict()  # user_id -> (version, snapshot)
+        self._lock = threading.Lock()
+
+    def changes(self, user_id, since, version):
+        """O que mudou entre a versão `since` (a do cliente) e `version`."""
+        with self._lock:
+            last = self._last.get(user_id)
+        snap = self.snapshot(user_id, version)
+        with self._lock:
+            self._last[user_id] = (version, snap)
+            self._last.move_to_end(user_id)
+            while len(self._last) > self.max_users:
+                self._last.popitem(last=False)
+        if last is not None and last[0] == since:
+            delta = _diff(last[1], snap)
+        else:
+            delta = dict(snap, full=True)
+        delta["version"] = version
+        return delta
+
+    def forget(self, user_id=None):
+        with self._lock:
+            if user_id is None:
+                self._last.clear()
+            else:
+                self._last.pop(user_id, None)
+
+
+def _diff(old, new):
+    """Só o que mudou. Nos dicionários (categorias, dias, ...) só as entradas
+    alteradas; as que desapareceram vão a None."""
+    delta = {}
+    for key, value in new.items():
+        before = old.get(key)
+        if isinstance(value, dict) and isinstance(before, dict):
+            changed = {k: v for k, v in value.items() if before.get(k) != v}
+            changed.update({k: None for k in before if k not in value})
+            if changed:
+                delta[key] = changed
+        elif before != value:
+            delta[key] = value
+    return delta
@@ -0,0 +1,377 @@
+"""Teste de carga que reproduz o deployment do Procfile (gunicorn, 2 workers x 8 threads).
+
+Cria uma BD temporária com utilizadores sintéticos, arranca o gunicorn
+localmente contra essa BD e corre vários clientes em paralelo, cada um
+autenticado como um utilizador, a repetir uma mistura configurável de rotas
+de leitura e escrita. No fim mostra throughput, latências p50/p95/p99 por
+rota, taxa de erros e falhas de lock do SQLite, para comparar configurações
+de workers/threads ou alterações no armazenamento.
+
+Exemplos:
+
+    python loadtest.py
+    python loadtest.py --workers 4 --threads 4 --duration 60 --clients 48
+    python loadtest.py --mix "dashboard=50,transactions=30,new=20"
+    python loadtest.py --url http://127.0.0.1:5000   # servidor já a correr
+
+Só usa a biblioteca standard (mais o gunicorn, já no requirements.txt).
+"""
+import argparse
+import os
+import random
+import re
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+from datetime import date, timedelta
+from http.cookiejar import CookieJar
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_MIX = "dashboard=35,transactions=25,new=15,transfer=5,salary_split=5,export=5,report=10"
+CATEGORIAS = ["refeição", "compras", "transporte", "agua", "luz", "extra", "divida", "saude"]
+PASSWORD = "loadtest"
+
+# quantas linhas em transactions cada escrita bem sucedida cria
+ROWS_PER_WRITE = {"new": 1, "transfer": 2, "salary_split": 3}
+LOCK_RE = re.compile(r"database is (locked|busy)")
+
+
+# ---------------------- Seed ----------------------
+
+def seed_database(db_path, users, rows_per_user):
+    """BD nova com `users` utilizadores, cada um com 2 contas e histórico de ~1 ano."""
+    os.environ["FINTRACK_DB"] = db_path
+    sys.path.insert(0, HERE)
+    import app as fintrack
+    from werkzeug.security import generate_password_hash
+
+    fintrack.app.config["DB_PATH"] = db_path
+    fintrack.init_db()
+
+    # um hash partilhado: o custo do scrypt não interessa aqui
+    senha = generate_password_hash(PASSWORD)
+    conn = sqlite3.connect(db_path)
+    cur = conn.cursor()
+    rnd = random.Random(42)
+    today = date.today()
+    emails = []
+    for n in range(users):
+        email = f"load{n}@fintrack.test"
+        cur.execute(
+            "INSERT INTO users (nome, email, senha, role, status) VALUES (?,?,?,?,?)",
+            (f"Load {n}", email, senha, "user", "ativo"),
+        )
+        uid = cur.lastrowid
+        acc_ids = []
+        for nome, banco, tipo in [("Poupança", "BCI", "poupanca"), ("Despesas", "BIM", "despesas")]:
+            cur.execute(
+                "INSERT INTO accounts (user_id, nome, banco, tipo, saldo) VALUES (?,?,?,?,0)",
+                (uid, nome, banco, tipo),
+            )
+            acc_ids.append(cur.lastrowid)
+        rows = []
+        for _ in range(rows_per_user):
+            d = today - timedelta(days=rnd.randint(0, 365))
+            tipo = "income" if rnd.random() < 0.2 else "expense"
+            rows.append((
+                uid, rnd.choice(acc_ids), d.isoformat(), tipo,
+                rnd.randint(5_000, 500_000 if tipo == "income" else 80_000),  # cêntimos
+                f"mov {rnd.randint(1, 200)}", rnd.choice(CATEGORIAS),
+            ))
+        cur.executemany(
+            "INSERT INTO transactions (user_id, account_id, data, tipo, valor, descricao, categoria) VALUES (?,?,?,?,?,?,?)",
+            rows,
+        )
+        emails.append(email)
+    for uid in range(1, users + 2):
+        fintrack.recalc_balances(cur, uid)
+    conn.commit()
+    conn.close()
+    return emails
+
+
+# ---------------------- Servidor ----------------------
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_gunicorn(db_path, workers, threads, log_path):
+    port = free_port()
+    env = dict(os.environ, FINTRACK_DB=db_path, FINTRACK_JINJA_CACHE=os.path.join(os.path.dirname(db_path), "jinja"))
+    cmd = [
+        sys.executable, "-m", "gunicorn", "run:app",
+        "-b", f"127.0.0.1:{port}",
+        "--workers", str(workers), "--threads", str(threads), "--timeout", "120",
+    ]
+    log = open(log_path, "w")
+    proc = subprocess.Popen(cmd, cwd=HERE, env=env, stdout=log, stderr=subprocess.STDOUT)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"gunicorn terminou logo no arranque (ver {log_path})")
+        try:
+            urllib.request.urlopen(url + "/login", timeout=1).read()
+            return proc, url
+        except (urllib.error.URLError, ConnectionError, socket.timeout):
+            time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError("gunicorn não ficou pronto em 30s")
+
+
+# ---------------------- Clientes ----------------------
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class Client:
+    """Um utilizador autenticado (cookie de sessão próprio)."""
+
+    def __init__(self, base_url, email):
+        self.base = base_url
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(CookieJar()), _NoRedirect()
+        )
+        status, _ = self.request("POST", "/login", {"email": email, "senha": PASSWORD})
+        if status != 302:
+            raise RuntimeError(f"login falhou para {email} (HTTP {status})")
+        self.accounts = self._account_ids()
+
+    def request(self, method, path, form=None):
+        data = urllib.parse.urlencode(form).encode() if form is not None else None
+        req = urllib.request.Request(self.base + path, data=data, method=method)
+        try:
+            with self.opener.open(req, timeout=60) as resp:
+                body = resp.read()
+                return resp.status, body
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+    def _account_ids(self):
+        _, body = self.request("GET", "/transactions/new")
+        ids = sorted({int(x) for x in re.findall(rb'<option value="(\d+)">', body)})
+        return ids or [1, 2]
+
+
+def build_actions(rnd, client):
+    """Cada acção devolve (rota, método, path, form)."""
+    today = date.today()
+
+    def dashboard():
+        return "GET /dashboard", "GET", "/dashboard", None
+
+    def transactions():
+        params = {}
+        if rnd.random() < 0.5:
+            params["from"] = (today - timedelta(days=rnd.choice([7, 30, 90]))).isoformat()
+        if rnd.random() < 0.3:
+            params["tipo"] = rnd.choice(["income", "expense"])
+        if rnd.random() < 0.3:
+            params["categoria"] = rnd.choice(CATEGORIAS)[:4]
+        if rnd.random() < 0.2:
+            params["q"] = "mov 1"
+        if rnd.random() < 0.2:
+            params["account_id"] = rnd.choice(client.accounts)
+        qs = ("?" + urllib.parse.urlencode(params)) if params else ""
+        return "GET /transactions", "GET", "/transactions" + qs, None
+
+    def new():
+        return "POST /transactions/new", "POST", "/transactions/new", {
+            "tipo": rnd.choice(["income", "expense", "expense"]),
+            "account_id": rnd.choice(client.accounts),
+            "valor": f"{rnd.uniform(10, 500):.2f}",
+            "descricao": f"load {rnd.randint(1, 50)}",
+            "categoria": rnd.choice(CATEGORIAS),
+        }
+
+    def transfer():
+        a, b = (client.accounts + client.accounts)[:2]
+        return "POST /transfer", "POST", "/transfer", {
+            "from_account": a, "to_account": b, "valor": f"{rnd.uniform(10, 200):.2f}",
+        }
+
+    def salary_split():
+        return "POST /salary_split", "POST", "/salary_split", {
+            "valor_total": f"{rnd.uniform(20000, 60000):.2f}", "pct_poupanca": "40",
+        }
+
+    def export():
+        return "GET /transactions/export", "GET", "/transactions/export", None
+
+    def report():
+        return "GET /report", "GET", "/report", None
+
+    return {
+        "dashboard": dashboard, "transactions": transactions, "new": new, "transfer": transfer,
+        "salary_split": salary_split, "export": export, "report": report,
+    }
+
+
+def parse_mix(spec):
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.ok_writes = defaultdict(int)
+
+    def record(self, route, kind, status, elapsed):
+        with self.lock:
+            self.latencies[route].append(elapsed)
+            # writes acabam em redirect (302); leituras em 200
+            if status not in (200, 302):
+                self.errors[route] += 1
+            elif kind in ROWS_PER_WRITE:
+                self.ok_writes[kind] += 1
+
+
+def run_client(base_url, email, mix, deadline, stats, seed):
+    rnd = random.Random(seed)
+    try:
+        client = Client(base_url, email)
+    except Exception as e:
+        with stats.lock:
+            stats.errors["login"] += 1
+        print(f"[cliente {email}] {e}", file=sys.stderr)
+        return
+    actions = build_actions(rnd, client)
+    names = [n for n in mix if n in actions]
+    weights = [mix[n] for n in names]
+    while time.time() < deadline:
+        kind = rnd.choices(names, weights)[0]
+        route, method, path, form = actions[kind]()
+        t0 = time.perf_counter()
+        try:
+            status, _ = client.request(method, path, form)
+        except Exception:
+            status = 0
+        stats.record(route, kind, status, time.perf_counter() - t0)
+
+
+def percentile(sorted_vals, pct):
+    if not sorted_vals:
+        return 0.0
+    k = max(0, min(len(sorted_vals) - 1, int(round(pct / 100.0 * len(sorted_vals) + 0.5)) - 1))
+    return sorted_vals[k]
+
+
+def report(stats, elapsed, lock_errors, lost_writes):
+    total = sum(len(v) for v in stats.latencies.values())
+    errors = sum(stats.errors.values())
+    print()
+    print(f"Pedidos: {total} em {elapsed:.1f}s -> {total / elapsed:.1f} req/s; erros: {errors} ({errors * 100.0 / max(total, 1):.2f}%)")
+    print()
+    print(f"{'rota':<28}{'n':>7}{'req/s':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'erros':>7}")
+    for route in sorted(stats.latencies):
+        vals = sorted(stats.latencies[route])
+        print(
+            f"{route:<28}{len(vals):>7}{len(vals) / elapsed:>8.1f}"
+            f"{percentile(vals, 50) * 1000:>9.1f}{percentile(vals, 95) * 1000:>9.1f}{percentile(vals, 99) * 1000:>9.1f}"
+            f"{stats.errors.get(route, 0):>7}"
+        )
+    print()
+    print(f"Falhas SQLite busy/locked no log do servidor: {lock_errors}")
+    if lost_writes is not None:
+        print(f"Escritas com resposta OK mas sem linhas gravadas (erros engolidos pela rota): {lost_writes}")
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    p.add_argument("--url", help="servidor já a correr (não arranca gunicorn nem cria BD)")
+    p.add_argument("--emails", help="com --url: lista de emails (password 'loadtest'), separados por vírgula")
+    p.add_argument("--workers", type=int, default=2)
+    p.add_argument("--threads", type=int, default=8)
+    p.add_argument("--users", type=int, default=20, help="utilizadores sintéticos na BD")
+    p.add_argument("--rows", type=int, default=2000, help="movimentos por utilizador no seed")
+    p.add_argument("--clients", type=int, default=32, help="clientes concorrentes")
+    p.add_argument("--duration", type=float, default=30.0, help="segundos de carga")
+    p.add_argument("--mix", default=DEFAULT_MIX, help=f"pesos por acção (default: {DEFAULT_MIX})")
+    p.add_argument("--keep", action="store_true", help="não apagar a pasta temporária no fim")
+    args = p.parse_args(argv)
+
+    mix = parse_mix(args.mix)
+    workdir = tempfile.mkdtemp(prefix="fintrack-load-")
+    db_path = os.path.join(workdir, "load.db")
+    log_path = os.path.join(workdir, "gunicorn.log")
+    proc = None
+    try:
+        if args.url:
+            base_url = args.url.rstrip("/")
+            emails = (args.emails or "admin@demo.mz").split(",")
+        else:
+            t0 = time.perf_counter()
+            emails = seed_database(db_path, args.users, args.rows)
+            print(f"Seed: {args.users} utilizadores x {args.rows} movimentos em {time.perf_counter() - t0:.1f}s")
+            proc, base_url = start_gunicorn(db_path, args.workers, args.threads, log_path)
+            print(f"gunicorn em {base_url} ({args.workers} workers x {args.threads} threads)")
+
+        rows_before = _count_rows(db_path) if not args.url else None
+        stats = Stats()
+        deadline = time.time() + args.duration
+        threads = [
+            threading.Thread(
+                target=run_client,
+                args=(base_url, emails[i % len(emails)], mix, deadline, stats, i),
+                daemon=True,
+            )
+            for i in range(args.clients)
+        ]
+        t0 = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - t0
+
+        lock_errors = 0
+        lost = None
+        if proc is not None:
+            proc.terminate()
+            proc.wait(timeout=30)
+            proc = None
+            with open(log_path, encoding="utf-8", errors="replace") as fh:
+                lock_errors = len(LOCK_RE.findall(fh.read()))
+            expected = sum(ROWS_PER_WRITE[k] * n for k, n in stats.ok_writes.items())
+            lost = max(0, expected - (_count_rows(db_path) - rows_before))
+        report(stats, elapsed, lock_errors, lost)
+    finally:
+        if proc is not None:
+            proc.terminate()
+        if args.keep:
+            print(f"Ficheiros em {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _count_rows(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute("SELECT COUNT(*) FROM transactions").fetchone()[0]
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
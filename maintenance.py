@@ -0,0 +1,159 @@
+"""Manutenção do armazenamento SQLite: estatísticas, vacuum incremental e checkpoints.
+
+- ``PRAGMA optimize`` (com analysis_limit) corre de forma barata e periódica;
+  ``ANALYZE`` completo fica para a ronda seguinte a importações grandes (as
+  linhas escritas em lote somam-se num contador partilhado pelos workers).
+- Com ``auto_vacuum=INCREMENTAL`` as páginas livres ficam na freelist até
+  ``PRAGMA incremental_vacuum(N)``; aqui libertamos no máximo N páginas por
+  ronda, para que cada passo seja curto. Numa BD que já tinha tabelas o modo
+  só muda com um VACUUM completo, uma vez e à mão (``flask vacuum``): bloqueia
+  as escritas de todos os workers enquanto corre.
+- O checkpoint do WAL é PASSIVE (não espera por leitores) e, quando a app
+  está parada, TRUNCATE para encolher o ficheiro -wal.
+"""
+import logging
+import os
+import sqlite3
+import time
+
+from jobs import file_lock
+
+# acima disto (somado entre pedidos), as escritas em lote justificam um ANALYZE completo
+BULK_ANALYZE_ROWS = 5000
+
+
+def _add_bulk_rows(db_path, delta):
+    """Soma `delta` ao contador de linhas em lote (ficheiro ao lado da BD); devolve o total."""
+    path = os.path.join(os.path.dirname(db_path) or ".", ".bulk-rows")
+    with file_lock(path + ".lock"):
+        open(path, "a").close()
+        with open(path, "r+") as fh:
+            try:
+                total = int(fh.read() or 0)
+            except ValueError:
+                total = 0
+            total = max(total + delta, 0)
+            if delta:
+                # largura fixa: reescreve no lugar, sem truncar o ficheiro
+                fh.seek(0)
+                fh.write(f"{total:20d}")
+    return total
+
+
+def storage_stats(conn, db_path):
+    """Páginas, freelist e fragmentação (por tabela quando o dbstat existe)."""
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+    freelist = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    auto_vacuum = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+    journal_mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+
+    wal_path = db_path + "-wal"
+    stats = {
+        "page_size": page_size,
+        "page_count": page_count,
+        "freelist_count": freelist,
+        "freelist_pct": round(freelist * 100.0 / page_count, 2) if page_count else 0.0,
+        "db_bytes": page_size * page_count,
+        "wal_bytes": os.path.getsize(wal_path) if os.path.exists(wal_path) else 0,
+        "auto_vacuum": {0: "none", 1: "full", 2: "incremental"}.get(auto_vacuum, auto_vacuum),
+        "vacuum_pending": auto_vacuum != 2,
+        "journal_mode": journal_mode,
+        "tables": None,
+    }
+
+    # dbstat só existe se o SQLite foi compilado com SQLITE_ENABLE_DBSTAT_VTAB
+    try:
+        rows = conn.execute(
+            """
+            SELECT name, COUNT(*) AS pages, SUM(unused) AS unused, SUM(pgsize) AS bytes
+            FROM dbstat
+            GROUP BY name
+            ORDER BY bytes DESC
+            """
+        ).fetchall()
+    except sqlite3.OperationalError:
+        rows = []
+    if rows:
+        stats["tables"] = [
+            {
+                "name": r[0],
+                "pages": r[1],
+                "bytes": r[3],
+                # % de bytes não usados dentro das páginas da tabela/índice
+                "fragmentation_pct": round((r[2] or 0) * 100.0 / r[3], 2) if r[3] else 0.0,
+            }
+            for r in rows
+        ]
+    return stats
+
+
+def vacuum_pending(conn):
+    """True enquanto falta o VACUUM único que passa a BD a auto_vacuum=INCREMENTAL."""
+    return conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2
+
+
+def full_vacuum(db_path):
+    """O VACUUM único (só pela CLI `flask vacuum`: reescreve o ficheiro todo e
+    bloqueia as escritas de todos os workers enquanto corre). Devolve quanto demorou."""
+    t0 = time.perf_counter()
+    conn = sqlite3.connect(db_path, isolation_level=None, timeout=30)
+    try:
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+    finally:
+        conn.close()
+    duration = time.perf_counter() - t0
+    logging.info("VACUUM completo (auto_vacuum=INCREMENTAL) em %.2fs", duration)
+    return duration
+
+
+def run_maintenance(db_path, analyze=False, vacuum_pages=256, idle=False):
+    """Uma ronda de manutenção. Devolve o que foi feito e quanto demorou."""
+    t0 = time.perf_counter()
+    bulk_rows = _add_bulk_rows(db_path, 0)
+    analyze = analyze or bulk_rows >= BULK_ANALYZE_ROWS
+    conn = sqlite3.connect(db_path, isolation_level=None, timeout=30)
+    try:
+        vacuum = vacuum_pending(conn)
+        if vacuum:
+            logging.warning("VACUUM pendente (auto_vacuum=INCREMENTAL): corre `flask vacuum`.")
+        free_before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+        if analyze:
+            conn.execute("ANALYZE")
+            _add_bulk_rows(db_path, -bulk_rows)
+        else:
+            conn.execute("PRAGMA analysis_limit=400")
+            conn.execute("PRAGMA optimize")
+
+        vacuumed = 0
+        if vacuum_pages and free_before:
+            # executescript corre o pragma até ao fim (execute() só dá um passo = 1 página)
+            conn.executescript(f"PRAGMA incremental_vacuum({int(vacuum_pages)});")
+            vacuumed = free_before - conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+        mode = "TRUNCATE" if idle else "PASSIVE"
+        busy, wal_frames, checkpointed = conn.execute(f"PRAGMA wal_checkpoint({mode})").fetchone()
+    finally:
+        conn.close()
+
+    result = {
+        "analyze": "full" if analyze else "optimize",
+        "bulk_rows": bulk_rows,
+        "vacuumed_pages": vacuumed,
+        "vacuum_pending": vacuum,
+        "checkpoint": {"mode": mode, "busy": busy, "wal_frames": wal_frames, "checkpointed": checkpointed},
+        "duration_s": time.perf_counter() - t0,
+    }
+    logging.info(
+        "Manutenção: %s, %s páginas libertadas, checkpoint %s (%s/%s) em %.2fs",
+        result["analyze"], vacuumed, mode, checkpointed, wal_frames, result["duration_s"],
+    )
+    return result
+
+
+def after_bulk_write(db_path, rows):
+    """Chamar depois de importações/lotes: conta as linhas escritas. Não corre nada
+    no pedido; a próxima ronda de manutenção faz o ANALYZE se o total o justificar."""
+    return _add_bulk_rows(db_path, rows)
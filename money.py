@@ -0,0 +1,85 @@
+"""Valores monetários em unidades menores (cêntimos) inteiras.
+
+Na BD (valor, saldo, valor_total, valor_pago, limite, gasto) e em todo o
+código os valores são `int` em cêntimos: somas e comparações são exatas e
+não há epsilons nem round(..., 2) espalhados. Só se passa a unidades
+(float) na fronteira: JSON, gráficos e CSV. Conversões de moeda e
+percentagens arredondam ao cêntimo com `scale`.
+"""
+from decimal import ROUND_HALF_UP, Decimal, InvalidOperation
+
+SCALE = 100
+
+
+def parse(value):
+    """'1 234,5' / '12.50' / 12.5 -> cêntimos (int). ValueError se não for número."""
+    if isinstance(value, bool):  # bool é int: True não são 100 cêntimos
+        raise ValueError(f"Valor inválido: {value!r}")
+    if isinstance(value, int):
+        return value * SCALE
+    text = str(value).strip().replace(" ", "").replace(",", ".")
+    try:
+        amount = Decimal(text)
+    except InvalidOperation:
+        raise ValueError(f"Valor inválido: {value!r}") from None
+    if not amount.is_finite():
+        raise ValueError(f"Valor inválido: {value!r}")
+    return int((amount * SCALE).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def scale(cents, factor):
+    """cêntimos * factor (taxa de câmbio, percentagem), arredondado ao cêntimo."""
+    return int(Decimal(repr(cents * factor)).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def units(cents):
+    """Cêntimos -> unidades (float), para JSON e gráficos."""
+    return (cents or 0) / SCALE
+
+
+def fmt(cents):
+    """1234567 -> '12345.67' (aceita floats vindos de conversões: arredonda primeiro)."""
+    cents = int(round(cents or 0))
+    sign = "-" if cents < 0 else ""
+    whole, frac = divmod(abs(cents), SCALE)
+    return f"{sign}{whole}.{frac:02d}"
+
+
+def _benchmark(n=500_000):
+    """SUM/GROUP BY em SQLite: coluna REAL (unidades) vs INTEGER (cêntimos)."""
+    import random
+    import sqlite3
+    import time
+
+    rnd = random.Random(1)
+    cents = [rnd.randint(1_000, 500_000) for _ in range(n)]
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE t_real (user_id INTEGER, categoria TEXT, valor REAL)")
+    conn.execute("CREATE TABLE t_int (user_id INTEGER, categoria TEXT, valor INTEGER)")
+    cats = ["refeição", "compras", "transporte", "agua", "luz", "extra"]
+    rows = [(i % 50, cats[i % len(cats)], c) for i, c in enumerate(cents)]
+    conn.executemany("INSERT INTO t_real VALUES (?,?,?)", ((u, k, c / SCALE) for u, k, c in rows))
+    conn.executemany("INSERT INTO t_int VALUES (?,?,?)", rows)
+
+    exact = sum(cents)
+    print(f"Movimentos: {n}")
+    for table in ("t_real", "t_int"):
+        for label, sql in [
+            ("SUM", f"SELECT SUM(valor) FROM {table}"),
+            ("GROUP BY", f"SELECT user_id, categoria, SUM(valor) FROM {table} GROUP BY user_id, categoria"),
+        ]:
+            t0 = time.perf_counter()
+            for _ in range(10):
+                result = conn.execute(sql).fetchall()
+            ms = (time.perf_counter() - t0) / 10 * 1000
+            line = f"  {table:7s} {label:9s} {ms:7.1f} ms ({n / ms / 1000:.1f} M linhas/s)"
+            if label == "SUM":
+                total = result[0][0]
+                err = abs(total * SCALE - exact) if table == "t_real" else abs(total - exact)
+                line += f"  erro vs. soma exata: {err:.6f} cêntimos"
+            print(line)
+    conn.close()
+
+
+if __name__ == "__main__":
+    _benchmark()
@@ -0,0 +1,127 @@
+"""Pool de ligações só de leitura (mode=ro) e leituras de uma view em paralelo.
+
+Em WAL os leitores não se bloqueiam uns aos outros nem ao writer, e o
+sqlite3 larga o GIL enquanto a query corre, por isso as leituras
+independentes de uma página (contas, resumo das dívidas, carga do ledger,
+últimos movimentos) podem correr ao mesmo tempo, cada uma na sua ligação.
+A latência passa a ser a da mais lenta em vez da soma.
+
+Cada tarefa abre uma transação de leitura e começa por ler um "token"
+(ex.: users.data_version e o estado de cada tabela que as tarefas leem).
+Se os tokens não baterem certo — houve uma escrita a meio — as tarefas
+voltam a correr em série numa só transação, que é consistente por construção. Com `size=0` é sempre esse o caminho.
+
+As ligações e as threads são criadas à primeira utilização em cada
+processo (os workers do gunicorn fazem fork depois do import).
+"""
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ReadPool:
+    """`connect()` devolve uma ligação só de leitura que pode mudar de thread."""
+
+    def __init__(self, connect, size=4):
+        self.connect = connect
+        self.size = size
+        self._pid = None
+        self._idle = None
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _ensure(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # fork: as ligações/threads herdadas pertencem ao processo pai
+                self._pid = os.getpid()
+                self._idle = queue.LifoQueue()
+                self._executor = ThreadPoolExecutor(max(self.size, 1), thread_name_prefix="readpool")
+
+    def acquire(self):
+        self._ensure()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self.connect()
+
+    def release(self, conn):
+        conn.set_trace_callback(None)
+        if self._idle.qsize() < max(self.size, 1):
+            self._idle.put(conn)
+        else:
+            conn.close()
+
+    def close(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                while not self._idle.empty():
+                    self._idle.get_nowait().close()
+                self._executor.shutdown(wait=False)
+            self._pid = None
+
+    def gather(self, tasks, token_sql, token_params=(), trace=None):
+        """Corre `tasks` = {nome: fn(conn, token)} e devolve (resultados, token, tempos).
+
+        `token_sql` devolve uma linha que identifica o estado dos dados (ex.: a
+        do utilizador, com a data_version); cada tarefa recebe-a. Tempos em
+        ms: um por tarefa, 'total' (parede) e 'serial' (se houve repetição).
+        """
+        t0 = time.perf_counter()
+        timings = {}
+        results = token = None
+        if self.size > 0 and len(tasks) > 1:
+            self._ensure()
+            futures = {
+                name: self._executor.submit(self._run_one, fn, token_sql, token_params, trace)
+                for name, fn in tasks.items()
+            }
+            outcomes = {name: fut.result() for name, fut in futures.items()}
+            tokens = {tuple(t) if t is not None else None for t, _, _ in outcomes.values()}
+            if len(tokens) == 1:
+                token = next(iter(outcomes.values()))[0]
+                results = {name: value for name, (_, value, _) in outcomes.items()}
+                timings = {name: ms for name, (_, _, ms) in outcomes.items()}
+        if results is None:
+            ts = time.perf_counter()
+            results, token = self._run_serial(tasks, token_sql, token_params, trace, timings)
+            timings["serial"] = (time.perf_counter() - ts) * 1000
+        timings["total"] = (time.perf_counter() - t0) * 1000
+        return results, token, timings
+
+    def _run_one(self, fn, token_sql, token_params, trace):
+        t0 = time.perf_counter()
+        conn = self.acquire()
+        try:
+            if trace is not None:
+                conn.set_trace_callback(trace)
+            conn.execute("BEGIN")
+            token = conn.execute(token_sql, token_params).fetchone()
+            value = fn(conn, token)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.close()
+            raise
+        self.release(conn)
+        return token, value, (time.perf_counter() - t0) * 1000
+
+    def _run_serial(self, tasks, token_sql, token_params, trace, timings):
+        conn = self.acquire()
+        try:
+            if trace is not None:
+                conn.set_trace_callback(trace)
+            conn.execute("BEGIN")
+            token = conn.execute(token_sql, token_params).fetchone()
+            results = {}
+            for name, fn in tasks.items():
+                t0 = time.perf_counter()
+                results[name] = fn(conn, token)
+                timings[name] = (time.perf_counter() - t0) * 1000
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.close()
+            raise
+        self.release(conn)
+        return results, token
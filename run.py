@@ -0,0 +1,8 @@
+"""Entrada WSGI para o gunicorn (ver Procfile: `gunicorn run:app`)."""
+import logging
+
+from app import create_app
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(process)d] %(levelname)s %(message)s")
+
+app = create_app()
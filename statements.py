@@ -0,0 +1,171 @@
+"""Extratos do mês em lote: um PDF do relatório por utilizador activo.
+
+`collect` junta o que o relatório precisa para todos os utilizadores em
+poucas queries agrupadas por user_id (em vez de ~8 por utilizador pelo
+ledger e pelas rotas). `run_batch` renderiza o HTML num pool de processos
+(Jinja é CPU puro) e converte para PDF com no máximo `pdf_jobs` wkhtmltopdf
+em simultâneo.
+
+Cada ficheiro é escrito em <saída>/<user_id>/relatorio_<AAAA-MM>.<ext>
+através de um `.part` + rename, por isso voltar a correr o comando depois de
+uma interrupção salta os que já existem.
+"""
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from datetime import date
+
+
+def available_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # Windows/macOS
+        return os.cpu_count() or 1
+
+
+def output_path(out_dir, user_id, mes, ext="pdf"):
+    return os.path.join(out_dir, str(user_id), f"relatorio_{mes}.{ext}")
+
+
+def _day(dia):
+    return date.fromisoformat(dia).toordinal() if dia else None
+
+
+def collect(conn, rates, target, since, user_ids=None):
+    """{user_id: dados} com contas, dívidas, totais, categorias do mês e últimos 60 movimentos.
+
+    Valores em `target` (convertidos à taxa do dia, como o ledger), excepto os
+    saldos das contas e as linhas, que ficam na moeda da conta.
+    """
+    users_where = "status='ativo'"
+    params = []
+    if user_ids:
+        users_where += f" AND id IN ({','.join('?' * len(user_ids))})"
+        params = list(user_ids)
+    users_sql = f"SELECT id FROM users WHERE {users_where}"
+
+    out = {
+        r[0]: {
+            "nome": r[1],
+            "data_version": r[2],
+            "contas": [],
+            "aberto": 0,
+            "total_in_all": 0,
+            "total_out_all": 0,
+            "month_in": 0,
+            "month_out": 0,
+            "cats": {},
+            "rows": [],
+        }
+        for r in conn.execute(f"SELECT id, nome, data_version FROM users WHERE {users_where} ORDER BY id", params)
+    }
+
+    for r in conn.execute(f"SELECT * FROM accounts WHERE user_id IN ({users_sql}) ORDER BY user_id, tipo", params):
+        out[r["user_id"]]["contas"].append(dict(r))
+
+    # resumo pré-calculado (installments.refresh); sem linha = sem dívidas pendentes
+    for uid, aberto in conn.execute(
+        f"SELECT user_id, aberto FROM debt_summary WHERE user_id IN ({users_sql})", params
+    ):
+        out[uid]["aberto"] = aberto or 0
+
+    # totais (histórico e mês) e despesas por categoria no mês, numa só passagem:
+    # somas por (moeda, dia) para converter à taxa certa sem ir linha a linha
+    since_iso = since.isoformat()
+    for uid, moeda, dia, entrada, categoria, valor in conn.execute(
+        f"""
+        SELECT t.user_id, a.moeda, date(t.data) AS dia, t.tipo = 'income' AS entrada,
+               CASE WHEN date(t.data) >= ? AND t.tipo <> 'income' THEN t.categoria END AS cat_mes,
+               SUM(t.valor)
+        FROM transactions t
+        JOIN accounts a ON a.id = t.account_id
+        WHERE (t.categoria IS NULL OR LOWER(t.categoria) <> 'transfer')
+          AND t.user_id IN ({users_sql})
+        GROUP BY t.user_id, a.moeda, dia, entrada, cat_mes
+        """,
+        [since_iso, *params],
+    ):
+        u = out[uid]
+        valor = valor or 0
+        if moeda != target:
+            valor = rates.convert(valor, moeda, target, _day(dia))
+        u["total_in_all" if entrada else "total_out_all"] += valor
+        if dia is not None and dia >= since_iso:
+            u["month_in" if entrada else "month_out"] += valor
+            if not entrada:
+                cat = categoria.lower() if categoria is not None else "(sem)"
+                u["cats"][cat] = u["cats"].get(cat, 0) + valor
+
+    for r in conn.execute(
+        f"""
+        SELECT user_id, data, conta, tipo, valor, moeda, descricao, categoria FROM (
+            SELECT t.user_id, t.data, a.nome AS conta, t.tipo, t.valor, a.moeda, t.descricao, t.categoria,
+                   ROW_NUMBER() OVER (PARTITION BY t.user_id ORDER BY date(t.data) DESC, t.id DESC) AS n
+            FROM transactions t
+            JOIN accounts a ON a.id = t.account_id
+            WHERE t.user_id IN ({users_sql})
+        )
+        WHERE n <= 60
+        ORDER BY user_id, n
+        """,
+        params,
+    ):
+        row = dict(r)
+        out[row.pop("user_id")]["rows"].append(row)
+
+    return out
+
+
+def write_html(html, path):
+    with open(path, "w", encoding="utf-8") as fh:
+        fh.write(html)
+
+
+def _write(convert, html, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".part"
+    convert(html, tmp)
+    os.replace(tmp, path)
+
+
+def run_batch(items, render, convert, render_procs, pdf_jobs, echo=print):
+    """Gera os ficheiros de `items` = [(user_id, path, ctx)].
+
+    `render(user_id, ctx) -> html` corre num processo do pool (tem de ser
+    uma função de módulo); `convert(html, path)` corre numa thread, no máximo
+    `pdf_jobs` ao mesmo tempo. Devolve (feitos, falhas).
+    """
+    total = len(items)
+    done = failed = 0
+    t0 = time.perf_counter()
+
+    def report(uid, error=None):
+        nonlocal done, failed
+        if error is None:
+            done += 1
+        else:
+            failed += 1
+        n = done + failed
+        eta = (time.perf_counter() - t0) / n * (total - n)
+        status = "ok" if error is None else f"ERRO: {error}"
+        echo(f"[{n}/{total}] utilizador {uid}: {status} (faltam ~{eta:.0f}s)")
+
+    with ProcessPoolExecutor(render_procs) as procs, ThreadPoolExecutor(pdf_jobs) as pdfs:
+        rendering = {procs.submit(render, uid, ctx): (uid, path) for uid, path, ctx in items}
+        converting = {}
+        for fut in as_completed(rendering):
+            uid, path = rendering[fut]
+            try:
+                html = fut.result()
+            except Exception as e:
+                report(uid, e)
+                continue
+            converting[pdfs.submit(_write, convert, html, path)] = uid
+        for fut in as_completed(converting):
+            try:
+                fut.result()
+            except Exception as e:
+                report(converting[fut], e)
+            else:
+                report(converting[fut])
+    return done, failed
@@ -0,0 +1,198 @@
+"""Autocomplete de categorias e descrições: índice de prefixos em memória, por utilizador.
+
+Cada campo é uma lista ordenada de chaves normalizadas (minúsculas, sem
+acentos, para "refeicao" encontrar "refeição") e uma pesquisa é um bisect
+até ao fim do prefixo, ordenado por nº de usos. Não toca na BD.
+
+O índice de um utilizador é construído na primeira pesquisa (duas queries
+GROUP BY). Escritas neste worker atualizam-no no sítio (`record`); as de
+outros workers entram quando a data_version muda, lendo só os movimentos
+com id acima do último visto. Descrições ficam limitadas às
+`max_descriptions` mais usadas e a cache inteira a `max_bytes` (LRU).
+"""
+import threading
+import unicodedata
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from heapq import nlargest
+
+FIELDS = ("categoria", "descricao")
+
+
+def normalize(text):
+    text = unicodedata.normalize("NFKD", (text or "").strip().lower())
+    return "".join(ch for ch in text if not unicodedata.combining(ch))
+
+
+class PrefixIndex:
+    """Chaves ordenadas + {chave: [texto a mostrar, usos]}."""
+
+    def __init__(self, cap=None):
+        self.keys = []
+        self.entries = {}
+        self.cap = cap
+        self.bytes = 0  # estimativa, atualizada a cada chave que entra ou sai
+
+    def add(self, text, count=1):
+        key = normalize(text)
+        if not key:
+            return
+        entry = self.entries.get(key)
+        if entry is None:
+            # a primeira grafia vista (na carga: a mais usada) é a que se mostra
+            self.entries[key] = [text.strip(), count]
+            insort(self.keys, key)
+            self.bytes += _key_bytes(key)
+            if self.cap and len(self.keys) > self.cap:
+                self._drop_rarest(keep=key)
+        else:
+            entry[1] += count
+
+    def _drop_rarest(self, keep):
+        # raro: só quando uma descrição nova passa o limite. A nova (`keep`) fica,
+        # senão com o limite cheio nenhuma descrição nova chegava a ser sugerida
+        key = min((k for k in self.entries if k != keep), key=lambda k: self.entries[k][1])
+        del self.entries[key]
+        del self.keys[bisect_left(self.keys, key)]
+        self.bytes -= _key_bytes(key)
+
+    def search(self, prefix, limit=8):
+        p = normalize(prefix)
+        i = bisect_left(self.keys, p)
+        matches = []
+        keys = self.keys
+        while i < len(keys) and keys[i].startswith(p):
+            matches.append(keys[i])
+            i += 1
+        best = nlargest(limit, matches, key=lambda k: self.entries[k][1])
+        return [{"value": self.entries[k][0], "count": self.entries[k][1]} for k in best]
+
+    def nbytes(self):
+        return self.bytes
+
+
+def _key_bytes(key):
+    # estimativa: chave + texto + lista/entrada no dict
+    return 2 * len(key) + 120
+
+
+class UserSuggestions:
+    def __init__(self, max_descriptions):
+        self.fields = {
+            "categoria": PrefixIndex(),
+            "descricao": PrefixIndex(cap=max_descriptions),
+        }
+        self.last_id = 0
+        self.version = None
+        self.recorded = set()  # ids já contados por record() e ainda não vistos na BD
+        self.lock = threading.Lock()
+
+    def nbytes(self):
+        return sum(ix.nbytes() for ix in self.fields.values())
+
+
+class SuggestCache:
+    def __init__(self, connect, max_bytes=8 * 1024 * 1024, max_descriptions=500):
+        self.connect = connect
+        self.max_bytes = max_bytes
+        self.max_descriptions = max_descriptions
+        self._users = OrderedDict()
+        self._sizes = {}  # user_id -> bytes contados em `_bytes`
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def _load(self, user_id, s):
+        conn = self.connect()
+        try:
+            s.last_id = conn.execute(
+                "SELECT COALESCE(MAX(id), 0) FROM transactions WHERE user_id=?", (user_id,)
+            ).fetchone()[0]
+            for field, limit in (("categoria", -1), ("descricao", self.max_descriptions)):
+                rows = conn.execute(
+                    f"""
+                    SELECT {field}, COUNT(*) AS n FROM transactions
+                    WHERE user_id=? AND id<=? AND {field} IS NOT NULL AND TRIM({field}) <> ''
+                    GROUP BY {field} ORDER BY n DESC LIMIT ?
+                    """,
+                    (user_id, s.last_id, limit),
+                ).fetchall()
+                for text, n in rows:
+                    s.fields[field].add(text, n)
+        finally:
+            conn.close()
+
+    def _catch_up(self, user_id, s):
+        conn = self.connect()
+        try:
+            rows = conn.execute(
+                "SELECT id, categoria, descricao FROM transactions WHERE user_id=? AND id>? ORDER BY id",
+                (user_id, s.last_id),
+            ).fetchall()
+        finally:
+            conn.close()
+        for tx_id, categoria, descricao in rows:
+            if tx_id in s.recorded:
+                continue
+            s.fields["categoria"].add(categoria or "")
+            s.fields["descricao"].add(descricao or "")
+        if rows:
+            s.last_id = rows[-1][0]
+        s.recorded = {i for i in s.recorded if i > s.last_id}
+
+    def _get(self, user_id, version):
+        with self._lock:
+            s = self._users.get(user_id)
+            if s is None:
+                s = self._users[user_id] = UserSuggestions(self.max_descriptions)
+            self._users.move_to_end(user_id)
+        with s.lock:
+            if s.version is None:
+                self._load(user_id, s)
+            elif s.version != version:
+                self._catch_up(user_id, s)
+            s.version = version
+            self._account(user_id, s)
+        return s
+
+    def search(self, user_id, version, field, prefix, limit=8):
+        s = self._get(user_id, version)
+        with s.lock:
+            return s.fields[field].search(prefix, limit)
+
+    def record(self, user_id, tx_id, categoria, descricao):
+        """Chamado pelas escritas: conta o movimento já, sem esperar pela próxima leitura."""
+        with self._lock:
+            s = self._users.get(user_id)
+        if s is None or s.version is None:
+            return  # ainda não carregado: a carga lê-o da BD
+        with s.lock:
+            if tx_id <= s.last_id:
+                return
+            s.fields["categoria"].add(categoria or "")
+            s.fields["descricao"].add(descricao or "")
+            s.recorded.add(tx_id)
+            self._account(user_id, s)
+
+    def nbytes(self):
+        return self._bytes
+
+    def _account(self, user_id, s):
+        # chamar com s.lock: o tamanho só muda quando entram/saem chaves
+        size = s.nbytes()
+        with self._lock:
+            if self._users.get(user_id) is not s:
+                return  # despejado entretanto
+            self._bytes += size - self._sizes.get(user_id, 0)
+            self._sizes[user_id] = size
+            if self._bytes > self.max_bytes:
+                self._evict(keep=user_id)
+
+    def _evict(self, keep):
+        # chamar com self._lock
+        while self._bytes > self.max_bytes and len(self._users) > 1:
+            uid = next(iter(self._users))
+            if uid == keep:
+                self._users.move_to_end(uid)
+                continue
+            del self._users[uid]
+            self._bytes -= self._sizes.pop(uid, 0)
@@ -0,0 +1,101 @@
+"""Cache de fragmentos para os templates Jinja.
+
+Uso no template:
+
+    {% cache 'dash-highlights', data_version, mes %}
+        ... html pesado ...
+    {% endcache %}
+
+A chave inclui sempre o utilizador da sessão; os restantes argumentos (em
+regra a ``data_version`` do utilizador, que muda a cada escrita) vêm do
+template. Como a versão faz parte da chave, uma escrita noutro worker nunca
+serve um fragmento desatualizado: apenas deixa de haver hit.
+
+O limite é em bytes (FRAGMENT_CACHE_MAX_BYTES na config da app), não em nº
+de fragmentos: uma tabela de movimentos pode ter perto de 1 MB e cada
+combinação de filtros é uma entrada.
+"""
+import threading
+from collections import OrderedDict
+
+from flask import has_request_context, session
+from jinja2 import nodes
+from jinja2.ext import Extension
+
+
+class FragmentCache:
+    """LRU simples em memória (por processo), segura para threads, limitada em bytes."""
+
+    def __init__(self, max_bytes=16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()
+        self._bytes = 0  # soma de len() dos fragmentos guardados
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        size = len(value)
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old)
+            if size > self.max_bytes // 4:
+                return  # maior do que vale a pena guardar
+            self._data[key] = value
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, dropped = self._data.popitem(last=False)
+                self._bytes -= len(dropped)
+
+    def nbytes(self):
+        return self._bytes
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+
+class FragmentCacheExtension(Extension):
+    """Tag ``{% cache nome, *partes %}...{% endcache %}``."""
+
+    tags = {"cache"}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        # o Environment do Flask conhece a app (e a config já aplicada pelo create_app)
+        app = getattr(environment, "app", None)
+        max_bytes = app.config.get("FRAGMENT_CACHE_MAX_BYTES") if app is not None else None
+        environment.extend(fragment_cache=FragmentCache(max_bytes) if max_bytes else FragmentCache())
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        parts = [parser.parse_expression()]
+        while parser.stream.skip_if("comma"):
+            parts.append(parser.parse_expression())
+        body = parser.parse_statements(("name:endcache",), drop_needle=True)
+        return nodes.CallBlock(
+            self.call_method("_render_cached", [nodes.List(parts)]), [], [], body
+        ).set_lineno(lineno)
+
+    def _render_cached(self, parts, caller):
+        user_id = session.get("user_id") if has_request_context() else None
+        key = (user_id, *parts)
+        cache = self.environment.fragment_cache
+        rv = cache.get(key)
+        if rv is None:
+            rv = caller()
+            cache.set(key, rv)
+        return rv